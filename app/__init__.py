@@ -1,25 +1,75 @@
 from flask import Flask
 from flask_login import LoginManager
-from flask_mail import Mail
-from .models import db, User
+from werkzeug.middleware.proxy_fix import ProxyFix
+from .models import db
+from .database import database_url, engine_options, configure_sqlite
+from .migrations import upgrade as upgrade_schema
+from .mailer import mail, mail_queue
+from .images import image_srcset
+from .history import sparkline_points
+from .image_proxy import image_src
+from .emails import registration_email, approval_email, password_reset_email, account_info_change_email
+from .status import status_checker
+from .status_feed import status_feed
+from .user_cache import user_cache
+from .logs import configure_logging
+from .metrics import metrics
+from .assets import assets
+from .page_cache import page_cache
+from .background import start_background_jobs
+from .passwords import passwords
+from .site_meta import site_meta
 import os
 import secrets
 
-# Initialize extensions
-mail = Mail()
-
 def create_app():
     app = Flask(__name__)
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', secrets.token_hex(16))
+    app.config['LOG_LEVEL'] = os.getenv('LOG_LEVEL', 'INFO')
+    app.config['LOG_FORMAT'] = os.getenv('LOG_FORMAT', 'text')  # 'json' for one JSON object per line
+    configure_logging(app)
 
     # Database setup
     instance_path = os.path.join(app.root_path, 'instance')
-    if not os.path.exists(instance_path):
-        os.makedirs(instance_path)
+    os.makedirs(instance_path, exist_ok=True)
     db_path = os.path.join(instance_path, 'bookmarks.db')
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    # DATABASE_URL selects another backend, e.g. postgresql://user:pass@db/bookmarks
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url(db_path)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', '5'))
+    app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+    app.config['DB_POOL_TIMEOUT'] = int(os.getenv('DB_POOL_TIMEOUT', '30'))
+    app.config['DB_POOL_RECYCLE'] = int(os.getenv('DB_POOL_RECYCLE', '1800'))  # Seconds before a connection is replaced
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+    app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))  # Wait this long for a write lock
+    app.config['SQLITE_MMAP_SIZE'] = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+    app.config['SQLITE_CACHE_SIZE_KB'] = int(os.getenv('SQLITE_CACHE_SIZE_KB', '20000'))
     app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'static/images')
+    app.config['MAX_IMAGE_UPLOAD_BYTES'] = int(os.getenv('MAX_IMAGE_UPLOAD_BYTES', str(10 * 1024 * 1024)))
+    app.config['IMAGE_TILE_SIZE'] = int(os.getenv('IMAGE_TILE_SIZE', '64'))  # Longest side of the tile variant in pixels, 2x is double
+
+    # CSS and JS are served as fingerprinted, precompressed copies with immutable caching
+    app.config['ASSETS_ENABLED'] = os.getenv('ASSETS_ENABLED', 'True').lower() == 'true'  # Turn off while editing static files
+    app.config['ASSETS_DIR'] = os.path.join(instance_path, 'assets')
+
+    # Remote image_url bookmarks are fetched once and served from a local cache
+    app.config['IMAGE_PROXY_ENABLED'] = os.getenv('IMAGE_PROXY_ENABLED', 'True').lower() == 'true'
+    app.config['IMAGE_PROXY_CACHE_DIR'] = os.path.join(instance_path, 'image_cache')
+    app.config['IMAGE_PROXY_MAX_BYTES'] = int(os.getenv('IMAGE_PROXY_MAX_BYTES', str(100 * 1024 * 1024)))
+    app.config['IMAGE_PROXY_TTL'] = int(os.getenv('IMAGE_PROXY_TTL', '86400'))  # Seconds before revalidating with the source
+    app.config['IMAGE_PROXY_MAX_AGE'] = int(os.getenv('IMAGE_PROXY_MAX_AGE', '604800'))  # Browser cache lifetime
+    app.config['IMAGE_PROXY_TIMEOUT'] = float(os.getenv('IMAGE_PROXY_TIMEOUT', '5'))
+    app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = os.getenv('IMAGE_PROXY_ALLOW_PRIVATE', 'False').lower() == 'true'  # Fetch LAN hosts server side
+
+    # Titles and favicons of bookmarked sites, fetched once per origin by a background job
+    app.config['SITE_META_ENABLED'] = os.getenv('SITE_META_ENABLED', 'True').lower() == 'true'
+    app.config['SITE_META_INTERVAL'] = int(os.getenv('SITE_META_INTERVAL', '300'))  # Seconds between enrichment cycles
+    app.config['SITE_META_FETCHES_PER_CYCLE'] = int(os.getenv('SITE_META_FETCHES_PER_CYCLE', '50'))  # Origins fetched per cycle
+    app.config['SITE_META_WORKERS'] = int(os.getenv('SITE_META_WORKERS', '4'))  # Origins fetched at once
+    app.config['SITE_META_HOST_INTERVAL'] = float(os.getenv('SITE_META_HOST_INTERVAL', '1'))  # Minimum seconds between requests to one host
+    app.config['SITE_META_TIMEOUT'] = float(os.getenv('SITE_META_TIMEOUT', '5'))
+    app.config['SITE_META_RETRY_AFTER'] = int(os.getenv('SITE_META_RETRY_AFTER', '3600'))  # Seconds before a failed origin is tried again
+    app.config['SITE_META_ALLOW_PRIVATE'] = os.getenv('SITE_META_ALLOW_PRIVATE', 'False').lower() == 'true'  # Fetch LAN hosts too
 
     # Flask-Mail configuration using environment variables without defaults
     app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER')  # No default
@@ -34,10 +84,91 @@ def create_app():
     ) if os.getenv('MAIL_USERNAME') else None  # Set to None if no username
     app.config['MAIL_ASCII_ATTACHMENTS'] = os.getenv('MAIL_ASCII_ATTACHMENTS', 'False').lower() == 'true'
     app.config['MAIL_CHARSET'] = os.getenv('MAIL_CHARSET', 'UTF-8')
+    app.config['MAIL_TIMEOUT'] = float(os.getenv('MAIL_TIMEOUT', '10'))  # SMTP connect/read timeout in seconds
+
+    # Outbound mail is queued in the database and sent by a background worker
+    app.config['MAIL_QUEUE_ENABLED'] = os.getenv('MAIL_QUEUE_ENABLED', 'True').lower() == 'true'
+    app.config['MAIL_QUEUE_INTERVAL'] = int(os.getenv('MAIL_QUEUE_INTERVAL', '30'))  # Seconds between queue scans
+    app.config['MAIL_MAX_ATTEMPTS'] = int(os.getenv('MAIL_MAX_ATTEMPTS', '5'))
+    app.config['MAIL_RETRY_DELAY'] = int(os.getenv('MAIL_RETRY_DELAY', '60'))  # First retry delay, doubled per attempt
+    app.config['MAIL_CLAIM_TIMEOUT'] = int(os.getenv('MAIL_CLAIM_TIMEOUT', '300'))  # Seconds before mail a request was sending is retried by the queue
+    app.config['MAIL_INLINE_BATCH'] = int(os.getenv('MAIL_INLINE_BATCH', '20'))  # Emails an admin bulk action sends before leaving the rest to the queue
+
+    # Background URL health checks (status dots are read from the stored results)
+    app.config['STATUS_CHECK_ENABLED'] = os.getenv('STATUS_CHECK_ENABLED', 'True').lower() == 'true'
+    app.config['STATUS_CHECK_INTERVAL'] = int(os.getenv('STATUS_CHECK_INTERVAL', '60'))  # Seconds between check cycles
+    app.config['STATUS_CHECK_TIMEOUT'] = float(os.getenv('STATUS_CHECK_TIMEOUT', '5'))
+    app.config['STATUS_CHECK_DEADLINE'] = float(os.getenv('STATUS_CHECK_DEADLINE')) if os.getenv('STATUS_CHECK_DEADLINE') else None  # Defaults to 2x the timeout
+    app.config['STATUS_CHECK_WORKERS'] = int(os.getenv('STATUS_CHECK_WORKERS', '16'))
+    app.config['STATUS_CHECK_PER_HOST'] = int(os.getenv('STATUS_CHECK_PER_HOST', '2'))  # Concurrent probes and pooled connections per host
+    app.config['STATUS_POOL_HOSTS'] = int(os.getenv('STATUS_POOL_HOSTS', '100'))  # Hosts that keep a keep-alive pool
+    app.config['STATUS_CHECK_ON_DEMAND'] = os.getenv('STATUS_CHECK_ON_DEMAND', 'False').lower() == 'true'  # Also probe page URLs during the request
+    app.config['STATUS_CACHE_UP_TTL'] = int(os.getenv('STATUS_CACHE_UP_TTL', '60'))  # Seconds an "up" result is reused
+    app.config['STATUS_CACHE_DOWN_TTL'] = int(os.getenv('STATUS_CACHE_DOWN_TTL', '30'))  # First retry delay for a failing host, doubled per failure
+    app.config['STATUS_CACHE_MAX_BACKOFF'] = int(os.getenv('STATUS_CACHE_MAX_BACKOFF', '900'))
+    app.config['STATUS_CACHE_SIZE'] = int(os.getenv('STATUS_CACHE_SIZE', '10000'))
+    app.config['STATUS_HISTORY_HOURS'] = int(os.getenv('STATUS_HISTORY_HOURS', '24'))  # Raw probe samples kept, rollups are kept longer
+    app.config['STATUS_STREAM_ENABLED'] = os.getenv('STATUS_STREAM_ENABLED', 'True').lower() == 'true'  # Push status changes to open pages
+    app.config['STATUS_STREAM_POLL'] = float(os.getenv('STATUS_STREAM_POLL', '2'))  # Seconds between checks for new results
+    app.config['STATUS_STREAM_TIMEOUT'] = int(os.getenv('STATUS_STREAM_TIMEOUT', '30'))  # Seconds a stream stays open before the browser reconnects
+    # Open streams per worker, each holding one of its GUNICORN_THREADS; half of them by default
+    app.config['STATUS_STREAM_MAX'] = int(os.getenv('STATUS_STREAM_MAX', max(1, int(os.getenv('GUNICORN_THREADS', '8')) // 2)))
+    app.config['STATUS_STREAM_BUSY_RETRY'] = int(os.getenv('STATUS_STREAM_BUSY_RETRY', '30'))  # Seconds before a browser turned away retries
+    # Set STATUS_CACHE_SHARED=true to keep the cache in a SQLite file shared by all gunicorn workers
+    if os.getenv('STATUS_CACHE_SHARED', 'False').lower() == 'true':
+        app.config['STATUS_CACHE_PATH'] = os.path.join(instance_path, 'status_cache.db')
+    app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', '60'))  # Seconds the logged-in user's fields are reused, 0 disables
+    app.config['BOOKMARKS_PAGE_SIZE'] = int(os.getenv('BOOKMARKS_PAGE_SIZE', '60'))  # Tiles per page on the home page and API
+    # Folders and schema are set up at startup unless AUTO_SETUP is off; then `flask init` must run first
+    app.config['AUTO_SETUP'] = os.getenv('AUTO_SETUP', 'True').lower() == 'true'
+    # gunicorn.conf.py turns this off and starts the jobs after forking instead
+    app.config['BACKGROUND_JOBS_AT_STARTUP'] = os.getenv('BACKGROUND_JOBS_AT_STARTUP', 'True').lower() == 'true'
+    app.config['BACKGROUND_LOCK_FILE'] = os.path.join(instance_path, 'background.lock')  # Held by the one process running the jobs
+    app.config['BACKGROUND_LOCK_RETRY'] = float(os.getenv('BACKGROUND_LOCK_RETRY', '5'))  # Seconds between attempts to take the lock
+    app.config['BACKGROUND_WAKE_POLL'] = float(os.getenv('BACKGROUND_WAKE_POLL', '2'))  # Seconds between checks for wake requests from other workers
+    # Password hashing runs in a bounded pool; failed logins are throttled per IP and per username
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))  # Concurrent hashes per process
+    app.config['PASSWORD_HASH_QUEUE'] = int(os.getenv('PASSWORD_HASH_QUEUE', '16'))  # Hashes running or waiting before logins get 503
+    app.config['LOGIN_FAILURE_WINDOW'] = int(os.getenv('LOGIN_FAILURE_WINDOW', '900'))  # Seconds failed logins are counted
+    app.config['LOGIN_MAX_FAILURES_PER_IP'] = int(os.getenv('LOGIN_MAX_FAILURES_PER_IP', '20'))
+    app.config['LOGIN_MAX_FAILURES_PER_USER'] = int(os.getenv('LOGIN_MAX_FAILURES_PER_USER', '5'))
+    # Set LOGIN_THROTTLE_SHARED=true to count failures in a SQLite file shared by all gunicorn workers
+    if os.getenv('LOGIN_THROTTLE_SHARED', 'False').lower() == 'true':
+        app.config['LOGIN_THROTTLE_PATH'] = os.path.join(instance_path, 'login_throttle.db')
+    # Behind reverse proxies (load balancer, nginx) set TRUSTED_PROXY_HOPS to how many of them add
+    # X-Forwarded-For, so request.remote_addr and the per-IP login limit see the client rather than
+    # the proxy. Leave it at 0 when clients connect directly, or they could forge the header.
+    app.config['TRUSTED_PROXY_HOPS'] = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+    if app.config['TRUSTED_PROXY_HOPS']:
+        hops = app.config['TRUSTED_PROXY_HOPS']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+    app.config['ADMIN_PAGE_SIZE'] = int(os.getenv('ADMIN_PAGE_SIZE', '50'))  # Users per list page in the admin panel
+    app.config['PAGE_CACHE_ENABLED'] = os.getenv('PAGE_CACHE_ENABLED', 'True').lower() == 'true'  # ETags and rendered-page reuse for the bookmarks view
+    app.config['PAGE_CACHE_SIZE'] = int(os.getenv('PAGE_CACHE_SIZE', '500'))  # Rendered pages kept per process
+    app.config['PAGE_CACHE_WINDOW'] = int(os.getenv('PAGE_CACHE_WINDOW', '300'))  # Seconds before a page is rebuilt for fresh uptime history
+
+    # Prometheus-style metrics at /metrics, merged across gunicorn workers through METRICS_DIR
+    app.config['METRICS_ENABLED'] = os.getenv('METRICS_ENABLED', 'True').lower() == 'true'
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')  # Require "Authorization: Bearer <token>"; without it only loopback clients may scrape
+    app.config['METRICS_DIR'] = os.path.join(instance_path, 'metrics')
 
     # Initialize extensions with the app
     db.init_app(app)
     mail.init_app(app)
+    mail_queue.init_app(app)
+    status_checker.init_app(app)
+    status_feed.init_app(app)
+    user_cache.init_app(app)
+    metrics.init_app(app)
+    assets.init_app(app)
+    page_cache.init_app(app)
+    passwords.init_app(app)
+    site_meta.init_app(app)
+    metrics.counter_func('status_cache_hits_total', 'Status cache lookups answered from the cache.', lambda: status_checker.cache.stats()['hits'])
+    metrics.counter_func('status_cache_misses_total', 'Status cache lookups that needed a probe.', lambda: status_checker.cache.stats()['misses'])
+    metrics.counter_func('user_cache_hits_total', 'Logged-in user lookups answered from the cache.', lambda: user_cache.hits)
+    metrics.counter_func('user_cache_misses_total', 'Logged-in user lookups that queried the database.', lambda: user_cache.misses)
+    metrics.gauge('mail_queue_depth', 'Emails waiting to be sent.', mail_queue.depth)
 
     login_manager = LoginManager()
     login_manager.init_app(app)
@@ -45,10 +176,24 @@ def create_app():
 
     @login_manager.user_loader
     def load_user(user_id):
-        return db.session.get(User, int(user_id))
+        return user_cache.get(int(user_id))
 
     with app.app_context():
-        db.create_all()
+        configure_sqlite(app)
+        if app.config['AUTO_SETUP']:
+            setup(app)
+        if app.config['METRICS_ENABLED']:
+            metrics.instrument_engine(db.engine)
+
+    if app.config['BACKGROUND_JOBS_AT_STARTUP']:
+        start_background_jobs(app)
+
+    app.add_template_filter(image_srcset)
+    app.add_template_filter(image_src)
+    app.add_template_filter(sparkline_points)
+
+    from .cli import register_commands
+    register_commands(app)
 
     from .routes.auth import auth_bp
     from .routes.main import main_bp
@@ -57,85 +202,9 @@ def create_app():
 
     return app
 
-# Email template functions
-def generate_email_html(subject, body_content):
-    return f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <title>{subject}</title>
-    </head>
-    <body style="font-family: Arial, sans-serif; background-color: #f4f4f4; margin: 0; padding: 0;">
-        <table width="100%" cellpadding="0" cellspacing="0" style="background-color: #f4f4f4; padding: 20px;">
-            <tr>
-                <td align="center">
-                    <table width="600px" cellpadding="0" cellspacing="0" style="background-color: #ffffff; border-radius: 8px; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
-                        <tr>
-                            <td style="background-color: #1b263b; color: #00ffff; text-align: center; padding: 20px; border-top-left-radius: 8px; border-top-right-radius: 8px;">
-                                <h1 style="margin: 0; font-size: 24px; text-shadow: 0 0 5px rgba(0, 255, 255, 0.5);">{subject}</h1>
-                            </td>
-                        </tr>
-                        <tr>
-                            <td style="padding: 20px; color: #333333; line-height: 1.6;">
-                                <div style="background-color: #f9f9f9; border: 1px solid #00ffff; border-radius: 5px; padding: 15px; box-shadow: 0 0 10px rgba(0, 255, 255, 0.1);">
-                                    {body_content}
-                                </div>
-                            </td>
-                        </tr>
-                        <tr>
-                            <td style="text-align: center; padding: 10px; color: #777777; font-size: 12px; border-bottom-left-radius: 8px; border-bottom-right-radius: 8px;">
-                                <p style="margin: 0;">© 2025 Bookmarks. All rights reserved. 
-                                <!-- Optional: Add Privacy Policy link if your email client supports it -->
-                                <!-- <a href="https://yourdomain.com/privacy-policy" style="color: #00ffff; text-decoration: none;">Privacy Policy</a> -->
-                                </p>
-                            </td>
-                        </tr>
-                    </table>
-                </td>
-            </tr>
-        </table>
-    </body>
-    </html>
-    """
-
-def registration_email(name):
-    body = f"""
-    <p>Hello {name},</p>
-    <p>Thank you for registering! Your account is pending approval.</p>
-    <p>Thank you,<br>Management</p>
-    """
-    return generate_email_html("Registration Confirmation", body)
-
-def approval_email(name, username):
-    body = f"""
-    <p>Hello {name},</p>
-    <p>Thank you for registering! Your account has been approved! You may login now.</p>
-    <p><strong>Username:</strong> {username}</p>
-    <p>Thank you,<br>Management</p>
-    """
-    return generate_email_html("Account Approved", body)
-
-def password_reset_email(name, username, temp_password="ChangeMe123@"):
-    body = f"""
-    <p>Hello {name},</p>
-    <p>Your password has been reset. Below is your new information, please update your password in your profile section within 24 hours!</p>
-    <p><strong>Username:</strong> {username}</p>
-    <p><strong>Password:</strong> {temp_password}</p>
-    <p>Thank you,<br>Management</p>
-    """
-    return generate_email_html("Password Reset", body)
-
-def account_info_change_email(name, changes):
-    body_lines = [f"<p>Hello {name},</p>", "<p>Your account information has been updated.</p>"]
-    if "name" in changes:
-        body_lines.append(f"<p><strong>Name:</strong> {changes['name']}</p>")
-    if "email" in changes:
-        body_lines.append(f"<p><strong>Email:</strong> {changes['email']}</p>")
-    if "username" in changes:
-        body_lines.append(f"<p><strong>Username:</strong> {changes['username']}</p>")
-    if "password" in changes:
-        body_lines.append(f"<p><strong>Password:</strong> changed</p>")
-    body_lines.append("<p>Thank you,<br>Management</p>")
-    body = "".join(body_lines)
-    return generate_email_html("Account Information Updated", body)
\ No newline at end of file
+# One-time setup: folders the app writes to and pending schema migrations. Runs inside an app
+# context, at startup or from `flask init`.
+def setup(app):
+    os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], 'incoming'), exist_ok=True)
+    os.makedirs(app.config['IMAGE_PROXY_CACHE_DIR'], exist_ok=True)
+    return upgrade_schema()
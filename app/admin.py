@@ -0,0 +1,60 @@
+from sqlalchemy import func, or_
+from sqlalchemy.orm import aliased
+from .models import db, User, Bookmark, ImageBlob
+from .images import release_image
+
+# Queries behind the admin panel. Users are listed a page at a time with keyset pagination on the
+# unique username, so a page is an index range scan however many accounts there are, and the
+# bookmark counts and image storage of a page's users come from one grouped query.
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+# Users with a status, in username order after the username `after`, optionally matching query
+# in the username, name or email. Returns (users, username to continue after or None).
+def list_users(status, query='', after=None, limit=50, exclude_id=None):
+    users = User.query.filter(User.status == status)
+    if exclude_id is not None:
+        users = users.filter(User.id != exclude_id)
+    if query:
+        pattern = f"%{_escape_like(query)}%"
+        users = users.filter(or_(User.username.ilike(pattern, escape='\\'), User.real_name.ilike(pattern, escape='\\'),
+                                 User.email.ilike(pattern, escape='\\')))
+    if after:
+        users = users.filter(User.username > after)
+    users = users.order_by(User.username).limit(limit + 1).all()
+    if len(users) > limit:
+        return users[:limit], users[limit - 1].username
+    return users, None
+
+# Number of users per status
+def user_totals():
+    return dict(db.session.query(User.status, func.count(User.id)).group_by(User.status))
+
+# Bookmark count and bytes of stored images (uploads and site icons) per user id. Images shared
+# between users count towards each of them.
+def user_usage(user_ids):
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    icon = aliased(ImageBlob)
+    storage = func.coalesce(func.sum(ImageBlob.size), 0) + func.coalesce(func.sum(icon.size), 0)
+    rows = (db.session.query(Bookmark.user_id, func.count(Bookmark.id), storage)
+            .outerjoin(ImageBlob, ImageBlob.url == Bookmark.image_url)
+            .outerjoin(icon, icon.url == Bookmark.icon_url)
+            .filter(Bookmark.user_id.in_(user_ids))
+            .group_by(Bookmark.user_id))
+    return {user_id: {'bookmarks': count, 'storage': storage} for user_id, count, storage in rows}
+
+# Delete a user and their bookmarks with one statement each. Image references are dropped per
+# distinct image; the files themselves are left to collect_garbage(), which removes them once
+# no bookmark has used them for the grace period.
+def delete_user(user):
+    for column in (Bookmark.image_url, Bookmark.icon_url):
+        images = (db.session.query(column, func.count(Bookmark.id))
+                  .filter(Bookmark.user_id == user.id, column.like('/static/images/%'))
+                  .group_by(column).all())
+        for image_url, count in images:
+            release_image(image_url, count)
+    Bookmark.query.filter(Bookmark.user_id == user.id).delete(synchronize_session=False)
+    User.query.filter(User.id == user.id).delete(synchronize_session=False)
@@ -0,0 +1,127 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from flask import abort, request, send_file, url_for
+
+try:
+    import brotli
+except ImportError:  # Optional; without it only gzip variants are written
+    brotli = None
+
+# Fingerprinted static assets. At startup every file under the static folder (except the upload
+# folder) is copied to ASSETS_DIR as <name>.<content hash>.<ext>, with gzip and, when the brotli
+# package is installed, brotli variants next to it. Templates link them through asset_url(), and
+# they are served from /assets with a one-year immutable Cache-Control, so browsers never
+# revalidate them; a changed file gets a new name. Uploaded image tiles are content addressed
+# already and get the same header from the regular static route.
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.map'}
+
+_TILE_PATH = re.compile(r'^images/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.tile(@2x)?\.(webp|jpg)$')
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+class Assets:
+    def __init__(self, app=None):
+        self.app = None
+        self.manifest = {}  # Source path relative to the static folder -> fingerprinted path
+        self.encodings = {}  # Fingerprinted path -> precompressed encodings available
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('ASSETS_ENABLED', True)
+        app.config.setdefault('ASSETS_DIR', os.path.join(app.instance_path, 'assets'))
+        app.config.setdefault('ASSETS_MAX_AGE', 365 * 24 * 3600)
+        app.extensions['assets'] = self
+        app.add_template_global(self.url, 'asset_url')
+        app.after_request(self._cache_tiles)
+        if app.config['ASSETS_ENABLED']:
+            self.build()
+            app.add_url_rule('/assets/<path:filename>', 'assets', self._serve)
+
+    def _sources(self):
+        static_folder = self.app.static_folder
+        upload_folder = os.path.abspath(self.app.config.get('UPLOAD_FOLDER') or os.path.join(static_folder, 'images'))
+        for root, dirs, files in os.walk(static_folder):
+            dirs[:] = [name for name in dirs if os.path.abspath(os.path.join(root, name)) != upload_folder]
+            for name in files:
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, static_folder).replace(os.sep, '/'), path
+
+    # Write the fingerprinted copies and their compressed variants. Files already built from the
+    # same content are left alone, so workers starting together do not redo the work; old builds
+    # stay, so pages cached before a deploy can still load their assets.
+    def build(self):
+        out_dir = self.app.config['ASSETS_DIR']
+        manifest = {}
+        encodings = {}
+        for rel_path, path in self._sources():
+            with open(path, 'rb') as f:
+                data = f.read()
+            base, ext = os.path.splitext(rel_path)
+            built = f"{base}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+            dest = os.path.join(out_dir, built)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if not os.path.exists(dest):
+                _write_atomic(dest, data)
+            available = []
+            if ext.lower() in COMPRESSIBLE:
+                variants = [('gzip', '.gz', lambda: gzip.compress(data, 9, mtime=0))]
+                if brotli is not None:
+                    variants.insert(0, ('br', '.br', lambda: brotli.compress(data, quality=11)))
+                for encoding, suffix, compress in variants:
+                    if not os.path.exists(dest + suffix):
+                        compressed = compress()
+                        if len(compressed) >= len(data):
+                            continue
+                        _write_atomic(dest + suffix, compressed)
+                    available.append((encoding, suffix))
+            manifest[rel_path] = built
+            encodings[built] = available
+        self.manifest = manifest
+        self.encodings = encodings
+        return manifest
+
+    # Template global: URL of the fingerprinted copy of a static file, or the plain static URL
+    # for files that were not built (e.g. with ASSETS_ENABLED off)
+    def url(self, filename):
+        built = self.manifest.get(filename)
+        if built is None:
+            return url_for('static', filename=filename)
+        return url_for('assets', filename=built)
+
+    def _serve(self, filename):
+        if filename not in self.encodings:
+            abort(404)
+        path = os.path.join(self.app.config['ASSETS_DIR'], filename)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        accepted = request.accept_encodings
+        for encoding, suffix in self.encodings[filename]:
+            if accepted[encoding]:
+                response = send_file(path + suffix, mimetype=mimetype, max_age=self.app.config['ASSETS_MAX_AGE'])
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_file(path, mimetype=mimetype, max_age=self.app.config['ASSETS_MAX_AGE'])
+        response.vary.add('Accept-Encoding')
+        response.cache_control.immutable = True
+        return response
+
+    def _cache_tiles(self, response):
+        if (request.endpoint == 'static' and response.status_code in (200, 304)
+                and _TILE_PATH.match((request.view_args or {}).get('filename', ''))):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = self.app.config['ASSETS_MAX_AGE']
+            response.cache_control.immutable = True
+        return response
+
+assets = Assets()
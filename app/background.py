@@ -0,0 +1,73 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+from .models import db, Counter
+from .status import status_checker
+from .mailer import mail_queue
+from .site_meta import site_meta
+
+logger = logging.getLogger(__name__)
+
+# Background jobs (URL health checks, the mail queue and site metadata) run in one process only.
+# Every process that could run them waits on an exclusive lock on BACKGROUND_LOCK_FILE from a
+# helper thread, and the holder starts the jobs. The lock belongs to the open file, so when that
+# gunicorn worker exits the OS releases it and the next waiting worker takes over.
+#
+# The lock is taken with non-blocking attempts and a sleep between them, so waiting never blocks
+# the process. wake() in other processes bumps a counter per job (database.signal_wake), which
+# the holder polls every BACKGROUND_WAKE_POLL seconds.
+
+_lock_file = None
+
+WAKE_COUNTERS = {'wake_status_check': status_checker, 'wake_mail_queue': mail_queue, 'wake_site_meta': site_meta}
+
+def _start_jobs(app):
+    if app.config['STATUS_CHECK_ENABLED']:
+        status_checker.start()
+    if app.config['MAIL_QUEUE_ENABLED']:
+        mail_queue.start()
+    if app.config['SITE_META_ENABLED']:
+        site_meta.start()
+
+def start_background_jobs(app):
+    if not (app.config['STATUS_CHECK_ENABLED'] or app.config['MAIL_QUEUE_ENABLED'] or app.config['SITE_META_ENABLED']):
+        return
+    path = app.config.get('BACKGROUND_LOCK_FILE')
+    if not path:
+        _start_jobs(app)
+        return
+
+    def wait_for_lock():
+        global _lock_file
+        lock_file = open(path, 'a')
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(app.config['BACKGROUND_LOCK_RETRY'])
+        _lock_file = lock_file  # Kept open, and so locked, for the life of the process
+        logger.info("Running background jobs in process %s", os.getpid())
+        _start_jobs(app)
+        _watch_wake_counters(app)
+
+    threading.Thread(target=wait_for_lock, name='background-lock', daemon=True).start()
+
+# Wake the jobs whose counters other processes bumped since the last poll
+def _watch_wake_counters(app):
+    seen = None
+    while True:
+        try:
+            with app.app_context():
+                values = dict(db.session.query(Counter.name, Counter.value).filter(Counter.name.in_(WAKE_COUNTERS)).all())
+        except Exception:
+            logger.exception("Reading background wake counters failed")
+        else:
+            if seen is not None:
+                for name, job in WAKE_COUNTERS.items():
+                    if values.get(name) != seen.get(name):
+                        job.wake()
+            seen = values
+        time.sleep(app.config['BACKGROUND_WAKE_POLL'])
@@ -0,0 +1,106 @@
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from .images import collect_garbage, recount_references
+from .migrations import upgrade, current_version, MIGRATIONS
+from .models import db, User
+from .transfer import FORMATS, format_for_filename, export_bookmarks, read_records, import_bookmarks
+from .site_meta import site_meta
+
+# Maintenance commands, run with e.g. `flask --app run images gc`
+images_cli = AppGroup('images', help='Manage stored bookmark images.')
+
+@images_cli.command('gc')
+@click.option('--grace', default=3600, show_default=True, help='Seconds an unreferenced image is kept before removal.')
+@click.option('--dry-run', is_flag=True, help='Only list what would be removed.')
+def images_gc(grace, dry_run):
+    """Remove image files no bookmark references any more."""
+    removed = collect_garbage(grace_seconds=grace, dry_run=dry_run)
+    for path in removed:
+        click.echo(path)
+    click.echo(f"{'Would remove' if dry_run else 'Removed'} {len(removed)} file(s).")
+
+@images_cli.command('recount')
+def images_recount():
+    """Rebuild image reference counts from the bookmarks table."""
+    changed = recount_references()
+    click.echo(f"Corrected {changed} reference count(s).")
+
+db_cli = AppGroup('db', help='Manage the database schema.')
+
+@db_cli.command('upgrade')
+def db_upgrade():
+    """Apply pending schema migrations."""
+    applied = upgrade()
+    click.echo(f"Applied migration(s) {', '.join(map(str, applied))}." if applied else "Schema is up to date.")
+
+@db_cli.command('current')
+def db_current():
+    """Show the schema version of the database."""
+    click.echo(f"Schema version {current_version()} (latest {MIGRATIONS[-1][0]}).")
+
+bookmarks_cli = AppGroup('bookmarks', help='Import and export bookmarks.')
+
+def _user_or_fail(username):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.BadParameter(f"No user named {username!r}.", param_hint='--user')
+    return user
+
+@bookmarks_cli.command('export')
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='jsonl', show_default=True)
+@click.option('--user', 'username', help='Only export this account; all accounts by default.')
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-', help='File to write, stdout by default.')
+def bookmarks_export(fmt, username, output):
+    """Export bookmarks as browser HTML, JSON Lines or CSV."""
+    if username:
+        user = _user_or_fail(username)
+        users, with_user = [(user.id, user.username)], False
+    else:
+        users, with_user = [tuple(row) for row in db.session.query(User.id, User.username).order_by(User.username)], True
+    for chunk in export_bookmarks(fmt, users, with_user):
+        output.write(chunk)
+
+@bookmarks_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), help='Defaults to the file extension.')
+@click.option('--user', 'username', help='Import into this account; otherwise each entry names its user.')
+@click.option('--batch-size', default=500, show_default=True, help='Bookmarks inserted per transaction.')
+def bookmarks_import(path, fmt, username, batch_size):
+    """Import bookmarks, skipping URLs the user already has."""
+    fmt = fmt or format_for_filename(path)
+    if fmt is None:
+        raise click.BadParameter('Cannot tell the format from the file name, pass --format.', param_hint='PATH')
+    user_id = _user_or_fail(username).id if username else None
+    with open(path, encoding='utf-8-sig', errors='replace', newline='') as f:
+        stats = import_bookmarks(read_records(f, fmt), user_id, batch_size)
+    click.echo(f"Imported {stats['imported']} bookmark(s), skipped {stats['duplicates']} duplicate(s) and {stats['invalid']} invalid entr{'y' if stats['invalid'] == 1 else 'ies'}.")
+
+@bookmarks_cli.command('enrich')
+@click.option('--cycles', default=1, show_default=True, help='Enrichment cycles to run, 0 to run until nothing is left to fetch.')
+def bookmarks_enrich(cycles):
+    """Fetch site titles and favicons for bookmarks now, instead of waiting for the background job."""
+    total_assigned = total_fetched = 0
+    cycle = 0
+    while cycles == 0 or cycle < cycles:
+        assigned, fetched = site_meta.run_once()
+        total_assigned += assigned
+        total_fetched += fetched
+        cycle += 1
+        if not assigned and not fetched:
+            break
+    click.echo(f"Assigned {total_assigned} bookmark(s) to their sites and fetched {total_fetched} site(s).")
+
+@click.command('init')
+@with_appcontext
+def init_command():
+    """Create the app's folders and apply schema migrations, once before starting the server."""
+    from . import setup
+    applied = setup(current_app)
+    click.echo(f"Applied migration(s) {', '.join(map(str, applied))}." if applied else "Schema is up to date.")
+
+def register_commands(app):
+    app.cli.add_command(init_command)
+    app.cli.add_command(images_cli)
+    app.cli.add_command(db_cli)
+    app.cli.add_command(bookmarks_cli)
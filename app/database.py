@@ -0,0 +1,83 @@
+import os
+from sqlalchemy import event, insert, update
+from sqlalchemy.exc import IntegrityError
+from .models import db, Counter, User
+
+# Database URL from the environment, falling back to the bundled SQLite file
+def database_url(default_sqlite_path):
+    url = os.getenv('DATABASE_URL')
+    if not url:
+        return f'sqlite:///{default_sqlite_path}'
+    # Heroku-style URLs use a scheme SQLAlchemy no longer accepts
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+# Connection pool settings. pre_ping replaces connections the server dropped, recycle retires
+# them before typical idle timeouts on load balancers and managed databases.
+def engine_options(config):
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    }
+
+# Increment a named counter in the current transaction and return the new value. The row stays
+# locked until commit, so values become visible in the order they were handed out.
+def bump_counter(name):
+    updated = Counter.query.filter_by(name=name).update({Counter.value: Counter.value + 1}, synchronize_session=False)
+    if not updated:
+        db.session.add(Counter(name=name, value=1))
+        db.session.flush()
+    return db.session.query(Counter.value).filter_by(name=name).scalar()
+
+def counter_value(name):
+    return db.session.query(Counter.value).filter_by(name=name).scalar() or 0
+
+# Ask the process running the background jobs to wake one of them, from a process that does not
+# (see background.py). Uses its own connection, so the caller's session is not committed.
+def signal_wake(name):
+    try:
+        with db.engine.begin() as connection:
+            bumped = connection.execute(
+                update(Counter).where(Counter.name == name).values(value=Counter.value + 1)).rowcount
+            if not bumped:
+                connection.execute(insert(Counter).values(name=name, value=1))
+    except IntegrityError:
+        pass  # Another process created the row first, which wakes the job just as well
+
+# Mark the bookmarks of these users as changed, in the current transaction. Pages built from
+# them carry the version in their ETag (see page_cache.py).
+def bump_bookmarks_version(*user_ids):
+    if user_ids:
+        User.query.filter(User.id.in_(user_ids)).update(
+            {User.bookmarks_version: User.bookmarks_version + 1}, synchronize_session=False)
+
+def bookmarks_version(user_id):
+    return db.session.query(User.bookmarks_version).filter(User.id == user_id).scalar() or 0
+
+# Connection settings for the SQLite database. Every new connection gets WAL journaling so
+# readers never block the writer, a busy timeout so concurrent writes from gunicorn workers wait
+# instead of failing with "database is locked", and larger page/mmap caches for the hot queries.
+def configure_sqlite(app):
+    engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+    config = app.config
+    pragmas = [
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}",
+        f"PRAGMA mmap_size={int(config['SQLITE_MMAP_SIZE'])}",
+        f"PRAGMA cache_size=-{int(config['SQLITE_CACHE_SIZE_KB'])}",  # Negative means KiB, not pages
+        'PRAGMA temp_store=MEMORY',
+    ]
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
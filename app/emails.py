@@ -0,0 +1,38 @@
+from functools import lru_cache
+import os
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+# Email bodies are rendered from templates/emails with their own Jinja environment, so they can
+# be built outside a request (e.g. by the mail queue worker). Templates are compiled once and
+# cached, and every value is autoescaped.
+_env = Environment(
+    loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'templates', 'emails')),
+    autoescape=select_autoescape(['html']),
+    auto_reload=False,
+    trim_blocks=True,
+    lstrip_blocks=True,
+)
+
+@lru_cache(maxsize=None)
+def _template(name):
+    return _env.get_template(name)
+
+def render_email(template_name, subject, **context):
+    return _template(template_name).render(subject=subject, **context)
+
+# Render one personalised message per context from a single compiled template
+def render_emails(template_name, subject, contexts):
+    template = _template(template_name)
+    return [template.render(subject=subject, **context) for context in contexts]
+
+def registration_email(name):
+    return render_email('registration.html', "Registration Confirmation", name=name)
+
+def approval_email(name, username):
+    return render_email('approval.html', "Account Approved", name=name, username=username)
+
+def password_reset_email(name, username, temp_password="ChangeMe123@"):
+    return render_email('password_reset.html', "Password Reset", name=name, username=username, temp_password=temp_password)
+
+def account_info_change_email(name, changes):
+    return render_email('info_change.html', "Account Information Updated", name=name, changes=changes)
@@ -0,0 +1,150 @@
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from sqlalchemy import case
+from .models import db, ProbeSample, StatusRollup
+
+# Uptime history for bookmarked URLs. Every real probe result is appended to probe_sample and,
+# in the same transaction, added to per-minute, per-hour and per-day rollups with an upsert, so
+# reading uptime or a latency series never scans raw samples. Raw samples are kept for
+# STATUS_HISTORY_HOURS and each rollup level for its own retention below, which bounds the
+# storage per URL whatever the probe rate.
+
+# Rollup resolution in seconds and how long its buckets are kept
+RESOLUTIONS = (
+    (60, timedelta(days=2)),
+    (3600, timedelta(days=30)),
+    (86400, timedelta(days=400)),
+)
+RESOLUTION_NAMES = {'raw': 0, '1m': 60, '1h': 3600, '1d': 86400}
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _bucket(moment, resolution):
+    return datetime.fromtimestamp(int(moment.replace(tzinfo=timezone.utc).timestamp()) // resolution * resolution, timezone.utc).replace(tzinfo=None)
+
+def _dialect_insert():
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+# Append probe results given as (url_id, ProbeResult) pairs and fold them into the rollups.
+# Runs in the caller's transaction.
+def record_samples(samples):
+    if not samples:
+        return
+    db.session.execute(ProbeSample.__table__.insert(), [{
+        'url_id': url_id,
+        'checked_at': result.checked_at,
+        'is_up': result.is_up,
+        'status_code': result.status_code,
+        'latency_ms': result.latency_ms,
+        'error': (result.error or '')[:40] or None,
+    } for url_id, result in samples])
+
+    rollups = defaultdict(lambda: {'samples': 0, 'up': 0, 'latency_count': 0, 'latency_sum': 0.0, 'latency_max': None})
+    for url_id, result in samples:
+        for resolution, _ in RESOLUTIONS:
+            rollup = rollups[(url_id, resolution, _bucket(result.checked_at, resolution))]
+            rollup['samples'] += 1
+            rollup['up'] += int(result.is_up)
+            if result.latency_ms is not None:
+                rollup['latency_count'] += 1
+                rollup['latency_sum'] += result.latency_ms
+                rollup['latency_max'] = max(rollup['latency_max'] or 0, result.latency_ms)
+
+    stmt = _dialect_insert()(StatusRollup)
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['url_id', 'resolution', 'bucket_start'],
+        set_={
+            'samples': StatusRollup.samples + excluded.samples,
+            'up': StatusRollup.up + excluded.up,
+            'latency_count': StatusRollup.latency_count + excluded.latency_count,
+            'latency_sum': StatusRollup.latency_sum + excluded.latency_sum,
+            'latency_max': case(
+                (StatusRollup.latency_max.is_(None), excluded.latency_max),
+                (excluded.latency_max > StatusRollup.latency_max, excluded.latency_max),
+                else_=StatusRollup.latency_max,
+            ),
+        },
+    )
+    db.session.execute(stmt, [dict(values, url_id=url_id, resolution=resolution, bucket_start=bucket_start)
+                              for (url_id, resolution, bucket_start), values in rollups.items()])
+
+# Drop samples and rollups past their retention
+def prune_history():
+    now = _utcnow()
+    removed = ProbeSample.query.filter(
+        ProbeSample.checked_at < now - timedelta(hours=current_app.config['STATUS_HISTORY_HOURS'])
+    ).delete(synchronize_session=False)
+    for resolution, retention in RESOLUTIONS:
+        removed += StatusRollup.query.filter(
+            StatusRollup.resolution == resolution, StatusRollup.bucket_start < now - retention
+        ).delete(synchronize_session=False)
+    db.session.commit()
+    return removed
+
+# History of URLs that are no longer checked. Runs in the caller's transaction.
+def forget_history(url_ids):
+    if url_ids:
+        ProbeSample.query.filter(ProbeSample.url_id.in_(url_ids)).delete(synchronize_session=False)
+        StatusRollup.query.filter(StatusRollup.url_id.in_(url_ids)).delete(synchronize_session=False)
+
+# Uptime percentage and hourly average latency over the last hours for each URL id, from the
+# hourly rollups. Latency lists have one entry per hour, None where nothing was measured.
+def uptime_summary(url_ids, hours=24):
+    url_ids = list(url_ids)
+    if not url_ids:
+        return {}
+    start = _bucket(_utcnow(), 3600) - timedelta(hours=hours - 1)
+    rows = (db.session.query(StatusRollup.url_id, StatusRollup.bucket_start, StatusRollup.samples,
+                             StatusRollup.up, StatusRollup.latency_count, StatusRollup.latency_sum)
+            .filter(StatusRollup.url_id.in_(url_ids), StatusRollup.resolution == 3600,
+                    StatusRollup.bucket_start >= start))
+    summary = {}
+    for url_id, bucket_start, samples, up, latency_count, latency_sum in rows:
+        entry = summary.setdefault(url_id, {'samples': 0, 'up': 0, 'latency': [None] * hours})
+        entry['samples'] += samples
+        entry['up'] += up
+        if latency_count:
+            entry['latency'][int((bucket_start - start).total_seconds()) // 3600] = latency_sum / latency_count
+    for entry in summary.values():
+        entry['uptime'] = 100.0 * entry['up'] / entry['samples'] if entry['samples'] else None
+    return summary
+
+# Series for one URL id since a moment, raw samples for resolution 0, rollups otherwise
+def history_series(url_id, resolution, since):
+    if resolution == 0:
+        rows = (ProbeSample.query.filter(ProbeSample.url_id == url_id, ProbeSample.checked_at >= since)
+                .order_by(ProbeSample.checked_at))
+        return [{
+            'at': row.checked_at.isoformat() + 'Z',
+            'is_up': row.is_up,
+            'status_code': row.status_code,
+            'latency_ms': row.latency_ms,
+            'error': row.error,
+        } for row in rows]
+    rows = (StatusRollup.query.filter(StatusRollup.url_id == url_id, StatusRollup.resolution == resolution,
+                                      StatusRollup.bucket_start >= _bucket(since, resolution))
+            .order_by(StatusRollup.bucket_start))
+    return [{
+        'at': row.bucket_start.isoformat() + 'Z',
+        'samples': row.samples,
+        'uptime': 100.0 * row.up / row.samples if row.samples else None,
+        'latency_avg_ms': row.latency_sum / row.latency_count if row.latency_count else None,
+        'latency_max_ms': row.latency_max,
+    } for row in rows]
+
+# Template filter: SVG polyline points for a series, scaled to width x height. Gaps are skipped.
+def sparkline_points(values, width=48, height=12):
+    measured = [value for value in values if value is not None]
+    if not measured:
+        return ''
+    top = max(measured) or 1
+    step = width / max(len(values) - 1, 1)
+    return ' '.join(f"{i * step:.1f},{height - value / top * (height - 1):.1f}"
+                    for i, value in enumerate(values) if value is not None)
@@ -0,0 +1,297 @@
+from collections import namedtuple
+import hashlib
+import ipaddress
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import NewConnectionError
+from flask import current_app, url_for
+from itsdangerous import URLSafeSerializer, BadSignature
+from .images import validate_image, render_variants, output_format, ImageError
+from .status import get_session
+from .metrics import IMAGE_PROXY_FETCHES
+
+logger = logging.getLogger(__name__)
+
+# Local proxy for bookmarks whose image_url points at another host. The first view fetches the
+# image once, normalises it through the upload pipeline and keeps it in IMAGE_PROXY_CACHE_DIR;
+# later views are served from disk with long cache headers. Entries are revalidated with
+# ETag/Last-Modified after IMAGE_PROXY_TTL and the least recently used ones are evicted once
+# the cache grows past IMAGE_PROXY_MAX_BYTES.
+#
+# Proxy URLs carry the remote URL signed with the app secret, so only image URLs the app itself
+# rendered can be fetched. Hosts on private networks are not fetched server side; the browser is
+# redirected to them as before. Redirects are followed one hop at a time and every hop is checked,
+# and connections are refused if the socket ends up on a private address anyway (DNS rebinding).
+
+# path/mimetype/etag of a cached copy, or redirect=True to send the browser to the source
+CachedImage = namedtuple('CachedImage', ['path', 'mimetype', 'etag', 'redirect'])
+
+# Striped fetch locks: a fixed table, so memory does not grow with the number of images proxied
+_locks = [threading.Lock() for _ in range(64)]
+
+# Bytes this process believes the cache holds. Files are only walked when that crosses the budget,
+# or every EVICT_INTERVAL seconds to pick up what other workers wrote.
+EVICT_INTERVAL = 300
+_cache_bytes = None
+_walked_at = float('-inf')
+_size_lock = threading.Lock()
+
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='image-proxy')
+
+# Template filter: the URL the browser should load for a bookmark's image_url
+def image_src(image_url):
+    if image_url and image_url.startswith(('http://', 'https://')) and current_app.config['IMAGE_PROXY_ENABLED']:
+        return url_for('main.image_proxy', token=_serializer().dumps(image_url))
+    return image_url
+
+def load_token(token):
+    try:
+        return _serializer().loads(token)
+    except BadSignature:
+        return None
+
+class PrivateHostError(Exception):
+    pass
+
+def _is_private_ip(address):
+    ip = ipaddress.ip_address(address.split('%')[0])
+    return ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved or ip.is_multicast or ip.is_unspecified
+
+def is_private_host(url):
+    host = urlsplit(url).hostname
+    if not host:
+        return True
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except socket.gaierror:
+        return False  # Let the fetch fail normally
+    return any(_is_private_ip(address) for address in addresses)
+
+# Connections that check the address they actually connected to, whatever DNS said before
+class _PublicConnectionMixin:
+    def _new_conn(self):
+        sock = super()._new_conn()
+        address = sock.getpeername()[0]
+        if _is_private_ip(address):
+            sock.close()
+            raise NewConnectionError(self, f"Refusing to connect to {self.host} at private address {address}")
+        return sock
+
+class _PublicHTTPConnection(_PublicConnectionMixin, HTTPConnection):
+    pass
+
+class _PublicHTTPSConnection(_PublicConnectionMixin, HTTPSConnection):
+    pass
+
+class _PublicHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _PublicHTTPConnection
+
+class _PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _PublicHTTPSConnection
+
+class _PublicAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _PublicHTTPConnectionPool, 'https': _PublicHTTPSConnectionPool}
+
+_public_session = None
+_public_session_pid = None
+_public_session_lock = threading.Lock()
+
+def _get_public_session():
+    global _public_session, _public_session_pid
+    with _public_session_lock:
+        if _public_session is None or _public_session_pid != os.getpid():
+            session = requests.Session()
+            adapter = _PublicAdapter(pool_connections=20, pool_maxsize=2)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['User-Agent'] = 'Bookmarks-Fetch'
+            _public_session = session
+            _public_session_pid = os.getpid()
+        return _public_session
+
+# Streamed GET of a URL on behalf of users. Unless allow_private is set, every redirect hop must be
+# a public host and the connection must land on a public address; PrivateHostError otherwise.
+# The caller closes the response.
+def fetch_url(url, allow_private=False, headers=None, timeout=5, max_redirects=5):
+    session = get_session() if allow_private else _get_public_session()
+    for _ in range(max_redirects + 1):
+        if not allow_private and is_private_host(url):
+            raise PrivateHostError(url)
+        response = session.get(url, headers=headers, timeout=timeout, stream=True, allow_redirects=False)
+        if not response.is_redirect:
+            return response
+        url = urljoin(url, response.headers['Location'])
+        response.close()
+    raise requests.TooManyRedirects(f"More than {max_redirects} redirects", response=response)
+
+def _key_lock(key):
+    return _locks[int(key[:8], 16) % len(_locks)]
+
+def _paths(url):
+    key = hashlib.sha256(url.encode()).hexdigest()
+    folder = os.path.join(current_app.config['IMAGE_PROXY_CACHE_DIR'], key[:2])
+    _, ext = output_format()
+    return key, os.path.join(folder, f"{key}.{ext}"), os.path.join(folder, f"{key}.json")
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_meta(meta_path, meta):
+    tmp_path = f"{meta_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+def _result(meta, data_path):
+    if meta.get('passthrough'):
+        return CachedImage(None, None, None, True)
+    if not os.path.exists(data_path):
+        return None
+    # Mark as recently used for LRU eviction, at most once an hour per entry
+    if time.time() - os.path.getmtime(data_path) > 3600:
+        os.utime(data_path)
+    return CachedImage(data_path, meta['mimetype'], meta['digest'], False)
+
+# Response body, or None once it grows past limit
+def _download(response, limit):
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(64 * 1024):
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+# Count bytes written to the cache and evict when the budget may be exceeded
+def _cache_written(size, max_bytes):
+    global _cache_bytes
+    with _size_lock:
+        if _cache_bytes is not None:
+            _cache_bytes += size
+        due = _cache_bytes is None or _cache_bytes > max_bytes or time.monotonic() - _walked_at > EVICT_INTERVAL
+    if due:
+        evict(max_bytes)
+
+# Remove least recently used entries until the cache fits in its size budget, with a tenth of it
+# to spare so the next few fetches do not need another walk
+def evict(max_bytes):
+    global _cache_bytes, _walked_at
+    target = max_bytes * 0.9
+    root = current_app.config['IMAGE_PROXY_CACHE_DIR']
+    entries = []
+    total = 0
+    for folder, _, files in os.walk(root):
+        for name in files:
+            if name.endswith('.json') or '.tmp-' in name:
+                continue
+            path = os.path.join(folder, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue  # Evicted by another worker meanwhile
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    for _, size, path in sorted(entries):
+        if total <= target:
+            break
+        for remove in (path, path.rsplit('.', 1)[0] + '.json'):
+            try:
+                os.remove(remove)
+            except FileNotFoundError:
+                pass
+        total -= size
+    with _size_lock:
+        _cache_bytes = total
+        _walked_at = time.monotonic()
+
+# Cached copy of a remote image, fetching or revalidating it when needed. Returns None when
+# the image cannot be fetched and nothing is cached.
+def fetch_image(url):
+    config = current_app.config
+    if not config['IMAGE_PROXY_ALLOW_PRIVATE'] and is_private_host(url):
+        return CachedImage(None, None, None, True)
+    key, data_path, meta_path = _paths(url)
+    meta = _read_meta(meta_path)
+    if meta and time.time() - meta['fetched_at'] < config['IMAGE_PROXY_TTL']:
+        return _result(meta, data_path)
+
+    # One fetch per URL at a time; concurrent views of the same image wait for it
+    with _key_lock(key):
+        meta = _read_meta(meta_path)
+        if meta and time.time() - meta['fetched_at'] < config['IMAGE_PROXY_TTL']:
+            return _result(meta, data_path)
+        headers = {}
+        if meta and not meta.get('passthrough') and os.path.exists(data_path):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            with fetch_url(url, config['IMAGE_PROXY_ALLOW_PRIVATE'], headers=headers, timeout=config['IMAGE_PROXY_TIMEOUT']) as response:
+                if response.status_code == 304 and headers:
+                    IMAGE_PROXY_FETCHES.inc(result='not_modified')
+                    meta['fetched_at'] = time.time()
+                    _write_meta(meta_path, meta)
+                    return _result(meta, data_path)
+                if response.status_code != 200:
+                    IMAGE_PROXY_FETCHES.inc(result='error')
+                    logger.warning("Image proxy got %s for %s", response.status_code, url)
+                    return _result(meta, data_path) if meta else None
+                data = _download(response, config['MAX_IMAGE_UPLOAD_BYTES'])
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+        except PrivateHostError:
+            # Redirected into a private network: leave it to the browser
+            IMAGE_PROXY_FETCHES.inc(result='private')
+            return CachedImage(None, None, None, True)
+        except requests.RequestException as e:
+            IMAGE_PROXY_FETCHES.inc(result='error')
+            logger.warning("Image proxy failed to fetch %s: %s", url, e)
+            # Serve a stale copy rather than nothing
+            return _result(meta, data_path) if meta else None
+
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        try:
+            if data is None:
+                raise ImageError('Image is too large.')
+            validate_image(data)
+            render_variants(data, data_path.rsplit('.', 1)[0], config['IMAGE_TILE_SIZE'], scales=(('', 2),))
+        except (ImageError, OSError, ValueError, SyntaxError):
+            # Formats the pipeline cannot handle (SVG, oversized or truncated files) are loaded by the
+            # browser directly; the passthrough entry keeps the origin from being fetched on every view
+            IMAGE_PROXY_FETCHES.inc(result='passthrough')
+            meta = {'url': url, 'fetched_at': time.time(), 'passthrough': True}
+            _write_meta(meta_path, meta)
+            return _result(meta, data_path)
+        IMAGE_PROXY_FETCHES.inc(result='fetched')
+        with open(data_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        image_format, _ = output_format()
+        meta = {
+            'url': url,
+            'fetched_at': time.time(),
+            'etag': etag,
+            'last_modified': last_modified,
+            'mimetype': f"image/{'webp' if image_format == 'WEBP' else 'jpeg'}",
+            'digest': digest,
+        }
+        _write_meta(meta_path, meta)
+    _cache_written(os.path.getsize(data_path), config['IMAGE_PROXY_MAX_BYTES'])
+    return _result(meta, data_path)
@@ -0,0 +1,304 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from flask import current_app
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+from sqlalchemy import case, func
+from sqlalchemy.exc import IntegrityError
+from .models import db, Bookmark, ImageBlob
+from .database import bump_bookmarks_version
+
+logger = logging.getLogger(__name__)
+
+# Upload pipeline for bookmark images. The request only validates the upload and parks the raw
+# bytes in UPLOAD_FOLDER/incoming; a background thread then strips metadata and writes two
+# size-bounded variants (tile and 2x) that the templates serve through srcset.
+#
+# Processed images are content addressed: the SHA-256 of the upload names the files, sharded as
+# ab/cd/<digest>.tile.webp, so the same logo uploaded by many users is stored once. ImageBlob
+# counts the bookmarks using each image; files are only removed by collect_garbage().
+
+ALLOWED_FORMATS = {'PNG', 'JPEG', 'GIF', 'WEBP', 'BMP', 'ICO'}
+
+# Processed tiles are named <name>.tile.<ext> with a <name>.tile@2x.<ext> sibling
+_TILE_PATTERN = re.compile(r'^(?P<base>/static/images/.+\.tile)\.(?P<ext>webp|jpg)$')
+_SHARDED_PATTERN = re.compile(r'^(?P<digest>[0-9a-f]{64})\.tile(@2x)?\.(webp|jpg)$')
+# Flat files written by earlier versions: <hex>-<filename> uploads and <hex>.tile variants
+_LEGACY_PATTERN = re.compile(r'^[0-9a-f]{16}(-.+|\.tile(@2x)?\.(webp|jpg))$')
+
+class ImageError(ValueError):
+    pass
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='image-pipeline')
+            _executor_pid = os.getpid()
+        return _executor
+
+def output_format():
+    return ('WEBP', 'webp') if features.check('webp') else ('JPEG', 'jpg')
+
+# Check that the bytes are an image we accept and decode completely. verify() only checks the
+# structure, so the pixels are decoded as well: a truncated or corrupt file is rejected here
+# rather than failing later in the background pipeline.
+def validate_image(data):
+    if len(data) > current_app.config['MAX_IMAGE_UPLOAD_BYTES']:
+        raise ImageError('Image is too large.')
+    try:
+        with Image.open(BytesIO(data)) as image:
+            if image.format not in ALLOWED_FORMATS:
+                raise ImageError('Unsupported image format.')
+            width, height = image.size
+            if width * height > Image.MAX_IMAGE_PIXELS:
+                raise ImageError('Image dimensions are too large.')
+            image.verify()
+        with Image.open(BytesIO(data)) as image:
+            image.load()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError):
+        raise ImageError('Uploaded file is not a valid image.')
+
+def _save_atomic(image, path, image_format):
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    if image_format == 'WEBP':
+        image.save(tmp_path, 'WEBP', quality=80, method=4)
+    else:
+        image.save(tmp_path, 'JPEG', quality=85, optimize=True, progressive=True)
+    os.replace(tmp_path, path)
+
+# Decode, orient, strip metadata and write the tile and 2x variants next to each other.
+# scales lists (file suffix, multiple of tile_size) for each variant to write.
+def render_variants(data, dest_base, tile_size, scales=(('', 1), ('@2x', 2))):
+    image_format, ext = output_format()
+    with Image.open(BytesIO(data)) as image:
+        image.seek(0)  # First frame of animated images
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+        if image_format == 'WEBP' and has_alpha:
+            image = image.convert('RGBA')
+        elif has_alpha:
+            # JPEG has no alpha channel, flatten onto white
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image.convert('RGBA'), mask=image.convert('RGBA').getchannel('A'))
+            image = background
+        else:
+            image = image.convert('RGB')
+        # Re-encoding from fresh pixel data drops EXIF, GPS and ICC blobs
+        for suffix, scale in scales:
+            variant = image.copy()
+            variant.thumbnail((tile_size * scale, tile_size * scale), Image.LANCZOS)
+            _save_atomic(variant, f"{dest_base}{suffix}.{ext}", image_format)
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _shard_path(digest, ext, upload_folder):
+    return os.path.join(upload_folder, digest[:2], digest[2:4], f"{digest}.tile.{ext}")
+
+def _variant_paths(tile_path):
+    base, ext = tile_path.rsplit('.', 1)
+    return [tile_path, f"{base}@2x.{ext}"]
+
+def _process_upload(app, incoming_path, digest, tile_path, tile_size):
+    try:
+        with open(incoming_path, 'rb') as f:
+            data = f.read()
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        render_variants(data, tile_path.rsplit('.', 1)[0], tile_size)
+        size = sum(os.path.getsize(path) for path in _variant_paths(tile_path))
+        with app.app_context():
+            ImageBlob.query.filter_by(digest=digest).update({ImageBlob.size: size}, synchronize_session=False)
+            db.session.commit()
+    except Exception:
+        logger.exception("Image processing failed for %s", incoming_path)
+        with app.app_context():
+            _abandon_blob(digest, tile_path)
+    finally:
+        if os.path.exists(incoming_path):
+            os.remove(incoming_path)
+
+# Processing failed: bookmarks that took the image get none instead of a tile that will never
+# exist, and the blob is deleted so the next upload of the same bytes starts over. A tile left by
+# an earlier run keeps both.
+def _abandon_blob(digest, tile_path):
+    url = db.session.query(ImageBlob.url).filter_by(digest=digest).scalar()
+    if url is None or os.path.exists(tile_path):
+        return
+    users = [user_id for (user_id,) in db.session.query(Bookmark.user_id).filter(Bookmark.image_url == url).distinct()]
+    Bookmark.query.filter(Bookmark.image_url == url).update({Bookmark.image_url: None}, synchronize_session=False)
+    bump_bookmarks_version(*users)
+    ImageBlob.query.filter_by(digest=digest).delete(synchronize_session=False)
+    db.session.commit()
+    for path in _variant_paths(tile_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+def _tile_location(digest, upload_folder):
+    _, ext = output_format()
+    tile_path = _shard_path(digest, ext, upload_folder)
+    return tile_path, '/static/images/' + os.path.relpath(tile_path, upload_folder).replace(os.sep, '/')
+
+def _add_blob(digest, image_url):
+    try:
+        with db.session.begin_nested():
+            db.session.add(ImageBlob(digest=digest, url=image_url, refcount=0, size=0, updated_at=_utcnow()))
+    except IntegrityError:
+        pass  # Someone else stored the same image at the same moment
+
+# Url of the stored blob for digest, or None. Its garbage collection grace period starts over,
+# since the caller is about to reference it; a blob collect_garbage() deleted meanwhile is None.
+def _reuse_blob(digest):
+    touched = ImageBlob.query.filter_by(digest=digest).update({ImageBlob.updated_at: _utcnow()}, synchronize_session=False)
+    return db.session.query(ImageBlob.url).filter_by(digest=digest).scalar() if touched else None
+
+# Validate an uploaded FileStorage and store it under its content hash. Returns the image_url of
+# the tile variant; identical uploads share one stored copy. New content is processed in the
+# background and appears once the variants are written. The caller takes a reference with
+# acquire_image() when it assigns the url to a bookmark.
+def save_upload(file):
+    config = current_app.config
+    data = file.read(config['MAX_IMAGE_UPLOAD_BYTES'] + 1)
+    validate_image(data)
+    digest = hashlib.sha256(data).hexdigest()
+    upload_folder = config['UPLOAD_FOLDER']
+    tile_path, image_url = _tile_location(digest, upload_folder)
+
+    url = _reuse_blob(digest)
+    if url is None:
+        _add_blob(digest, image_url)
+    elif os.path.exists(tile_path):
+        return url
+
+    incoming_path = os.path.join(upload_folder, 'incoming', f"{digest}-{os.urandom(4).hex()}")
+    with open(incoming_path, 'wb') as f:
+        f.write(data)
+    app = current_app._get_current_object()
+    _get_executor().submit(_process_upload, app, incoming_path, digest, tile_path, config['IMAGE_TILE_SIZE'])
+    return image_url
+
+# Same as save_upload() for image bytes the server fetched itself (site favicons), processed right
+# away since the callers already run in the background. Raises ImageError for anything the
+# pipeline cannot decode.
+def store_image(data):
+    validate_image(data)
+    digest = hashlib.sha256(data).hexdigest()
+    tile_path, image_url = _tile_location(digest, current_app.config['UPLOAD_FOLDER'])
+    url = _reuse_blob(digest)
+    if url is not None and os.path.exists(tile_path):
+        return url
+    if url is None:
+        _add_blob(digest, image_url)
+    os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+    try:
+        render_variants(data, tile_path.rsplit('.', 1)[0], current_app.config['IMAGE_TILE_SIZE'])
+    except (OSError, ValueError, SyntaxError) as e:
+        raise ImageError(f'Image could not be processed: {e}')
+    size = sum(os.path.getsize(path) for path in _variant_paths(tile_path))
+    ImageBlob.query.filter_by(digest=digest).update({ImageBlob.size: size}, synchronize_session=False)
+    return image_url
+
+# Reference counting. Both run inside the caller's transaction; urls that are not stored
+# images (remote links, legacy uploads) are ignored. count takes several references at once.
+def acquire_image(image_url, count=1):
+    if image_url and image_url.startswith('/static/images/'):
+        ImageBlob.query.filter_by(url=image_url).update(
+            {ImageBlob.refcount: ImageBlob.refcount + count, ImageBlob.updated_at: _utcnow()},
+            synchronize_session=False,
+        )
+
+def release_image(image_url, count=1):
+    if image_url and image_url.startswith('/static/images/'):
+        ImageBlob.query.filter(ImageBlob.url == image_url, ImageBlob.refcount > 0).update(
+            {ImageBlob.refcount: case((ImageBlob.refcount > count, ImageBlob.refcount - count), else_=0),
+             ImageBlob.updated_at: _utcnow()},
+            synchronize_session=False,
+        )
+
+# Rebuild every refcount from Bookmark.image_url and icon_url, e.g. after a crash or manual database edits
+def recount_references():
+    counts = {}
+    for column in (Bookmark.image_url, Bookmark.icon_url):
+        for url, count in (db.session.query(column, func.count(Bookmark.id))
+                           .filter(column.like('/static/images/%'))
+                           .group_by(column)):
+            counts[url] = counts.get(url, 0) + count
+    changed = 0
+    for blob in ImageBlob.query:
+        refcount = counts.get(blob.url, 0)
+        if blob.refcount != refcount:
+            blob.refcount = refcount
+            blob.updated_at = _utcnow()
+            changed += 1
+    db.session.commit()
+    return changed
+
+# Delete unreferenced images. Blobs only become eligible grace_seconds after their last reference
+# went away or an upload last reused them. Each is deleted with the same conditions re-checked in
+# the DELETE, so one an upload reuses while the collector runs keeps its row and files: the
+# upload's touch either lands first and the DELETE skips the row, or lands after and finds no row
+# and stores the image again. Blobs still without files after the grace period were never
+# processed (the worker died mid-way) and are abandoned as if processing had failed. Also removes
+# stray shard files, abandoned incoming uploads and legacy flat uploads no bookmark points at.
+def collect_garbage(grace_seconds=3600, dry_run=False):
+    upload_folder = os.path.abspath(current_app.config['UPLOAD_FOLDER'])
+    cutoff = _utcnow() - timedelta(seconds=grace_seconds)
+    removed = []
+
+    def remove(path):
+        removed.append(path)
+        if not dry_run and os.path.isfile(path):
+            os.remove(path)
+
+    if not dry_run:
+        unprocessed = db.session.query(ImageBlob.digest, ImageBlob.url).filter(ImageBlob.size == 0, ImageBlob.updated_at < cutoff).all()
+        for digest, url in unprocessed:
+            _abandon_blob(digest, os.path.join(upload_folder, url[len('/static/images/'):]))
+
+    unreferenced = (ImageBlob.refcount == 0, ImageBlob.updated_at < cutoff)
+    orphans = db.session.query(ImageBlob.digest, ImageBlob.url).filter(*unreferenced).all()
+    if not dry_run:
+        orphans = [(digest, url) for digest, url in orphans
+                   if ImageBlob.query.filter(ImageBlob.digest == digest, *unreferenced).delete(synchronize_session=False)]
+        db.session.commit()
+    for _, url in orphans:
+        for path in _variant_paths(os.path.join(upload_folder, url[len('/static/images/'):])):
+            remove(path)
+
+    known = {digest for (digest,) in db.session.query(ImageBlob.digest)}
+    legacy_in_use = set()
+    for (url,) in db.session.query(Bookmark.image_url).filter(Bookmark.image_url.like('/static/images/%')):
+        legacy_in_use.update(os.path.basename(path) for path in _variant_paths(url))
+    old_enough = time.time() - grace_seconds
+    for root, dirs, files in os.walk(upload_folder):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.getmtime(path) > old_enough:
+                continue
+            if root == os.path.join(upload_folder, 'incoming'):
+                remove(path)
+            elif root == upload_folder:
+                if _LEGACY_PATTERN.match(name) and name not in legacy_in_use:
+                    remove(path)
+            else:
+                match = _SHARDED_PATTERN.match(name)
+                if (match and match.group('digest') not in known) or '.tmp-' in name:
+                    remove(path)
+    return removed
+
+# srcset value for processed tiles, empty for anything else
+def image_srcset(image_url):
+    match = _TILE_PATTERN.match(image_url or '')
+    if not match:
+        return ''
+    return f"{image_url} 1x, {match.group('base')}@2x.{match.group('ext')} 2x"
@@ -0,0 +1,102 @@
+from flask import current_app
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import Integer, and_, case, false, func, or_, text
+from sqlalchemy.orm import aliased
+from .models import db, Bookmark, UrlStatus
+
+# Paginated bookmark listing for the home page and the JSON API. Pages are fetched with keyset
+# pagination: the cursor carries the sort key of the last bookmark shown, so every page is an
+# index range scan from that point instead of an OFFSET that re-reads all earlier rows.
+#
+# Search matches substrings of the name and URLs. On SQLite it goes through the bookmark_fts
+# trigram index (see migrations.py); queries shorter than a trigram, and other databases, fall
+# back to a case-insensitive LIKE over the user's bookmarks.
+
+SORTS = ('name', 'recent', 'status')
+
+class CursorError(ValueError):
+    pass
+
+def _serializer():
+    return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='bookmark-cursor')
+
+# Worst status of a bookmark's links: 0 down, 1 not checked yet, 2 up, 3 no links
+def _status_rank():
+    server = aliased(UrlStatus)
+    domain = aliased(UrlStatus)
+    rank = case(
+        (or_(server.is_up == false(), domain.is_up == false()), 0),
+        (or_(and_(Bookmark.server_url.isnot(None), server.id.is_(None)),
+             and_(Bookmark.domain_url.isnot(None), domain.id.is_(None))), 1),
+        (or_(Bookmark.server_url.isnot(None), Bookmark.domain_url.isnot(None)), 2),
+        else_=3,
+    )
+    joins = [(server, server.url == Bookmark.server_url), (domain, domain.url == Bookmark.domain_url)]
+    return rank, joins
+
+# (expression, descending) pairs the listing is ordered by, always ending with the id
+def _sort_keys(sort):
+    if sort == 'recent':
+        return [(Bookmark.id, True)], []
+    name_key = (func.lower(Bookmark.name), False)
+    if sort == 'status':
+        rank, joins = _status_rank()
+        return [(rank, False), name_key, (Bookmark.id, False)], joins
+    return [name_key, (Bookmark.id, False)], []
+
+# Rows strictly after values in the (possibly mixed direction) order of keys
+def _after(keys, values):
+    clauses = []
+    for i, (expression, descending) in enumerate(keys):
+        equal = [key == value for (key, _), value in zip(keys[:i], values[:i])]
+        beyond = expression < values[i] if descending else expression > values[i]
+        clauses.append(and_(*equal, beyond))
+    return or_(*clauses)
+
+_fts_tables = {}
+
+def _has_fts():
+    engine = db.engine
+    if engine not in _fts_tables:
+        _fts_tables[engine] = engine.dialect.name == 'sqlite' and db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bookmark_fts'")
+        ).first() is not None
+    return _fts_tables[engine]
+
+def _search(query):
+    if len(query) >= 3 and _has_fts():
+        # A quoted phrase: with the trigram tokenizer this matches the text anywhere in a column
+        phrase = '"' + query.replace('"', '""') + '"'
+        matches = text('SELECT rowid FROM bookmark_fts WHERE bookmark_fts MATCH :phrase').bindparams(phrase=phrase)
+        return Bookmark.id.in_(matches.columns(rowid=Integer))
+    pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    return or_(*[column.ilike(pattern, escape='\\') for column in (Bookmark.name, Bookmark.server_url, Bookmark.domain_url)])
+
+# One page of a user's bookmarks and the cursor for the next page (None on the last page).
+# Raises CursorError for a cursor that was not issued for this sort.
+def list_bookmarks(user_id, sort='name', query='', cursor=None, limit=50):
+    if sort not in SORTS:
+        sort = 'name'
+    keys, joins = _sort_keys(sort)
+    expressions = [expression for expression, _ in keys]
+    q = db.session.query(Bookmark, *expressions).filter(Bookmark.user_id == user_id)
+    for target, on in joins:
+        q = q.outerjoin(target, on)
+    if query:
+        q = q.filter(_search(query))
+    if cursor:
+        try:
+            state = _serializer().loads(cursor)
+        except BadSignature:
+            raise CursorError('Invalid cursor.')
+        if state.get('sort') != sort or len(state.get('after', [])) != len(keys):
+            raise CursorError('Cursor does not match this listing.')
+        q = q.filter(_after(keys, state['after']))
+    q = q.order_by(*[expression.desc() if descending else expression for expression, descending in keys])
+
+    rows = q.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _serializer().dumps({'sort': sort, 'after': list(rows[-1][1:])})
+    return [row[0] for row in rows], next_cursor
@@ -0,0 +1,65 @@
+import atexit
+from datetime import datetime, timezone
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+# Logging for the app's own loggers (app.*). Records are put on a queue and written to stderr by
+# a listener thread, so logging from a request or a probe never waits on a slow stdout pipe.
+# LOG_LEVEL sets the level, LOG_FORMAT=json emits one JSON object per line for log shippers.
+
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        # Anything passed with extra={...}
+        entry.update({key: value for key, value in vars(record).items() if key not in _STANDARD_ATTRIBUTES})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # Starts the writer thread in whichever process emits first; threads do not survive a fork,
+    # so a gunicorn worker forked from a preloaded master starts its own
+
+    def __init__(self, target):
+        super().__init__(queue.SimpleQueue())
+        self.target = target
+        self._listener_pid = None
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        if self._listener_pid != os.getpid():
+            with self._lock:
+                if self._listener_pid != os.getpid():
+                    self.queue = queue.SimpleQueue()
+                    listener = logging.handlers.QueueListener(self.queue, self.target)
+                    listener.start()
+                    atexit.register(listener.stop)  # Drain what is left on shutdown
+                    self._listener_pid = os.getpid()
+        super().emit(record)
+
+def configure_logging(app):
+    if isinstance(app.config['LOG_FORMAT'], str) and app.config['LOG_FORMAT'].lower() == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s')
+    target = logging.StreamHandler(sys.stderr)
+    target.setFormatter(formatter)
+
+    logger = logging.getLogger('app')
+    logger.handlers = [_QueueHandler(target)]
+    logger.setLevel(app.config['LOG_LEVEL'].upper())
+    logger.propagate = False
+    # Flask's app.logger is named after the package, so this also covers current_app.logger
+    return logger
@@ -0,0 +1,203 @@
+from datetime import datetime, timedelta, timezone
+from smtplib import SMTP, SMTP_SSL, SMTPAuthenticationError, SMTPServerDisconnected
+import logging
+import threading
+from flask import current_app
+from flask_mail import Mail, Message, Connection
+from .models import db, MailMessage
+from .database import signal_wake
+from .metrics import MAIL_DELIVERIES
+
+logger = logging.getLogger(__name__)
+
+# Initialize extensions
+mail = Mail()
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+# Queue an email for the background sender. Routes call this instead of mail.send() so a slow
+# or unreachable SMTP server never blocks the request.
+def queue_email(subject, recipients, html, commit=True):
+    message = MailMessage(
+        subject=subject,
+        recipients=','.join(recipients),
+        html=html,
+        status='queued',
+        attempts=0,
+        created_at=_utcnow(),
+        next_attempt_at=_utcnow(),
+    )
+    db.session.add(message)
+    if commit:
+        db.session.commit()
+        mail_queue.wake()
+    return message
+
+# Take queued messages for delivery by the caller (e.g. a request sending them right away), in the
+# caller's transaction. The background queue skips them until the claim lapses after
+# MAIL_CLAIM_TIMEOUT seconds, so a request that dies mid-send still has its mail retried.
+def claim_messages(messages):
+    until = _utcnow() + timedelta(seconds=current_app.config['MAIL_CLAIM_TIMEOUT'])
+    for message in messages:
+        message.status = 'sending'
+        message.next_attempt_at = until
+
+def describe_mail_error(error):
+    if isinstance(error, SMTPAuthenticationError):
+        return "SMTP authentication failed. Check MAIL_USERNAME and MAIL_PASSWORD."
+    if isinstance(error, SMTPServerDisconnected):
+        return "SMTP server disconnected. Check network or MAIL_SERVER settings."
+    return str(error) or type(error).__name__
+
+# Flask-Mail's connection has no timeout, which would let a hung SMTP server stall the sender
+class _Connection(Connection):
+    def configure_host(self):
+        timeout = current_app.config['MAIL_TIMEOUT']
+        if self.mail.use_ssl:
+            host = SMTP_SSL(self.mail.server, self.mail.port, timeout=timeout)
+        else:
+            host = SMTP(self.mail.server, self.mail.port, timeout=timeout)
+        host.set_debuglevel(int(self.mail.debug))
+        if self.mail.use_tls:
+            host.starttls()
+        if self.mail.username and self.mail.password:
+            host.login(self.mail.username, self.mail.password)
+        return host
+
+# Errors that mean the SMTP session itself is gone, so the rest of the batch cannot go out on it
+_CONNECTION_ERRORS = (SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+def _record_failure(message, error):
+    config = current_app.config
+    message.attempts += 1
+    message.last_error = describe_mail_error(error)[:200]
+    if message.attempts >= config['MAIL_MAX_ATTEMPTS']:
+        message.status = 'failed'
+    else:
+        message.status = 'queued'  # Claimed messages go back to the background queue
+        delay = config['MAIL_RETRY_DELAY'] * 2 ** (message.attempts - 1)
+        message.next_attempt_at = _utcnow() + timedelta(seconds=delay)
+    MAIL_DELIVERIES.inc(status='failed' if message.status == 'failed' else 'retry')
+    logger.warning("Email sending error (message %s, attempt %s): %s", message.id, message.attempts, message.last_error)
+
+# Send queued messages over a single SMTP connection and return a per-message delivery report.
+# The caller commits the session.
+def deliver(messages):
+    pending = list(messages)
+    report = []
+
+    def add_report(message, error=None):
+        report.append({
+            'id': message.id,
+            'recipients': message.recipients.split(','),
+            'status': message.status,
+            'error': message.last_error if error else None,
+        })
+
+    connection = _Connection(current_app.extensions['mail'])
+    try:
+        connection.__enter__()
+        while pending:
+            message = pending[0]
+            try:
+                connection.send(Message(message.subject, recipients=message.recipients.split(','), html=message.html))
+            except _CONNECTION_ERRORS:
+                raise
+            except Exception as e:
+                # Rejected recipient or bad message; the connection is still usable
+                _record_failure(message, e)
+                add_report(message, e)
+            else:
+                message.status = 'sent'
+                MAIL_DELIVERIES.inc(status='sent')
+                message.attempts += 1
+                message.sent_at = _utcnow()
+                message.last_error = None
+                add_report(message)
+            pending.pop(0)
+    except Exception as e:
+        # Could not connect, or lost the connection: every unsent message is retried later
+        for message in pending:
+            _record_failure(message, e)
+            add_report(message, e)
+    finally:
+        try:
+            connection.__exit__(None, None, None)
+        except Exception:
+            pass
+    return report
+
+class MailQueue:
+    # Background sender for the mail queue, retrying failed messages with exponential backoff
+
+    def __init__(self, app=None):
+        self.app = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('MAIL_QUEUE_ENABLED', True)
+        app.config.setdefault('MAIL_QUEUE_INTERVAL', 30)
+        app.config.setdefault('MAIL_QUEUE_BATCH_SIZE', 50)
+        app.config.setdefault('MAIL_MAX_ATTEMPTS', 5)
+        app.config.setdefault('MAIL_RETRY_DELAY', 60)
+        app.config.setdefault('MAIL_RETENTION_DAYS', 7)
+        app.config.setdefault('MAIL_TIMEOUT', 10)
+        app.config.setdefault('MAIL_CLAIM_TIMEOUT', 300)
+        app.config.setdefault('MAIL_INLINE_BATCH', 20)
+        app.extensions['mail_queue'] = self
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='mail-queue', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def wake(self):
+        if self._thread is not None:
+            self._wake.set()
+        elif self.app.config['MAIL_QUEUE_ENABLED']:
+            signal_wake('wake_mail_queue')
+
+    def depth(self):
+        return MailMessage.query.filter(MailMessage.status.in_(('queued', 'sending'))).count()
+
+    # Send one batch of due messages; returns the delivery report
+    def process_once(self):
+        with self.app.app_context():
+            config = self.app.config
+            due = (MailMessage.query
+                   .filter(MailMessage.status.in_(('queued', 'sending')), MailMessage.next_attempt_at <= _utcnow())
+                   .order_by(MailMessage.id)
+                   .limit(config['MAIL_QUEUE_BATCH_SIZE'])
+                   .all())
+            report = deliver(due) if due else []
+            # Sent messages are only kept for a while
+            cutoff = _utcnow() - timedelta(days=config['MAIL_RETENTION_DAYS'])
+            MailMessage.query.filter(MailMessage.status == 'sent', MailMessage.sent_at < cutoff).delete(synchronize_session=False)
+            db.session.commit()
+            return report
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                report = self.process_once()
+                # A full batch may mean more is waiting, so go again right away
+                if len(report) >= self.app.config['MAIL_QUEUE_BATCH_SIZE']:
+                    continue
+            except Exception:
+                logger.exception("Mail queue cycle failed")
+            self._wake.wait(self.app.config['MAIL_QUEUE_INTERVAL'])
+
+mail_queue = MailQueue()
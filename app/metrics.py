@@ -0,0 +1,287 @@
+from bisect import bisect_left
+import glob
+import hmac
+import ipaddress
+import json
+import os
+import threading
+import time
+from flask import Response, abort, current_app, g, request
+from sqlalchemy import event
+
+# Prometheus-style metrics without a client library. Metrics live in memory per process; every
+# few seconds (and on each scrape) a process writes a snapshot to METRICS_DIR, and /metrics
+# merges the snapshots of all live gunicorn workers, so a scrape sees the whole server whichever
+# worker answers it. Counters and histograms are summed across workers; gauges computed at scrape
+# time (e.g. the mail queue depth) come from the database and are reported once.
+#
+# /metrics answers loopback clients only, unless METRICS_TOKEN is set; then any client sending the
+# token as a bearer token.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class _Metric:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), [list(counts), total, count]] for key, (counts, total, count) in self._values.items()]
+
+# Counter whose per-process total is read from elsewhere (e.g. a cache's hit count) at snapshot time
+class CounterFunc(_Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, fn):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def snapshot(self):
+        return [[[], self.fn()]]
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Time to produce a response, by route.', ['method', 'endpoint', 'status'])
+REQUEST_DB_QUERIES = Histogram('http_request_db_queries', 'Database queries per request.', ['endpoint'], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+REQUEST_DB_TIME = Histogram('http_request_db_seconds', 'Time spent in database queries per request.', ['endpoint'])
+PROBE_LATENCY = Histogram('status_probe_duration_seconds', 'Outbound URL probe latency.', ['outcome'])
+PROBE_ERRORS = Counter('status_probe_errors_total', 'Failed URL probes by error class.', ['error'])
+MAIL_DELIVERIES = Counter('mail_deliveries_total', 'Delivery attempts of queued emails by result.', ['status'])
+LOGIN_ATTEMPTS = Counter('login_attempts_total', 'Login attempts by result.', ['result'])
+IMAGE_PROXY_FETCHES = Counter('image_proxy_fetches_total', 'Remote image fetches by the image proxy, by result.', ['result'])
+SITE_META_FETCHES = Counter('site_meta_fetches_total', 'Title and favicon fetches by the enrichment job, by result.', ['result'])
+
+class Metrics:
+    def __init__(self, app=None):
+        self.app = None
+        self.metrics = [REQUEST_LATENCY, REQUEST_DB_QUERIES, REQUEST_DB_TIME, PROBE_LATENCY, PROBE_ERRORS,
+                        MAIL_DELIVERIES, IMAGE_PROXY_FETCHES, LOGIN_ATTEMPTS, SITE_META_FETCHES]
+        self.gauges = []  # (name, help, fn) evaluated when scraped
+        self._flushed_at = 0.0
+        self._flush_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_TOKEN', None)
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', 5)
+        app.extensions['metrics'] = self
+        if not app.config['METRICS_ENABLED']:
+            return
+        if app.config['METRICS_DIR']:
+            os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        app.add_url_rule('/metrics', 'metrics', self._serve)
+
+    def counter_func(self, name, help, fn):
+        self.metrics.append(CounterFunc(name, help, fn))
+
+    def gauge(self, name, help, fn):
+        self.gauges.append((name, help, fn))
+
+    # Count queries and their time for the request being served, if any. Called once the
+    # engine exists (inside an app context). Start times are kept per cursor and dropped when a
+    # statement fails, so pooled connections do not accumulate them.
+    def instrument_engine(self, engine):
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('query_started', {})[id(cursor)] = time.perf_counter()
+
+        @event.listens_for(engine, 'handle_error')
+        def handle_error(context):
+            if context.connection is not None and context.execution_context is not None:
+                context.connection.info.get('query_started', {}).pop(id(context.execution_context.cursor), None)
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            started = conn.info['query_started'].pop(id(cursor))
+            stats = g.get('db_stats') if g else None
+            if stats is not None:
+                stats[0] += 1
+                stats[1] += time.perf_counter() - started
+
+    def _start_request(self):
+        g.request_started = time.perf_counter()
+        g.db_stats = [0, 0.0]
+
+    def _end_request(self, response):
+        started = g.pop('request_started', None)
+        if started is None:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        REQUEST_LATENCY.observe(time.perf_counter() - started, method=request.method, endpoint=endpoint, status=response.status_code)
+        queries, seconds = g.pop('db_stats')
+        REQUEST_DB_QUERIES.observe(queries, endpoint=endpoint)
+        REQUEST_DB_TIME.observe(seconds, endpoint=endpoint)
+        if time.monotonic() - self._flushed_at > self.app.config['METRICS_FLUSH_INTERVAL']:
+            self.flush()
+        return response
+
+    def snapshot(self):
+        return {metric.name: {
+            'type': metric.type,
+            'help': metric.help,
+            'labels': list(metric.labels),
+            'buckets': list(getattr(metric, 'buckets', ())),
+            'values': metric.snapshot(),
+        } for metric in self.metrics}
+
+    # Write this process's snapshot for the other workers' scrapes
+    def flush(self):
+        directory = self.app.config['METRICS_DIR']
+        if not directory or not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            self._flushed_at = time.monotonic()
+            path = os.path.join(directory, f"{os.getpid()}.json")
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        finally:
+            self._flush_lock.release()
+
+    def _snapshots(self):
+        directory = self.app.config['METRICS_DIR']
+        if not directory:
+            return [self.snapshot()]
+        self.flush()
+        snapshots = []
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            pid = int(os.path.basename(path).split('.')[0])
+            if pid != os.getpid() and not _alive(pid):
+                # Worker exited; its counts are gone, as after any process restart
+                _remove(path)
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self):
+        merged = {}
+        for snapshot in self._snapshots():
+            for name, metric in snapshot.items():
+                target = merged.setdefault(name, dict(metric, values={}))
+                for key, value in metric['values']:
+                    key = tuple(key)
+                    if metric['type'] == 'histogram':
+                        current = target['values'].get(key)
+                        if current is None:
+                            target['values'][key] = value
+                        else:
+                            current[0] = [a + b for a, b in zip(current[0], value[0])]
+                            current[1] += value[1]
+                            current[2] += value[2]
+                    else:
+                        target['values'][key] = target['values'].get(key, 0) + value
+
+        lines = []
+        for name, metric in sorted(merged.items()):
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for key, value in sorted(metric['values'].items()):
+                labels = dict(zip(metric['labels'], key))
+                if metric['type'] == 'histogram':
+                    counts, total, count = value
+                    cumulative = 0
+                    for bound, bucket_count in zip(list(metric['buckets']) + ['+Inf'], counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{_labels(dict(labels, le=_number(bound)))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_number(total)}")
+                    lines.append(f"{name}_count{_labels(labels)} {count}")
+                else:
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        for name, help, fn in self.gauges:
+            try:
+                value = fn()
+            except Exception:
+                current_app.logger.exception("Metrics gauge %s failed", name)
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_number(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def _serve(self):
+        token = self.app.config['METRICS_TOKEN']
+        if token:
+            if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {token}".encode()):
+                abort(401)
+        elif not _is_loopback(request.remote_addr):
+            abort(403)
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+def _is_loopback(address):
+    try:
+        return ipaddress.ip_address(address or '').is_loopback
+    except ValueError:
+        return False
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+metrics = Metrics()
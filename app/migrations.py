@@ -0,0 +1,239 @@
+from datetime import datetime, timezone
+from sqlalchemy import (
+    MetaData, Table, Column, Integer, SmallInteger, String, Text, Boolean, Float, DateTime, ForeignKey, Index,
+    inspect, text,
+)
+from sqlalchemy.exc import OperationalError
+from .models import db
+
+# Versioned schema migrations, replacing db.create_all() at startup. Each migration runs once,
+# in order, inside its own transaction, and is recorded in the schema_migrations table.
+#
+# Tables are created from the frozen definitions below, as they were when their migration was
+# written, never from the current models: a fresh database goes through every migration in turn
+# and ends up on the same schema as an old one that is upgraded. Migrations stay idempotent
+# (CREATE ... IF NOT EXISTS, check before adding a column) because databases created by
+# create_all() before versioning existed start at version 0 with the baseline tables in place.
+# Changing a model means adding a migration, not editing these definitions.
+
+_schema = MetaData()
+
+# Version 1: the tables create_all() made before migrations existed
+Table(
+    'user', _schema,
+    Column('id', Integer, primary_key=True),
+    Column('username', String(80), unique=True, nullable=False),
+    Column('password', String(120), nullable=False),
+    Column('real_name', String(120)),
+    Column('email', String(120), unique=True),
+    Column('role', String(20), index=True),
+    Column('status', String(20), index=True),
+    Column('theme', String(50)),
+)
+Table(
+    'bookmark', _schema,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('user.id'), nullable=False, index=True),
+    Column('name', String(120), nullable=False),
+    Column('server_url', String(200)),
+    Column('domain_url', String(200)),
+    Column('image_url', String(200)),
+)
+Table(
+    'url_status', _schema,
+    Column('id', Integer, primary_key=True),
+    Column('url', String(200), unique=True, nullable=False),
+    Column('is_up', Boolean, nullable=False),
+    Column('status_code', Integer),
+    Column('latency_ms', Float),
+    Column('error', String(200)),
+    Column('checked_at', DateTime),
+)
+Table(
+    'mail_message', _schema,
+    Column('id', Integer, primary_key=True),
+    Column('subject', String(200), nullable=False),
+    Column('recipients', String(500), nullable=False),
+    Column('html', Text, nullable=False),
+    Column('status', String(20), nullable=False, index=True),
+    Column('attempts', Integer, nullable=False),
+    Column('next_attempt_at', DateTime),
+    Column('last_error', String(200)),
+    Column('created_at', DateTime),
+    Column('sent_at', DateTime),
+)
+Table(
+    'image_blob', _schema,
+    Column('digest', String(64), primary_key=True),
+    Column('url', String(200), unique=True, nullable=False),
+    Column('refcount', Integer, nullable=False),
+    Column('size', Integer, nullable=False),
+    Column('updated_at', DateTime),
+)
+BASELINE_TABLES = ['user', 'bookmark', 'url_status', 'mail_message', 'image_blob']
+
+# Version 4
+Table(
+    'counter', _schema,
+    Column('name', String(50), primary_key=True),
+    Column('value', Integer, nullable=False),
+)
+
+# Version 5
+Table(
+    'probe_sample', _schema,
+    Column('id', Integer, primary_key=True),
+    Column('url_id', Integer, nullable=False),
+    Column('checked_at', DateTime, nullable=False, index=True),
+    Column('is_up', Boolean, nullable=False),
+    Column('status_code', SmallInteger),
+    Column('latency_ms', Float),
+    Column('error', String(40)),
+    Index('ix_probe_sample_url_checked', 'url_id', 'checked_at'),
+)
+Table(
+    'status_rollup', _schema,
+    Column('url_id', Integer, primary_key=True),
+    Column('resolution', Integer, primary_key=True),
+    Column('bucket_start', DateTime, primary_key=True),
+    Column('samples', Integer, nullable=False),
+    Column('up', Integer, nullable=False),
+    Column('latency_count', Integer, nullable=False),
+    Column('latency_sum', Float, nullable=False),
+    Column('latency_max', Float),
+    Index('ix_status_rollup_expiry', 'resolution', 'bucket_start'),
+)
+
+# Version 9
+Table(
+    'site_meta', _schema,
+    Column('origin', String(200), primary_key=True),
+    Column('title', String(200)),
+    Column('icon_url', String(200)),
+    Column('error', String(40)),
+    Column('fetched_at', DateTime, nullable=False),
+)
+
+def _create_tables(connection, *names):
+    _schema.create_all(bind=connection, tables=[_schema.tables[name] for name in names], checkfirst=True)
+
+def _baseline_tables(connection):
+    _create_tables(connection, *BASELINE_TABLES)
+
+def _create_index(connection, name, table, column):
+    connection.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON "{table}" ({column})'))
+
+def _index_hot_columns(connection):
+    _create_index(connection, 'ix_bookmark_user_id', 'bookmark', 'user_id')
+    _create_index(connection, 'ix_user_status', 'user', 'status')
+    _create_index(connection, 'ix_user_role', 'user', 'role')
+
+# Name-ordered listing index, plus an FTS5 trigram index over the bookmark name and URLs for
+# substring search on SQLite, kept in sync with the bookmark table by triggers
+def _bookmark_search_index(connection):
+    _create_index(connection, 'ix_bookmark_user_name', 'bookmark', 'user_id, lower(name), id')
+    if connection.dialect.name != 'sqlite':
+        return
+    try:
+        connection.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS bookmark_fts USING fts5("
+            "name, server_url, domain_url, content='bookmark', content_rowid='id', tokenize='trigram')"
+        ))
+    except OperationalError:
+        return  # SQLite built without FTS5 or older than 3.34; search falls back to LIKE
+    columns = 'name, server_url, domain_url'
+    new_row = "VALUES (new.id, new.name, new.server_url, new.domain_url)"
+    old_row = "VALUES ('delete', old.id, old.name, old.server_url, old.domain_url)"
+    connection.execute(text(
+        f"CREATE TRIGGER IF NOT EXISTS bookmark_fts_insert AFTER INSERT ON bookmark BEGIN "
+        f"INSERT INTO bookmark_fts (rowid, {columns}) {new_row}; END"
+    ))
+    connection.execute(text(
+        f"CREATE TRIGGER IF NOT EXISTS bookmark_fts_delete AFTER DELETE ON bookmark BEGIN "
+        f"INSERT INTO bookmark_fts (bookmark_fts, rowid, {columns}) {old_row}; END"
+    ))
+    connection.execute(text(
+        f"CREATE TRIGGER IF NOT EXISTS bookmark_fts_update AFTER UPDATE ON bookmark BEGIN "
+        f"INSERT INTO bookmark_fts (bookmark_fts, rowid, {columns}) {old_row}; "
+        f"INSERT INTO bookmark_fts (rowid, {columns}) {new_row}; END"
+    ))
+    connection.execute(text("INSERT INTO bookmark_fts (bookmark_fts) VALUES ('rebuild')"))
+
+# Change versions for stored status results, so status streams can ask for what changed since
+# the version a page was rendered with
+def _status_versions(connection):
+    _create_tables(connection, 'counter')
+    add_column(connection, 'url_status', 'version', 'INTEGER NOT NULL DEFAULT 0')
+    _create_index(connection, 'ix_url_status_version', 'url_status', 'version')
+
+# Every probe result, and per-bucket rollups of them
+def _status_history(connection):
+    _create_tables(connection, 'probe_sample', 'status_rollup')
+
+# Admin panel listing: users of a status in username order
+def _user_listing_index(connection):
+    _create_index(connection, 'ix_user_status_username', 'user', 'status, username')
+
+def add_column(connection, table, column, ddl):
+    if column not in {c['name'] for c in inspect(connection).get_columns(table)}:
+        connection.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}'))
+
+def _bookmarks_version(connection):
+    add_column(connection, 'user', 'bookmarks_version', 'INTEGER NOT NULL DEFAULT 0')
+
+# Room for scrypt hashes; SQLite does not enforce VARCHAR lengths
+def _widen_password(connection):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('ALTER TABLE "user" ALTER COLUMN password TYPE VARCHAR(255)'))
+
+# Site titles and favicons: the per-origin cache table and the bookmark columns they are copied to
+def _site_meta(connection):
+    _create_tables(connection, 'site_meta')
+    add_column(connection, 'bookmark', 'title', 'VARCHAR(200)')
+    add_column(connection, 'bookmark', 'icon_url', 'VARCHAR(200)')
+    add_column(connection, 'bookmark', 'meta_origin', 'VARCHAR(200)')
+    _create_index(connection, 'ix_bookmark_meta_origin', 'bookmark', 'meta_origin')
+
+MIGRATIONS = [
+    (1, 'create tables', _baseline_tables),
+    (2, 'index hot lookup columns', _index_hot_columns),
+    (3, 'bookmark search index', _bookmark_search_index),
+    (4, 'status change versions', _status_versions),
+    (5, 'status history', _status_history),
+    (6, 'user listing index', _user_listing_index),
+    (7, 'bookmarks version', _bookmarks_version),
+    (8, 'widen password hash', _widen_password),
+    (9, 'site metadata', _site_meta),
+]
+
+def _ensure_version_table(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_migrations ('
+        'version INTEGER PRIMARY KEY, name VARCHAR(200) NOT NULL, applied_at TIMESTAMP NOT NULL)'
+    ))
+
+def current_version():
+    with db.engine.begin() as connection:
+        _ensure_version_table(connection)
+        return connection.execute(text('SELECT MAX(version) FROM schema_migrations')).scalar() or 0
+
+# Apply every pending migration; returns the versions that were applied
+def upgrade():
+    applied = []
+    engine = db.engine
+    for version, name, migrate in MIGRATIONS:
+        with engine.begin() as connection:
+            if engine.dialect.name == 'postgresql':
+                # Serialise concurrent upgrades from several containers
+                connection.execute(text('SELECT pg_advisory_xact_lock(7306321)'))
+            _ensure_version_table(connection)
+            done = connection.execute(text('SELECT 1 FROM schema_migrations WHERE version = :version'), {'version': version}).first()
+            if done:
+                continue
+            migrate(connection)
+            connection.execute(
+                text('INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :applied_at)'),
+                {'version': version, 'name': name, 'applied_at': datetime.now(timezone.utc).replace(tzinfo=None)},
+            )
+            applied.append(version)
+    return applied
@@ -6,18 +6,87 @@ db = SQLAlchemy()
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
-    password = db.Column(db.String(120), nullable=False)
+    password = db.Column(db.String(255), nullable=False)  # scrypt hashes are about 160 characters
     real_name = db.Column(db.String(120))
     email = db.Column(db.String(120), unique=True)  # Added unique=True to prevent duplicate emails
-    role = db.Column(db.String(20), default='user')
-    status = db.Column(db.String(20), default='pending')
+    role = db.Column(db.String(20), default='user', index=True)
+    status = db.Column(db.String(20), default='pending', index=True)
     theme = db.Column(db.String(50), default='cyberpunk')
+    bookmarks_version = db.Column(db.Integer, default=0, nullable=False)  # Bumped whenever the user's bookmarks change
     bookmarks = db.relationship('Bookmark', backref='user', lazy=True)
 
 class Bookmark(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     name = db.Column(db.String(120), nullable=False)
     server_url = db.Column(db.String(200))
     domain_url = db.Column(db.String(200))
-    image_url = db.Column(db.String(200))
\ No newline at end of file
+    image_url = db.Column(db.String(200))
+    title = db.Column(db.String(200))  # Page title of the bookmarked site, filled in by the enrichment job
+    icon_url = db.Column(db.String(200))  # Stored favicon tile of the site, shown when there is no image_url
+    meta_origin = db.Column(db.String(200), index=True)  # Origin the title/icon come from, NULL until the job has seen the bookmark
+
+class UrlStatus(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.String(200), unique=True, nullable=False)
+    is_up = db.Column(db.Boolean, default=False, nullable=False)
+    status_code = db.Column(db.Integer)
+    latency_ms = db.Column(db.Float)
+    error = db.Column(db.String(200))
+    checked_at = db.Column(db.DateTime)
+    version = db.Column(db.Integer, default=0, nullable=False, index=True)  # 'url_status' counter value of the last visible change
+
+class SiteMeta(db.Model):
+    # Title and favicon fetched once per origin (scheme://host:port), shared by every bookmark on it
+    origin = db.Column(db.String(200), primary_key=True)
+    title = db.Column(db.String(200))
+    icon_url = db.Column(db.String(200))  # Stored tile, like uploaded images
+    error = db.Column(db.String(40))  # Exception class name or HTTP status of a failed fetch, retried later
+    fetched_at = db.Column(db.DateTime, nullable=False)
+
+class MailMessage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(200), nullable=False)
+    recipients = db.Column(db.String(500), nullable=False)  # Comma separated addresses
+    html = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), default='queued', nullable=False, index=True)  # queued, sending (claimed by a request), sent or failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
+
+class ImageBlob(db.Model):
+    digest = db.Column(db.String(64), primary_key=True)  # SHA-256 of the uploaded bytes
+    url = db.Column(db.String(200), unique=True, nullable=False)  # Served tile variant
+    refcount = db.Column(db.Integer, default=0, nullable=False)  # Bookmarks whose image_url is this url
+    size = db.Column(db.Integer, default=0, nullable=False)  # Bytes on disk for all variants
+    updated_at = db.Column(db.DateTime)
+
+class Counter(db.Model):
+    # Named sequence numbers, bumped in the same transaction as the rows they version
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, default=0, nullable=False)
+
+class ProbeSample(db.Model):
+    # Every probe result, append only and kept for STATUS_HISTORY_HOURS
+    id = db.Column(db.Integer, primary_key=True)
+    url_id = db.Column(db.Integer, nullable=False)  # UrlStatus.id
+    checked_at = db.Column(db.DateTime, nullable=False, index=True)
+    is_up = db.Column(db.Boolean, nullable=False)
+    status_code = db.Column(db.SmallInteger)
+    latency_ms = db.Column(db.Float)
+    error = db.Column(db.String(40))  # Exception class name
+    __table_args__ = (db.Index('ix_probe_sample_url_checked', 'url_id', 'checked_at'),)
+
+class StatusRollup(db.Model):
+    # Probe counts and latency per URL and time bucket, one row per resolution (60, 3600 or 86400 seconds)
+    url_id = db.Column(db.Integer, primary_key=True)
+    resolution = db.Column(db.Integer, primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    samples = db.Column(db.Integer, default=0, nullable=False)
+    up = db.Column(db.Integer, default=0, nullable=False)
+    latency_count = db.Column(db.Integer, default=0, nullable=False)
+    latency_sum = db.Column(db.Float, default=0, nullable=False)
+    latency_max = db.Column(db.Float)
+    __table_args__ = (db.Index('ix_status_rollup_expiry', 'resolution', 'bucket_start'),)
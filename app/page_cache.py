@@ -0,0 +1,78 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+import time
+from flask import Response, request
+
+# Conditional GET and a rendered-page cache for views that only change with the data behind them.
+# A view passes the values its output depends on (e.g. the user's bookmarks_version and the
+# 'url_status' counter); their hash, together with the deployed code and the current
+# PAGE_CACHE_WINDOW, is the ETag. A browser or dashboard that already has that version gets
+# 304 Not Modified without anything being rendered, and other requests for it reuse the body
+# rendered last time. The window bounds how stale time-based parts (uptime sparklines) can get.
+
+class PageCache:
+    def __init__(self, app=None):
+        self.app = None
+        self.code_version = ''
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('PAGE_CACHE_ENABLED', True)
+        app.config.setdefault('PAGE_CACHE_SIZE', 500)
+        app.config.setdefault('PAGE_CACHE_WINDOW', 300)
+        app.extensions['page_cache'] = self
+        self.code_version = self._code_version()
+
+    # Fingerprint of the code, templates and static files, so a deploy never answers 304 to a
+    # page rendered by the previous version. Files are compared by size and modification time.
+    def _code_version(self):
+        skip = {os.path.abspath(os.path.join(self.app.root_path, 'instance')),
+                os.path.abspath(self.app.config.get('UPLOAD_FOLDER') or os.path.join(self.app.root_path, 'static', 'images'))}
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(self.app.root_path):
+            dirs[:] = sorted(name for name in dirs if os.path.abspath(os.path.join(root, name)) not in skip and name != '__pycache__')
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                digest.update(f"{os.path.relpath(os.path.join(root, name), self.app.root_path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        return digest.hexdigest()[:16]
+
+    def etag(self, parts):
+        window = int(time.time() // self.app.config['PAGE_CACHE_WINDOW'])
+        payload = json.dumps([self.code_version, window, list(parts)], default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+    # Response for a page that depends only on parts. render() returns the body as text and is
+    # only called when neither the client nor this process has the current version.
+    def respond(self, parts, render, mimetype='text/html'):
+        if not self.app.config['PAGE_CACHE_ENABLED']:
+            return Response(render(), mimetype=mimetype)
+        etag = self.etag(parts)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            with self._lock:
+                body = self._entries.get(etag)
+                if body is not None:
+                    self._entries.move_to_end(etag)
+            if body is None:
+                body = render()
+                with self._lock:
+                    self._entries[etag] = body
+                    while len(self._entries) > self.app.config['PAGE_CACHE_SIZE']:
+                        self._entries.popitem(last=False)
+            response = Response(body, mimetype=mimetype)
+        response.set_etag(etag)
+        # Private to the logged-in user, and always revalidated, which costs a 304 at most
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response
+
+page_cache = PageCache()
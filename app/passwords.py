@@ -0,0 +1,170 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sqlite3
+import threading
+import time
+from flask import Response
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Password hashing off the request threads, and throttling of failed logins. Hashes are computed
+# in a small per-process pool (PASSWORD_HASH_WORKERS), so a burst of logins can only take that
+# many cores while bookmark views keep being served; once PASSWORD_HASH_QUEUE hashes are running
+# or waiting, further ones fail fast with 503 instead of piling up. Failed logins are counted per
+# IP and per username over a sliding window, in memory by default or, like the status cache, in a
+# small SQLite file shared by all gunicorn workers.
+
+class HashingBusy(Exception):
+    pass
+
+class _MemoryFailures:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._entries = OrderedDict()  # key -> deque of failure times
+        self._lock = threading.Lock()
+
+    def recent(self, key, since):
+        with self._lock:
+            times = self._entries.get(key)
+            if not times:
+                return 0, None
+            while times and times[0] <= since:
+                times.popleft()
+            return len(times), (times[0] if times else None)
+
+    def add(self, key, at, window):
+        with self._lock:
+            self._entries.setdefault(key, deque()).append(at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+
+    def clear(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+class _SQLiteFailures:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        conn = sqlite3.connect(self.path, timeout=5)
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS login_failure (key TEXT NOT NULL, at REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_login_failure_key_at ON login_failure (key, at)')
+        conn.close()
+
+    def _connect(self):
+        # One connection per thread, and never reuse one inherited across a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def recent(self, key, since):
+        return tuple(self._connect().execute(
+            'SELECT COUNT(*), MIN(at) FROM login_failure WHERE key = ? AND at > ?', (key, since)).fetchone())
+
+    def add(self, key, at, window):
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT INTO login_failure VALUES (?, ?)', (key, at))
+            self._writes += 1
+            # Expired rows are only swept every so often
+            if self._writes % 100 == 0:
+                conn.execute('DELETE FROM login_failure WHERE at <= ?', (at - window,))
+
+    def clear(self, key):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM login_failure WHERE key = ?', (key,))
+
+class LoginThrottle:
+    def __init__(self, window=900, path=None):
+        self.window = window
+        self._store = _SQLiteFailures(path) if path else _MemoryFailures()
+
+    # Seconds until a login may be tried again, 0 when none of the (key, limit) pairs is over its limit
+    def retry_after(self, limits):
+        now = time.time()
+        wait = 0
+        for key, limit in limits:
+            count, oldest = self._store.recent(key, now - self.window)
+            if count >= limit:
+                wait = max(wait, int(oldest + self.window - now) + 1)
+        return wait
+
+    def record_failure(self, *keys):
+        now = time.time()
+        for key in keys:
+            self._store.add(key, now, self.window)
+
+    def reset(self, key):
+        self._store.clear(key)
+
+class Passwords:
+    def __init__(self, app=None):
+        self.app = None
+        self.throttle = None
+        self._method_prefix = None
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+        self._slots = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'scrypt')
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+        app.config.setdefault('PASSWORD_HASH_QUEUE', 16)
+        app.config.setdefault('LOGIN_FAILURE_WINDOW', 900)
+        app.config.setdefault('LOGIN_MAX_FAILURES_PER_IP', 20)
+        app.config.setdefault('LOGIN_MAX_FAILURES_PER_USER', 5)
+        app.config.setdefault('LOGIN_THROTTLE_PATH', None)
+        app.extensions['passwords'] = self
+        # Hashes made with the current method and parameters start with this, e.g. scrypt:32768:8:1
+        self._method_prefix = generate_password_hash('', app.config['PASSWORD_HASH_METHOD']).split('$', 1)[0]
+        self._slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_QUEUE'])
+        self.throttle = LoginThrottle(app.config['LOGIN_FAILURE_WINDOW'], app.config['LOGIN_THROTTLE_PATH'])
+        app.register_error_handler(HashingBusy, self._busy)
+
+    def _get_executor(self):
+        with self._executor_lock:
+            # Threads do not survive a fork, so each gunicorn worker makes its own pool
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.app.config['PASSWORD_HASH_WORKERS'],
+                                                    thread_name_prefix='password-hash')
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.app.config['PASSWORD_HASH_METHOD'])
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    # Whether a hash was made with an older method or weaker parameters than configured now
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self._method_prefix
+
+    def _busy(self, error):
+        return Response('The server is busy, please try again in a moment.', 503, {'Retry-After': '1'}, mimetype='text/plain')
+
+passwords = Passwords()
@@ -1,12 +1,12 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, current_app
 from flask_login import login_user, logout_user, login_required
-from werkzeug.security import generate_password_hash, check_password_hash
 from .. import db
 from ..models import User
-from flask_mail import Mail, Message
-from .. import mail, registration_email
+from .. import registration_email
+from ..mailer import queue_email
+from ..passwords import passwords
+from ..metrics import LOGIN_ATTEMPTS
 import re
-from smtplib import SMTPAuthenticationError, SMTPServerDisconnected
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -29,8 +29,23 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
+        config = current_app.config
+        # remote_addr is the client behind TRUSTED_PROXY_HOPS proxies (see create_app)
+        ip_key, user_key = f"ip:{request.remote_addr}", f"user:{username.lower()}"
+        retry_after = passwords.throttle.retry_after([(ip_key, config['LOGIN_MAX_FAILURES_PER_IP']),
+                                                      (user_key, config['LOGIN_MAX_FAILURES_PER_USER'])])
+        if retry_after:
+            LOGIN_ATTEMPTS.inc(result='throttled')
+            flash(f'Too many failed login attempts. Try again in {(retry_after + 59) // 60} minute(s).', 'error')
+            return render_template('login.html'), 429, {'Retry-After': str(retry_after)}
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
+        if user and passwords.verify(user.password, password):
+            LOGIN_ATTEMPTS.inc(result='success')
+            passwords.throttle.reset(user_key)
+            if passwords.needs_rehash(user.password):
+                # Stored with an older method or weaker parameters; the plain password is only known now
+                user.password = passwords.hash(password)
+                db.session.commit()
             if user.status == 'approved':
                 login_user(user)
                 session['theme'] = user.theme
@@ -38,6 +53,8 @@ def login():
             else:
                 flash('Your account is pending approval or has been denied.', 'error')
         else:
+            LOGIN_ATTEMPTS.inc(result='failure')
+            passwords.throttle.record_failure(ip_key, user_key)
             flash('Invalid credentials', 'error')
     return render_template('login.html')
 
@@ -59,7 +76,7 @@ def register():
         elif not validate_password(password):
             flash('Password must be at least 8 characters long.', 'error')
         else:
-            hashed_password = generate_password_hash(password)
+            hashed_password = passwords.hash(password)
             is_first_user = User.query.count() == 0
             new_user = User(
                 username=username,
@@ -73,21 +90,8 @@ def register():
             db.session.commit()
 
             if not is_first_user:  # Only send email for non-admin users
-                msg = Message("Registration Confirmation", recipients=[email])
-                msg.html = registration_email(real_name or username)
-                try:
-                    with current_app.app_context():
-                        mail.send(msg)
-                    flash('Registration submitted! Awaiting admin approval. A confirmation email has been sent.', 'success')
-                except SMTPAuthenticationError:
-                    flash('Registration submitted! Awaiting admin approval. Failed to send confirmation email due to authentication error.', 'warning')
-                    print("Email sending error: SMTP authentication failed. Check MAIL_USERNAME and MAIL_PASSWORD.")
-                except SMTPServerDisconnected:
-                    flash('Registration submitted! Awaiting admin approval. Failed to send confirmation email due to server connection issue.', 'warning')
-                    print("Email sending error: SMTP server disconnected. Check network or MAIL_SERVER settings.")
-                except Exception as e:
-                    flash('Registration submitted! Awaiting admin approval. Failed to send confirmation email.', 'warning')
-                    print(f"Email sending error: {str(e)}")
+                queue_email("Registration Confirmation", [email], registration_email(real_name or username))
+                flash('Registration submitted! Awaiting admin approval. A confirmation email will be sent shortly.', 'success')
             else:
                 flash('Admin account created! Please log in.', 'success')
 
@@ -1,15 +1,29 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, current_app, abort, send_file, jsonify, get_template_attribute, Response, stream_with_context
 from flask_login import login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-import os
-import requests
 from .. import db
 from ..models import User, Bookmark
-from flask_mail import Mail, Message
-from .. import mail, approval_email, password_reset_email, account_info_change_email
+from ..status import status_checker, get_statuses, store_results
+from ..status_feed import status_feed, status_json
+from ..database import counter_value, bump_bookmarks_version, bookmarks_version
+from ..history import uptime_summary, history_series, RESOLUTION_NAMES
+from .. import approval_email, password_reset_email, account_info_change_email
+from ..emails import render_emails
+from ..mailer import mail_queue, queue_email, claim_messages, deliver
+from ..images import save_upload, acquire_image, release_image, ImageError
+from ..image_proxy import image_src, load_token, fetch_image
+from ..listing import list_bookmarks, CursorError, SORTS
+from ..transfer import FORMATS, format_for_filename, export_bookmarks, read_records, import_bookmarks
+from ..user_cache import user_cache, SESSION_FIELDS
+from ..passwords import passwords
+from ..page_cache import page_cache
+from ..admin import list_users, user_totals, user_usage, delete_user
+from ..site_meta import site_meta, bookmark_origin
+from datetime import datetime, timedelta, timezone
+import io
+import json
+import random
 import re
-from smtplib import SMTPAuthenticationError, SMTPServerDisconnected
+import time
 
 main_bp = Blueprint('main', __name__)
 
@@ -34,23 +48,6 @@ def validate_url(url):
     pattern = r'^https?://[^\s/$.?#].[^\s]*$'
     return bool(re.match(pattern, url))
 
-def check_url_status(url):
-    if not url:
-        return False
-    try:
-        response = requests.head(url, timeout=5, allow_redirects=True)
-        if response.status_code == 200:
-            print(f"HEAD success for {url}: {response.status_code}")
-            return True
-        else:
-            print(f"HEAD failed for {url}: {response.status_code}")
-            response = requests.get(url, timeout=5, allow_redirects=True)
-            print(f"GET result for {url}: {response.status_code}")
-            return response.status_code == 200
-    except requests.RequestException as e:
-        print(f"Error checking {url}: {str(e)}")
-        return False
-
 @main_bp.route('/', methods=['GET', 'POST'])
 @login_required
 def bookmarks():
@@ -67,21 +64,20 @@ def bookmarks():
                 return redirect(url_for('main.bookmarks'))
 
             if 'image_upload' in request.files and request.files['image_upload'].filename:
-                file = request.files['image_upload']
-                filename = secure_filename(file.filename)
-                filename = f"{os.urandom(8).hex()}-{filename}"
-                file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-                print(f"Saving uploaded image to: {file_path}")
-                file.save(file_path)
-                if os.path.exists(file_path):
-                    print(f"Image saved successfully: {file_path}")
-                else:
-                    print(f"Failed to save image: {file_path}")
-                image_url = f"/static/images/{filename}"
+                try:
+                    image_url = save_upload(request.files['image_upload'])
+                except ImageError as e:
+                    flash(str(e), 'error')
+                    return redirect(url_for('main.bookmarks'))
 
             bookmark = Bookmark(user_id=current_user.id, name=name, server_url=server_url, domain_url=domain_url, image_url=image_url)
             db.session.add(bookmark)
+            acquire_image(image_url)
+            bump_bookmarks_version(current_user.id)
             db.session.commit()
+            if server_url or domain_url:
+                status_checker.wake()
+                site_meta.wake()
             flash('Bookmark added successfully!', 'success')
             return redirect(url_for('main.bookmarks'))
         
@@ -95,6 +91,12 @@ def bookmarks():
             bookmark.name = request.form['name']
             bookmark.server_url = request.form.get('server_url') or None
             bookmark.domain_url = request.form.get('domain_url') or None
+            # Another site: drop its title and icon until the background job has the new ones
+            origin_changed = (bookmark.meta_origin is not None
+                              and (bookmark_origin(bookmark.server_url, bookmark.domain_url) or '') != bookmark.meta_origin)
+            if origin_changed:
+                release_image(bookmark.icon_url)
+                bookmark.title = bookmark.icon_url = bookmark.meta_origin = None
 
             # Handle image updates
             clear_image = 'clear_image' in request.form  # Check if the user wants to clear the image
@@ -105,58 +107,35 @@ def bookmarks():
                 flash('Invalid image URL. Must start with http:// or https://.', 'error')
                 return redirect(url_for('main.bookmarks'))
 
-            # Log the current state
-            print(f"Editing bookmark {bookmark_id}. Current image_url: {bookmark.image_url}")
-            print(f"Clear image: {clear_image}, New image_url: {image_url}, Image upload present: {'image_upload' in request.files and request.files['image_upload'].filename}")
-
             # Determine the new image_url
             if clear_image:
-                # Clear the image: delete the old file if it exists and set image_url to None
-                if bookmark.image_url and bookmark.image_url.startswith('/static/images/'):
-                    old_image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], bookmark.image_url.split('/')[-1])
-                    print(f"Clearing image. Deleting old image: {old_image_path}")
-                    if os.path.exists(old_image_path):
-                        os.remove(old_image_path)
-                        print(f"Old image deleted: {old_image_path}")
-                    else:
-                        print(f"Old image not found: {old_image_path}")
+                # Clear the image: drop the reference to the old file and set image_url to None
+                release_image(bookmark.image_url)
                 bookmark.image_url = None
             elif 'image_upload' in request.files and request.files['image_upload'].filename:
-                # New image uploaded: delete the old file if it exists, save the new file
-                if bookmark.image_url and bookmark.image_url.startswith('/static/images/'):
-                    old_image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], bookmark.image_url.split('/')[-1])
-                    print(f"New image uploaded. Deleting old image: {old_image_path}")
-                    if os.path.exists(old_image_path):
-                        os.remove(old_image_path)
-                        print(f"Old image deleted: {old_image_path}")
-                    else:
-                        print(f"Old image not found: {old_image_path}")
-                file = request.files['image_upload']
-                filename = secure_filename(file.filename)
-                filename = f"{os.urandom(8).hex()}-{filename}"
-                file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-                print(f"Saving new image to: {file_path}")
-                file.save(file_path)
-                if os.path.exists(file_path):
-                    print(f"New image saved successfully: {file_path}")
-                else:
-                    print(f"Failed to save new image: {file_path}")
-                bookmark.image_url = f"/static/images/{filename}"
+                # New image uploaded: save the new file and move the reference over to it
+                try:
+                    new_image_url = save_upload(request.files['image_upload'])
+                except ImageError as e:
+                    flash(str(e), 'error')
+                    return redirect(url_for('main.bookmarks'))
+                if new_image_url != bookmark.image_url:
+                    release_image(bookmark.image_url)
+                    acquire_image(new_image_url)
+                bookmark.image_url = new_image_url
             elif image_url and image_url != bookmark.image_url:
-                # New image URL provided and it's different: delete the old file if it exists, set the new URL
-                if bookmark.image_url and bookmark.image_url.startswith('/static/images/'):
-                    old_image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], bookmark.image_url.split('/')[-1])
-                    print(f"New image URL provided. Deleting old image: {old_image_path}")
-                    if os.path.exists(old_image_path):
-                        os.remove(old_image_path)
-                        print(f"Old image deleted: {old_image_path}")
-                    else:
-                        print(f"Old image not found: {old_image_path}")
+                # New image URL provided and it's different: move the reference over to the new URL
+                release_image(bookmark.image_url)
+                acquire_image(image_url)
                 bookmark.image_url = image_url
             # If none of the above, keep the existing image_url
-            print(f"Final image_url after edit: {bookmark.image_url}")
 
+            bump_bookmarks_version(current_user.id)
             db.session.commit()
+            if bookmark.server_url or bookmark.domain_url:
+                status_checker.wake()
+            if origin_changed:
+                site_meta.wake()
             flash('Bookmark updated successfully!', 'success')
             return redirect(url_for('main.bookmarks'))
     
@@ -164,101 +143,167 @@ def bookmarks():
         bookmark_id = request.args.get('delete')
         bookmark = Bookmark.query.get_or_404(bookmark_id)
         if bookmark.user_id == current_user.id:
-            if bookmark.image_url and bookmark.image_url.startswith('/static/images/'):
-                old_image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], bookmark.image_url.split('/')[-1])
-                print(f"Deleting bookmark {bookmark_id}. Deleting image: {old_image_path}")
-                if os.path.exists(old_image_path):
-                    os.remove(old_image_path)
-                    print(f"Image deleted: {old_image_path}")
-                else:
-                    print(f"Image not found: {old_image_path}")
+            release_image(bookmark.image_url)
+            release_image(bookmark.icon_url)
             db.session.delete(bookmark)
+            bump_bookmarks_version(current_user.id)
             db.session.commit()
             flash('Bookmark deleted successfully!', 'success')
         return redirect(url_for('main.bookmarks'))
     
-    bookmarks = Bookmark.query.filter_by(user_id=current_user.id).all()
+    sort = request.args.get('sort', 'name')
+    if sort not in SORTS:
+        sort = 'name'
+    query = request.args.get('q', '').strip()
+    cursor = request.args.get('cursor')
+    # Read before the statuses, so the live stream re-sends anything that changes in between
+    status_version = counter_value('url_status')
+
+    def render():
+        try:
+            bookmarks, next_cursor = load_bookmark_page(sort, query, cursor)
+        except CursorError:
+            bookmarks, next_cursor = load_bookmark_page(sort, query, None)
+        return render_template('bookmarks.html', bookmarks=bookmarks, next_cursor=next_cursor, sort=sort, q=query,
+                               status_version=status_version, display_name=current_user.real_name or current_user.username)
+
+    if current_app.config['STATUS_CHECK_ON_DEMAND']:
+        return render()  # Every view probes, so there is nothing to reuse
+    return page_cache.respond(bookmark_page_parts(status_version, sort, query, cursor), render)
+
+# Everything a bookmark page of the current user is built from, for its ETag
+def bookmark_page_parts(status_version, *args):
+    user = [getattr(current_user, name) for name in SESSION_FIELDS]
+    return [user, session.get('theme'), bookmarks_version(current_user.id), status_version, *args]
+
+# One page of the current user's bookmarks with their link statuses attached
+def load_bookmark_page(sort, query, cursor, limit=None):
+    limit = limit or current_app.config['BOOKMARKS_PAGE_SIZE']
+    bookmarks, next_cursor = list_bookmarks(current_user.id, sort, query, cursor, limit)
+    urls = [b.server_url for b in bookmarks] + [b.domain_url for b in bookmarks]
+    if current_app.config['STATUS_CHECK_ON_DEMAND']:
+        # One concurrent, deduplicated batch bounded by the batch deadline
+        store_results(status_checker.check(urls).values())
+    # Status dots come from the stored results of the health checker
+    statuses = get_statuses(urls)
+    history = uptime_summary(status.id for status in statuses.values())
     for bookmark in bookmarks:
-        bookmark.server_status = check_url_status(bookmark.server_url)
-        bookmark.domain_status = check_url_status(bookmark.domain_url)
-        print(f"Bookmark {bookmark.id}: image_url={bookmark.image_url}")
-    return render_template('bookmarks.html', bookmarks=bookmarks, display_name=current_user.real_name or current_user.username)
+        bookmark.server_status = statuses.get(bookmark.server_url)
+        bookmark.domain_status = statuses.get(bookmark.domain_url)
+        bookmark.server_history = history.get(bookmark.server_status.id) if bookmark.server_status else None
+        bookmark.domain_history = history.get(bookmark.domain_status.id) if bookmark.domain_status else None
+    return bookmarks, next_cursor
+
+# JSON listing for infinite scroll and scripts. Takes the same sort/q parameters as the home
+# page plus the cursor from the previous page. Besides the data, each page carries the rendered
+# tiles and edit popups so the page can append them without duplicating the markup in JS.
+@main_bp.route('/api/bookmarks')
+@login_required
+def api_bookmarks():
+    limit = max(1, min(request.args.get('limit', current_app.config['BOOKMARKS_PAGE_SIZE'], type=int), 200))
+    sort = request.args.get('sort', 'name')
+    query = request.args.get('q', '').strip()
+    cursor = request.args.get('cursor')
+    status_version = counter_value('url_status')
+
+    def render():
+        bookmarks, next_cursor = load_bookmark_page(sort, query, cursor, limit)
+        return current_app.json.dumps(bookmark_page_json(bookmarks, next_cursor))
+
+    try:
+        if current_app.config['STATUS_CHECK_ON_DEMAND']:
+            return current_app.response_class(render(), mimetype='application/json')
+        return page_cache.respond(bookmark_page_parts(status_version, 'api', sort, query, cursor, limit), render,
+                                  mimetype='application/json')
+    except CursorError as e:
+        return jsonify(error=str(e)), 400
+
+# Body of /api/bookmarks
+def bookmark_page_json(bookmarks, next_cursor):
+    return dict(
+        bookmarks=[{
+            'id': bookmark.id,
+            'name': bookmark.name,
+            'server_url': bookmark.server_url,
+            'domain_url': bookmark.domain_url,
+            'image_url': bookmark.image_url,
+            'image_src': image_src(bookmark.image_url or bookmark.icon_url),
+            'title': bookmark.title,
+            'server_status': status_json(bookmark.server_status),
+            'domain_status': status_json(bookmark.domain_status),
+        } for bookmark in bookmarks],
+        next_cursor=next_cursor,
+        html=get_template_attribute('_bookmarks.html', 'tiles')(bookmarks),
+        popups_html=get_template_attribute('_bookmarks.html', 'edit_popups')(bookmarks),
+    )
 
 @main_bp.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
+    # current_user only carries the cached session fields, the form needs the full account
+    user = db.session.get(User, current_user.id)
     if request.method == 'POST':
         if 'theme' in request.form and 'update_profile' not in request.form:
             new_theme = request.form['theme']
             if new_theme in VALID_THEMES:
-                current_user.theme = new_theme
+                user.theme = new_theme
                 session['theme'] = new_theme
                 db.session.commit()
+                user_cache.invalidate(user.id)
                 flash('Theme updated successfully!', 'success')
             return redirect(url_for('main.profile'))
 
         if 'update_profile' in request.form:
             current_password = request.form.get('current_password')
-            if not current_password or not check_password_hash(current_user.password, current_password):
+            if not current_password or not passwords.verify(user.password, current_password):
                 flash('Current password is incorrect or missing!', 'error')
             else:
                 updated = False
                 changes = {}
-                if request.form['real_name'] != (current_user.real_name or ''):
-                    current_user.real_name = request.form['real_name']
-                    changes['name'] = current_user.real_name
+                if request.form['real_name'] != (user.real_name or ''):
+                    user.real_name = request.form['real_name']
+                    changes['name'] = user.real_name
                     flash('Name updated successfully!', 'success')
                     updated = True
-                if request.form['new_username'] != current_user.username:
+                if request.form['new_username'] != user.username:
                     if User.query.filter_by(username=request.form['new_username']).first():
                         flash('Username already taken!', 'error')
                     else:
-                        current_user.username = request.form['new_username']
-                        changes['username'] = current_user.username
+                        user.username = request.form['new_username']
+                        changes['username'] = user.username
                         flash('Username updated successfully!', 'success')
                         updated = True
-                if request.form['email'] != (current_user.email or ''):
+                if request.form['email'] != (user.email or ''):
                     if not validate_email_address(request.form['email']):
                         flash('Invalid email address.', 'error')
                         return redirect(url_for('main.profile'))
                     # Check for email uniqueness
-                    if User.query.filter(User.email == request.form['email'], User.id != current_user.id).first():
+                    if User.query.filter(User.email == request.form['email'], User.id != user.id).first():
                         flash('Email already in use by another account.', 'error')
                         return redirect(url_for('main.profile'))
-                    current_user.email = request.form['email']
-                    changes['email'] = current_user.email
+                    user.email = request.form['email']
+                    changes['email'] = user.email
                     flash('Email updated successfully!', 'success')
                     updated = True
                 if request.form['new_password'] and request.form['new_password'] == request.form['confirm_password']:
-                    current_user.password = generate_password_hash(request.form['new_password'])
+                    user.password = passwords.hash(request.form['new_password'])
                     changes['password'] = True
                     flash('Password updated successfully!', 'success')
                     updated = True
 
                 if updated:
                     db.session.commit()
-                    if changes and current_user.email:
-                        msg = Message("Account Information Updated", recipients=[current_user.email])
-                        msg.html = account_info_change_email(current_user.real_name or current_user.username, changes)
-                        try:
-                            with current_app.app_context():
-                                mail.send(msg)
-                            flash('A confirmation email has been sent with your updated information.', 'success')
-                        except SMTPAuthenticationError:
-                            flash('Failed to send confirmation email due to authentication error.', 'warning')
-                            print("Email sending error: SMTP authentication failed. Check MAIL_USERNAME and MAIL_PASSWORD.")
-                        except SMTPServerDisconnected:
-                            flash('Failed to send confirmation email due to server connection issue.', 'warning')
-                            print("Email sending error: SMTP server disconnected. Check network or MAIL_SERVER settings.")
-                        except Exception as e:
-                            flash('Failed to send confirmation email.', 'warning')
-                            print(f"Email sending error: {str(e)}")
+                    user_cache.invalidate(user.id)
+                    if changes and user.email:
+                        queue_email("Account Information Updated", [user.email],
+                                    account_info_change_email(user.real_name or user.username, changes))
+                        flash('A confirmation email with your updated information will be sent shortly.', 'success')
                     return render_template('info_change.html', changes=changes)
                 else:
                     flash('No changes detected.', 'info')
             return redirect(url_for('main.profile'))
 
-    return render_template('profile.html', user=current_user)
+    return render_template('profile.html', user=user)
 
 @main_bp.route('/admin_panel', methods=['GET', 'POST'])
 @login_required
@@ -267,28 +312,20 @@ def admin_panel():
         flash('Only admins can access this page.', 'error')
         return render_template('access_denied.html')
     
+    delivery_report = None
     if request.method == 'POST':
-        if 'approve' in request.form:
+        if 'bulk_action' in request.form:
+            delivery_report = bulk_user_action(request.form['bulk_action'], request.form.getlist('user_ids'))
+
+        elif 'approve' in request.form:
             user_id = request.form['approve']
             user = User.query.get_or_404(user_id)
             user.status = 'approved'
             db.session.commit()
+            user_cache.invalidate(user.id)
             if user.email and validate_email_address(user.email):
-                msg = Message("Account Approved", recipients=[user.email])
-                msg.html = approval_email(user.real_name or user.username, user.username)
-                try:
-                    with current_app.app_context():
-                        mail.send(msg)
-                    flash(f"User {user.username} approved! A confirmation email has been sent.", 'success')
-                except SMTPAuthenticationError:
-                    flash(f"User {user.username} approved, but failed to send confirmation email due to authentication error.", 'warning')
-                    print("Email sending error: SMTP authentication failed. Check MAIL_USERNAME and MAIL_PASSWORD.")
-                except SMTPServerDisconnected:
-                    flash(f"User {user.username} approved, but failed to send confirmation email due to server connection issue.", 'warning')
-                    print("Email sending error: SMTP server disconnected. Check network or MAIL_SERVER settings.")
-                except Exception as e:
-                    flash(f"User {user.username} approved, but failed to send confirmation email.", 'warning')
-                    print(f"Email sending error: {str(e)}")
+                queue_email("Account Approved", [user.email], approval_email(user.real_name or user.username, user.username))
+                flash(f"User {user.username} approved! A confirmation email will be sent shortly.", 'success')
             else:
                 flash(f"User {user.username} approved! No valid email provided to send confirmation.", 'success')
         
@@ -297,6 +334,7 @@ def admin_panel():
             user = User.query.get_or_404(user_id)
             user.status = 'denied'
             db.session.commit()
+            user_cache.invalidate(user.id)
             flash(f"User {user.username} denied!", 'success')
         
         elif 'delete' in request.form:
@@ -305,39 +343,22 @@ def admin_panel():
             if user.username == current_user.username:
                 flash('You cannot delete your own account!', 'error')
             else:
-                # Delete the user's bookmarks first
-                bookmarks = Bookmark.query.filter_by(user_id=user.id).all()
-                for bookmark in bookmarks:
-                    if bookmark.image_url and os.path.exists(os.path.join(current_app.config['UPLOAD_FOLDER'], bookmark.image_url.split('/')[-1])):
-                        os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], bookmark.image_url.split('/')[-1]))
-                    db.session.delete(bookmark)
-                # Now delete the user
-                db.session.delete(user)
+                # Bookmarks and the user go in bulk statements; image files are left to the garbage collector
+                user_id, username = user.id, user.username
+                delete_user(user)
                 db.session.commit()
-                flash(f"User {user.username} deleted!", 'success')
+                user_cache.invalidate(user_id)
+                flash(f"User {username} deleted!", 'success')
         
         elif 'reset_password' in request.form:
             user_id = request.form['reset_password']
             user = User.query.get_or_404(user_id)
             new_password = 'ChangeMe123@'  # Consistent with email
-            user.password = generate_password_hash(new_password)
+            user.password = passwords.hash(new_password)
             db.session.commit()
             if user.email and validate_email_address(user.email):
-                msg = Message("Password Reset", recipients=[user.email])
-                msg.html = password_reset_email(user.real_name or user.username, user.username, new_password)
-                try:
-                    with current_app.app_context():
-                        mail.send(msg)
-                    flash(f"Password for {user.username} reset to '{new_password}'! A confirmation email has been sent.", 'success')
-                except SMTPAuthenticationError:
-                    flash(f"Password for {user.username} reset to '{new_password}', but failed to send confirmation email due to authentication error.", 'warning')
-                    print("Email sending error: SMTP authentication failed. Check MAIL_USERNAME and MAIL_PASSWORD.")
-                except SMTPServerDisconnected:
-                    flash(f"Password for {user.username} reset to '{new_password}', but failed to send confirmation email due to server connection issue.", 'warning')
-                    print("Email sending error: SMTP server disconnected. Check network or MAIL_SERVER settings.")
-                except Exception as e:
-                    flash(f"Password for {user.username} reset to '{new_password}', but failed to send confirmation email.", 'warning')
-                    print(f"Email sending error: {str(e)}")
+                queue_email("Password Reset", [user.email], password_reset_email(user.real_name or user.username, user.username, new_password))
+                flash(f"Password for {user.username} reset to '{new_password}'! A confirmation email will be sent shortly.", 'success')
             else:
                 flash(f"Password for {user.username} reset to '{new_password}'! No valid email provided to send confirmation.", 'success')
         
@@ -351,11 +372,193 @@ def admin_panel():
                 else:
                     user.role = new_role
                     db.session.commit()
+                    user_cache.invalidate(user.id)
                     flash(f"Role for {user.username} updated to {new_role}!", 'success')
     
-    pending_users = User.query.filter_by(status='pending').all()
-    approved_users = User.query.filter_by(status='approved').filter(User.id != current_user.id).all()
-    return render_template('admin_panel.html', pending_users=pending_users, approved_users=approved_users)
+    # Each list pages on its own; q searches both
+    query = request.args.get('q', '').strip()
+    limit = current_app.config['ADMIN_PAGE_SIZE']
+    pending_users, pending_next = list_users('pending', query, request.args.get('pending_after'), limit)
+    approved_users, approved_next = list_users('approved', query, request.args.get('approved_after'), limit,
+                                               exclude_id=current_user.id)
+    usage = user_usage(user.id for user in approved_users)
+    return render_template('admin_panel.html', pending_users=pending_users, approved_users=approved_users,
+                           pending_next=pending_next, approved_next=approved_next, q=query, usage=usage,
+                           totals=user_totals(), status_cache=status_checker.cache.stats(),
+                           delivery_report=delivery_report)
+
+# Approve, deny or reset many users at once. All status changes and their notification emails are
+# committed in one transaction. Up to MAIL_INLINE_BATCH of the emails are claimed by this request
+# before the commit and go out over a single SMTP connection, so the background queue cannot send
+# them a second time; the rest, and any that fail, are left to the queue. Returns a per-recipient
+# delivery report read back from the queue.
+def bulk_user_action(action, user_ids):
+    if action not in ('approve', 'deny', 'reset_password'):
+        flash('Unknown bulk action.', 'error')
+        return None
+    ids = [int(user_id) for user_id in user_ids if user_id.isdigit()]
+    users = User.query.filter(User.id.in_(ids), User.id != current_user.id).order_by(User.username).all() if ids else []
+    if not users:
+        flash('No users selected.', 'error')
+        return None
+
+    new_password = 'ChangeMe123@'  # Consistent with email
+    # Everyone gets the same temporary password, so hash it once rather than per user
+    new_password_hash = passwords.hash(new_password) if action == 'reset_password' else None
+    report = []
+    recipients = []
+    for user in users:
+        if action == 'approve':
+            user.status = 'approved'
+        elif action == 'deny':
+            user.status = 'denied'
+        else:
+            user.password = new_password_hash
+        if action == 'deny':
+            continue
+        if not (user.email and validate_email_address(user.email)):
+            report.append({'username': user.username, 'recipient': None, 'status': 'no email', 'error': None})
+            continue
+        recipients.append(user)
+
+    # One compiled template renders every message in the batch
+    if action == 'approve':
+        subject, template_name, extra = "Account Approved", 'approval.html', {}
+    else:
+        subject, template_name, extra = "Password Reset", 'password_reset.html', {'temp_password': new_password}
+    contexts = [dict(name=user.real_name or user.username, username=user.username, **extra) for user in recipients]
+    bodies = render_emails(template_name, subject, contexts) if recipients else []
+    messages = [(user, queue_email(subject, [user.email], html, commit=False)) for user, html in zip(recipients, bodies)]
+    inline = [message for _, message in messages[:current_app.config['MAIL_INLINE_BATCH']]]
+    claim_messages(inline)
+    db.session.commit()
+    user_cache.invalidate(*[user.id for user in users])
+    if len(inline) < len(messages):
+        mail_queue.wake()
+
+    if inline:
+        deliver(inline)
+        db.session.commit()
+    for user, message in messages:
+        report.append({'username': user.username, 'recipient': user.email, 'status': message.status, 'error': message.last_error})
+
+    verb = {'approve': 'approved', 'deny': 'denied', 'reset_password': f"had their password reset to '{new_password}'"}[action]
+    sent = sum(1 for _, message in messages if message.status == 'sent')
+    failed = sum(1 for _, message in messages if message.last_error)
+    summary = f"{len(users)} user(s) {verb}."
+    if messages:
+        summary += f" {sent} email(s) sent, {len(messages) - sent} queued for the background sender."
+    flash(summary, 'success' if not failed else 'warning')
+    return report
+
+# Download bookmarks as browser bookmark HTML, JSON Lines or CSV. Admins can add all=1 to
+# export every account. The file is streamed, so large collections are never held in memory.
+@main_bp.route('/bookmarks/export')
+@login_required
+def export_bookmarks_file():
+    fmt = request.args.get('format', 'html')
+    if fmt not in FORMATS:
+        abort(400)
+    with_user = bool(request.args.get('all')) and current_user.role == 'admin'
+    if with_user:
+        users = [tuple(row) for row in db.session.query(User.id, User.username).order_by(User.username)]
+    else:
+        users = [(current_user.id, current_user.username)]
+    mimetype, ext = FORMATS[fmt]
+    filename = f"bookmarks{'-all' if with_user else ''}.{ext}"
+    return Response(stream_with_context(export_bookmarks(fmt, users, with_user)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@main_bp.route('/bookmarks/import', methods=['POST'])
+@login_required
+def import_bookmarks_file():
+    file = request.files.get('import_file')
+    fmt = format_for_filename(file.filename) if file and file.filename else None
+    if fmt is None:
+        flash('Choose a bookmarks file (.html, .jsonl or .csv) to import.', 'error')
+        return redirect(url_for('main.profile'))
+    # Parsed straight from the upload stream and inserted in batches
+    stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig', errors='replace', newline='')
+    stats = import_bookmarks(read_records(stream, fmt), current_user.id)
+    if stats['imported']:
+        status_checker.wake()
+        site_meta.wake()
+    flash(f"Imported {stats['imported']} bookmark(s). Skipped {stats['duplicates']} duplicate(s) "
+          f"and {stats['invalid']} invalid entr{'y' if stats['invalid'] == 1 else 'ies'}.", 'success')
+    return redirect(url_for('main.profile'))
+
+# Server-Sent Events stream of status changes for the current user's bookmarked URLs, starting
+# after the version the page was rendered with (or the Last-Event-ID of a reconnect). Streams
+# only read the process-wide status feed, they never probe. Each one is closed after
+# STATUS_STREAM_TIMEOUT seconds and the browser reconnects, so a worker is never held forever.
+# When the worker already has STATUS_STREAM_MAX streams open, the browser is told to retry later.
+@main_bp.route('/api/status/stream')
+@login_required
+def status_stream():
+    if not current_app.config['STATUS_STREAM_ENABLED']:
+        abort(404)
+    version = request.headers.get('Last-Event-ID', request.args.get('since', '0'))
+    version = int(version) if version.isdigit() else 0
+    rows = db.session.query(Bookmark.server_url, Bookmark.domain_url).filter_by(user_id=current_user.id).all()
+    urls = {url for row in rows for url in row if url}
+    db.session.close()  # Do not hold a pooled connection for the life of the stream
+    timeout = current_app.config['STATUS_STREAM_TIMEOUT']
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    if not status_feed.open_stream():
+        # EventSource gives up for good on an error status, so answer with an empty stream and a
+        # jittered reconnect delay instead of a 503
+        retry = current_app.config['STATUS_STREAM_BUSY_RETRY'] * 1000
+        return Response(f"retry: {random.randint(retry, retry * 2)}\n\n", mimetype='text/event-stream', headers=headers)
+
+    def events(version):
+        yield 'retry: 2000\n\n'
+        expires = time.monotonic() + timeout
+        while True:
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                return
+            version_now, changes = status_feed.wait(urls, version, min(remaining, 15))
+            if changes:
+                version = version_now
+                yield f"id: {version}\nevent: status\ndata: {json.dumps(changes)}\n\n"
+            else:
+                yield ': keep-alive\n\n'
+
+    response = Response(events(version), mimetype='text/event-stream', headers=headers)
+    response.call_on_close(status_feed.close_stream)  # Also runs when the client disconnects
+    return response
+
+# Probe history of one of the current user's bookmarked URLs: raw samples or 1m/1h/1d rollups
+# for the last `hours` hours
+@main_bp.route('/api/status/history')
+@login_required
+def status_history():
+    url = request.args.get('url', '')
+    resolution = RESOLUTION_NAMES.get(request.args.get('resolution', '1h'))
+    hours = max(1, min(request.args.get('hours', 24, type=int), 24 * 400))
+    if resolution is None:
+        return jsonify(error='resolution must be one of raw, 1m, 1h or 1d'), 400
+    owned = Bookmark.query.filter(Bookmark.user_id == current_user.id,
+                                  (Bookmark.server_url == url) | (Bookmark.domain_url == url)).first()
+    status = get_statuses([url]).get(url) if owned else None
+    if status is None:
+        abort(404)
+    since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=hours)
+    return jsonify(url=url, resolution=request.args.get('resolution', '1h'), series=history_series(status.id, resolution, since))
+
+@main_bp.route('/image-proxy/<token>')
+@login_required
+def image_proxy(token):
+    url = load_token(token)
+    if not url:
+        abort(404)
+    cached = fetch_image(url)
+    if cached is None:
+        abort(404)
+    if cached.redirect:
+        return redirect(url)
+    return send_file(cached.path, mimetype=cached.mimetype, etag=cached.etag, conditional=True,
+                     max_age=current_app.config['IMAGE_PROXY_MAX_AGE'])
 
 @main_bp.route('/privacy-policy')
 def privacy_policy():
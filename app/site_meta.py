@@ -0,0 +1,347 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+import logging
+import threading
+import time
+import requests
+from flask import current_app
+from sqlalchemy import exists, or_
+from .models import db, Bookmark, SiteMeta
+from .database import bump_bookmarks_version, signal_wake
+from .images import store_image, validate_image, acquire_image, release_image, ImageError
+from .image_proxy import fetch_url, PrivateHostError
+from .metrics import SITE_META_FETCHES
+
+logger = logging.getLogger(__name__)
+
+# Background enrichment of bookmarks with the title and favicon of the site they point at, so
+# tiles without an image_url still get an icon. Metadata is fetched once per origin and kept in
+# SiteMeta; every bookmark on that origin copies it, so thousands of bookmarks of the same host
+# cost one fetch. Icons go through the image pipeline and are stored and refcounted like uploads.
+#
+# Each cycle first assigns an origin to new or edited bookmarks (meta_origin is NULL until then)
+# and copies metadata that is already known, then fetches up to SITE_META_FETCHES_PER_CYCLE
+# unknown origins on a small thread pool, at most one request per SITE_META_HOST_INTERVAL
+# seconds to the same host. Failed fetches are retried after SITE_META_RETRY_AFTER. Nothing
+# here runs on the request path; views only read the copied columns.
+
+# Outcome of fetching one origin: the page title and raw icon bytes, or the error that stopped it
+SiteFetch = namedtuple('SiteFetch', ['origin', 'title', 'icon', 'error'])
+
+# Icon URLs tried per origin, best candidate first
+MAX_ICON_CANDIDATES = 3
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+# scheme://host[:port] of an http(s) URL, or None for anything else
+def site_origin(url):
+    try:
+        parts = urlsplit(url or '')
+        port = parts.port
+    except ValueError:
+        return None
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        return None
+    host = f"[{parts.hostname}]" if ':' in parts.hostname else parts.hostname
+    return f"{parts.scheme}://{host}{f':{port}' if port else ''}"
+
+# The origin a bookmark's metadata comes from: its public domain, else its server address
+def bookmark_origin(server_url, domain_url):
+    return site_origin(domain_url) or site_origin(server_url)
+
+class _HeadParser(HTMLParser):
+    # Collects the <title> and <link rel="icon"> tags of a page, ignoring everything after <head>
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.icons = []  # (href, rel words, sizes, type)
+        self._title_parts = None
+        self._done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self._done:
+            return
+        attrs = dict(attrs)
+        if tag == 'title' and self.title is None:
+            self._title_parts = []
+        elif tag == 'link' and attrs.get('href'):
+            rel = (attrs.get('rel') or '').lower().split()
+            if any(word == 'icon' or word.startswith('apple-touch-icon') for word in rel):
+                self.icons.append((attrs['href'], rel, attrs.get('sizes'), attrs.get('type')))
+        elif tag == 'body':
+            self._done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self._title_parts is not None:
+            self.title = ' '.join(''.join(self._title_parts).split())[:200] or None
+            self._title_parts = None
+        elif tag == 'head':
+            self._done = True
+
+    def handle_data(self, data):
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+
+# Icon URLs to try for a page: declared icons, largest first (SVG cannot be tiled), then /favicon.ico
+def icon_candidates(page_url, links):
+    def size(link):
+        _, rel, sizes, _ = link
+        declared = [int(value.split('x')[0]) for value in (sizes or '').lower().split() if value.split('x')[0].isdigit()]
+        if declared:
+            return max(declared)
+        return 180 if any(word.startswith('apple-touch-icon') for word in rel) else 0
+    usable = [link for link in links if link[3] != 'image/svg+xml' and not urlsplit(link[0]).path.lower().endswith('.svg')]
+    urls = [urljoin(page_url, link[0]) for link in sorted(usable, key=size, reverse=True)]
+    urls.append(urljoin(page_url, '/favicon.ico'))
+    return [url for url in dict.fromkeys(urls) if url.startswith(('http://', 'https://'))][:MAX_ICON_CANDIDATES]
+
+class HostRateLimit:
+    # Spaces requests to the same host (host:port) at least interval seconds apart, across threads
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next.get(host, now))
+            self._next[host] = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+# Up to limit bytes of a streamed response body
+def _read(response, limit):
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(64 * 1024):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            break
+    return b''.join(chunks)[:limit]
+
+def _decode(response, data):
+    encoding = response.encoding if 'charset' in response.headers.get('Content-Type', '').lower() else 'utf-8'
+    try:
+        return data.decode(encoding or 'utf-8', errors='replace')
+    except LookupError:
+        return data.decode('utf-8', errors='replace')
+
+# Fetch the title and icon of one origin. Runs on the fetch pool inside an app context, but
+# never touches the database.
+def fetch_site(origin, limiter):
+    config = current_app.config
+    allow_private = config['SITE_META_ALLOW_PRIVATE']
+    timeout = config['SITE_META_TIMEOUT']
+    page_url = origin + '/'
+    parser = _HeadParser()
+    try:
+        limiter.wait(page_url)
+        # Redirects are followed hop by hop and each one checked, so a public site cannot point
+        # the fetch (and the title users get to see) at a host on the internal network
+        with fetch_url(page_url, allow_private, headers={'Accept': 'text/html,*/*;q=0.5'}, timeout=timeout) as response:
+            if response.status_code >= 500:
+                SITE_META_FETCHES.inc(result='error')
+                return SiteFetch(origin, None, None, f"HTTP {response.status_code}")
+            # Login pages and 404s still carry a title and icons
+            if 'html' in response.headers.get('Content-Type', ''):
+                parser.feed(_decode(response, _read(response, config['SITE_META_MAX_PAGE_BYTES'])))
+            page_url = response.url
+    except PrivateHostError:
+        SITE_META_FETCHES.inc(result='private')
+        return SiteFetch(origin, None, None, 'PrivateHost')
+    except requests.RequestException as e:
+        SITE_META_FETCHES.inc(result='error')
+        logger.info("Metadata fetch of %s failed: %s", origin, e)
+        return SiteFetch(origin, None, None, type(e).__name__)
+
+    for icon_url in icon_candidates(page_url, parser.icons):
+        try:
+            limiter.wait(icon_url)
+            with fetch_url(icon_url, allow_private, timeout=timeout) as response:
+                if response.status_code != 200:
+                    continue
+                data = _read(response, config['MAX_IMAGE_UPLOAD_BYTES'] + 1)
+            validate_image(data)
+        except (PrivateHostError, requests.RequestException, ImageError) as e:
+            logger.debug("Icon %s of %s not usable: %s", icon_url, origin, e)
+            continue
+        SITE_META_FETCHES.inc(result='fetched')
+        return SiteFetch(origin, parser.title, data, None)
+    SITE_META_FETCHES.inc(result='no_icon')
+    return SiteFetch(origin, parser.title, None, None)
+
+# Copy an origin's title and icon to its bookmarks that do not show them yet, moving the icon
+# references over. Runs in the caller's transaction; returns the number of bookmarks changed.
+def apply_meta(meta):
+    differs = (Bookmark.meta_origin == meta.origin,
+               or_(Bookmark.title.is_distinct_from(meta.title), Bookmark.icon_url.is_distinct_from(meta.icon_url)))
+    rows = db.session.query(Bookmark.user_id, Bookmark.icon_url).filter(*differs).all()
+    if not rows:
+        return 0
+    old_icons = {}
+    for _, icon_url in rows:
+        if icon_url != meta.icon_url:
+            old_icons[icon_url] = old_icons.get(icon_url, 0) + 1
+    for icon_url, count in old_icons.items():
+        release_image(icon_url, count)
+    acquire_image(meta.icon_url, sum(old_icons.values()))
+    Bookmark.query.filter(*differs).update({Bookmark.title: meta.title, Bookmark.icon_url: meta.icon_url},
+                                           synchronize_session=False)
+    bump_bookmarks_version(*{user_id for user_id, _ in rows})
+    return len(rows)
+
+class MetadataFetcher:
+    # Fills in Bookmark.title and icon_url on a schedule, see the top of this module
+
+    def __init__(self, app=None):
+        self.app = None
+        self._thread = None
+        self._last_prune = float('-inf')
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('SITE_META_ENABLED', True)
+        app.config.setdefault('SITE_META_INTERVAL', 300)
+        app.config.setdefault('SITE_META_BATCH_SIZE', 500)
+        app.config.setdefault('SITE_META_FETCHES_PER_CYCLE', 50)
+        app.config.setdefault('SITE_META_WORKERS', 4)
+        app.config.setdefault('SITE_META_HOST_INTERVAL', 1.0)
+        app.config.setdefault('SITE_META_TIMEOUT', 5)
+        app.config.setdefault('SITE_META_RETRY_AFTER', 3600)
+        app.config.setdefault('SITE_META_MAX_PAGE_BYTES', 256 * 1024)
+        app.config.setdefault('SITE_META_ALLOW_PRIVATE', False)
+        app.extensions['site_meta'] = self
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='site-meta', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    # Ask for a cycle now, e.g. after bookmarks were added or their URLs edited
+    def wake(self):
+        if self._thread is not None:
+            self._wake.set()
+        elif self.app.config['SITE_META_ENABLED']:
+            signal_wake('wake_site_meta')
+
+    # Give every bookmark without one its origin ('' when it has no http(s) URL), a batch per
+    # transaction, and copy the metadata of origins fetched before. Returns the number assigned.
+    def assign_pending(self):
+        batch_size = self.app.config['SITE_META_BATCH_SIZE']
+        assigned = 0
+        while True:
+            rows = (db.session.query(Bookmark.id, Bookmark.server_url, Bookmark.domain_url)
+                    .filter(Bookmark.meta_origin.is_(None))
+                    .order_by(Bookmark.id).limit(batch_size).all())
+            if not rows:
+                break
+            by_origin = {}
+            for bookmark_id, server_url, domain_url in rows:
+                by_origin.setdefault(bookmark_origin(server_url, domain_url) or '', []).append(bookmark_id)
+            for origin, ids in by_origin.items():
+                Bookmark.query.filter(Bookmark.id.in_(ids)).update({Bookmark.meta_origin: origin}, synchronize_session=False)
+            for meta in SiteMeta.query.filter(SiteMeta.origin.in_(by_origin), SiteMeta.error.is_(None)):
+                apply_meta(meta)
+            db.session.commit()
+            assigned += len(rows)
+            if len(rows) < batch_size:
+                break
+        return assigned
+
+    # Origins to fetch this cycle: bookmarked ones never fetched, then failed ones due for a retry
+    def due_origins(self):
+        config = self.app.config
+        limit = config['SITE_META_FETCHES_PER_CYCLE']
+        origins = [origin for (origin,) in (db.session.query(Bookmark.meta_origin)
+                                            .outerjoin(SiteMeta, SiteMeta.origin == Bookmark.meta_origin)
+                                            .filter(Bookmark.meta_origin != '', SiteMeta.origin.is_(None))
+                                            .distinct().limit(limit))]
+        if len(origins) < limit:
+            retry_before = _utcnow() - timedelta(seconds=config['SITE_META_RETRY_AFTER'])
+            origins += [origin for (origin,) in (db.session.query(SiteMeta.origin)
+                                                 .filter(SiteMeta.error.isnot(None), SiteMeta.fetched_at < retry_before)
+                                                 .order_by(SiteMeta.fetched_at).limit(limit - len(origins)))]
+        return origins
+
+    # Fetch origins concurrently, rate limited per host
+    def fetch(self, origins):
+        if not origins:
+            return []
+        limiter = HostRateLimit(self.app.config['SITE_META_HOST_INTERVAL'])
+
+        def work(origin):
+            with self.app.app_context():
+                return fetch_site(origin, limiter)
+
+        with ThreadPoolExecutor(max_workers=min(self.app.config['SITE_META_WORKERS'], len(origins)),
+                                thread_name_prefix='site-meta-fetch') as executor:
+            return list(executor.map(work, origins))
+
+    # Save a fetch result and copy it to the origin's bookmarks
+    def store(self, fetched):
+        meta = db.session.get(SiteMeta, fetched.origin) or SiteMeta(origin=fetched.origin)
+        meta.fetched_at = _utcnow()
+        meta.error = fetched.error
+        if fetched.error is None:
+            icon_url = None
+            if fetched.icon is not None:
+                try:
+                    icon_url = store_image(fetched.icon)
+                except ImageError as e:
+                    logger.info("Icon of %s could not be stored: %s", fetched.origin, e)
+            meta.title = fetched.title
+            meta.icon_url = icon_url
+        db.session.add(meta)
+        db.session.flush()
+        if meta.error is None:
+            apply_meta(meta)
+        db.session.commit()
+
+    # Drop metadata of origins no bookmark uses any more; their icons are then left to images gc
+    def forget_unused(self):
+        SiteMeta.query.filter(~exists().where(Bookmark.meta_origin == SiteMeta.origin)).delete(synchronize_session=False)
+        db.session.commit()
+
+    # One cycle; returns (bookmarks assigned, origins fetched)
+    def run_once(self):
+        with self.app.app_context():
+            assigned = self.assign_pending()
+            origins = self.due_origins()
+            db.session.close()  # Do not hold a pooled connection while fetching
+            for fetched in self.fetch(origins):
+                self.store(fetched)
+            if time.monotonic() - self._last_prune > 3600:
+                self.forget_unused()
+                self._last_prune = time.monotonic()
+            return assigned, len(origins)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                assigned, fetched = self.run_once()
+                # A full cycle may mean more origins are waiting, so go again right away
+                if fetched >= self.app.config['SITE_META_FETCHES_PER_CYCLE']:
+                    continue
+            except Exception:
+                logger.exception("Site metadata cycle failed")
+            self._wake.wait(self.app.config['SITE_META_INTERVAL'])
+
+site_meta = MetadataFetcher()
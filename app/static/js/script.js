@@ -91,16 +91,49 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
-    // Check URL status for status dots
-    const statusDots = document.querySelectorAll('.status-dot');
-    statusDots.forEach(dot => {
-        const url = dot.getAttribute('data-url');
-        if (url) {
-            fetch(url, { method: 'HEAD', mode: 'no-cors' })
-                .then(() => dot.classList.add('up'))
-                .catch(() => dot.classList.add('down'));
-        }
-    });
+    // Live status: the page renders with the stored results, then the server pushes changes
+    const statusSection = document.querySelector('[data-status-stream]');
+    if (statusSection && 'EventSource' in window) {
+        const source = new EventSource(statusSection.dataset.statusStream);
+        source.addEventListener('status', event => {
+            const changes = JSON.parse(event.data);
+            document.querySelectorAll('.status-dot[data-url]').forEach(dot => {
+                const status = changes[dot.dataset.url];
+                if (!status) return;
+                dot.classList.remove('unknown', 'up', 'down');
+                dot.classList.add(status.is_up ? 'up' : 'down');
+                let title = String(status.status_code || status.error || 'No response');
+                if (status.latency_ms !== null) title += ` - ${Math.round(status.latency_ms)} ms`;
+                if (status.checked_at) title += ` - checked ${status.checked_at.substring(11, 19)} UTC`;
+                dot.title = title;
+            });
+        });
+    }
+
+    // Infinite scroll: load the next page of bookmarks when the sentinel below the list comes into view
+    const sentinel = document.getElementById('bookmark-sentinel');
+    if (sentinel && 'IntersectionObserver' in window) {
+        const container = document.querySelector('.bookmark-container');
+        const popups = document.getElementById('edit-popups');
+        let loading = false;
+        const observer = new IntersectionObserver(entries => {
+            if (!entries[0].isIntersecting || loading || !sentinel.dataset.cursor) return;
+            loading = true;
+            const url = new URL(sentinel.dataset.api, window.location.origin);
+            url.searchParams.set('cursor', sentinel.dataset.cursor);
+            fetch(url, { headers: { 'Accept': 'application/json' }, credentials: 'same-origin' })
+                .then(response => response.ok ? response.json() : Promise.reject(response.status))
+                .then(page => {
+                    container.insertAdjacentHTML('beforeend', page.html);
+                    popups.insertAdjacentHTML('beforeend', page.popups_html);
+                    sentinel.dataset.cursor = page.next_cursor || '';
+                    if (!page.next_cursor) observer.disconnect();
+                })
+                .catch(error => console.log('Loading more bookmarks failed:', error))
+                .finally(() => { loading = false; });
+        }, { rootMargin: '400px' });
+        observer.observe(sentinel);
+    }
 
     // Add Bookmark popup functionality
     const addBookmarkBtn = document.getElementById('addBookmarkBtn');
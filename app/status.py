@@ -0,0 +1,281 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+import logging
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from .models import db, Bookmark, UrlStatus
+from .database import bump_counter, signal_wake
+from .status_feed import status_feed
+from .history import record_samples, prune_history, forget_history
+from .status_cache import StatusCache
+from .metrics import PROBE_LATENCY, PROBE_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Result of a single probe against a bookmark URL
+ProbeResult = namedtuple('ProbeResult', ['url', 'is_up', 'status_code', 'latency_ms', 'error', 'checked_at'])
+
+# Keep-alive connection pool shared by every probe in this worker process. pool_hosts is the
+# number of hosts that keep a pool, per_host the idle connections kept open to each of them.
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_pool_hosts = 100
+_pool_per_host = 2
+
+def configure_session(pool_hosts=100, per_host=2):
+    global _session, _pool_hosts, _pool_per_host
+    with _session_lock:
+        _pool_hosts = pool_hosts
+        _pool_per_host = per_host
+        _session = None
+
+def get_session():
+    global _session, _session_pid
+    with _session_lock:
+        # Sockets must not be shared with a forked gunicorn worker, so each process builds its own
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=_pool_hosts, pool_maxsize=_pool_per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['User-Agent'] = 'Bookmarks-StatusCheck'
+            _session = session
+            _session_pid = os.getpid()
+        return _session
+
+def probe_url(url, timeout=5):
+    session = get_session()
+    started = time.monotonic()
+    status_code = None
+    error = None
+    try:
+        response = session.head(url, timeout=timeout, allow_redirects=True)
+        status_code = response.status_code
+        if status_code != 200:
+            # Some servers reject HEAD, fall back to a GET but only read the status line;
+            # closing the streamed response means the body is never downloaded
+            with session.get(url, timeout=timeout, allow_redirects=True, stream=True) as response:
+                status_code = response.status_code
+    except requests.RequestException as e:
+        error = type(e).__name__
+        logger.info("Probe of %s failed: %s", url, e)
+        PROBE_ERRORS.inc(error=error)
+    latency_ms = (time.monotonic() - started) * 1000
+    PROBE_LATENCY.observe(latency_ms / 1000, outcome='error' if error else ('up' if status_code == 200 else 'down'))
+    return ProbeResult(url, status_code == 200, status_code, latency_ms, error, datetime.now(timezone.utc).replace(tzinfo=None))
+
+def check_url_status(url, timeout=5):
+    if not url:
+        return False
+    return probe_url(url, timeout=timeout).is_up
+
+def _host_of(url):
+    try:
+        return urlsplit(url).netloc.lower()
+    except ValueError:
+        return url
+
+def _missed_deadline(url):
+    PROBE_ERRORS.inc(error='DeadlineExceeded')
+    return ProbeResult(url, False, None, None, 'DeadlineExceeded', datetime.now(timezone.utc).replace(tzinfo=None))
+
+# Probe many URLs at once: duplicates are removed, probes run on a bounded thread pool with
+# at most per_host concurrent requests against the same host, and the whole batch gives up
+# after deadline seconds. URLs that did not finish in time are reported as down. With a cache,
+# only URLs without a fresh cached result are probed; with refresh as well, every URL is probed
+# and the cache is only updated. Missed deadlines say nothing about the host, so they are never
+# cached (nor count towards its backoff) and store_results skips them.
+def check_urls(urls, timeout=5, deadline=None, max_workers=16, per_host=2, cache=None, refresh=False):
+    unique_urls = list(dict.fromkeys(url for url in urls if url))
+    results = {}
+    if cache is not None and not refresh:
+        for url in unique_urls:
+            cached = cache.get(url)
+            if cached is not None:
+                results[url] = ProbeResult(*cached)
+        unique_urls = [url for url in unique_urls if url not in results]
+    if not unique_urls:
+        return results
+    if deadline is None:
+        deadline = timeout * 2
+    expires = time.monotonic() + deadline
+    host_limits = {}
+    for url in unique_urls:
+        host_limits.setdefault(_host_of(url), threading.BoundedSemaphore(per_host))
+
+    def probe(url):
+        limit = host_limits[_host_of(url)]
+        if not limit.acquire(timeout=max(expires - time.monotonic(), 0)):
+            return _missed_deadline(url)
+        try:
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                return _missed_deadline(url)
+            return probe_url(url, timeout=min(timeout, remaining))
+        finally:
+            limit.release()
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(unique_urls)), thread_name_prefix='status-probe')
+    futures = {executor.submit(probe, url): url for url in unique_urls}
+    done, _ = wait(futures, timeout=deadline)
+    # Do not wait for stragglers; they finish (or time out) in the background
+    executor.shutdown(wait=False, cancel_futures=True)
+    for future, url in futures.items():
+        result = future.result() if future in done else _missed_deadline(url)
+        results[url] = result
+        if cache is not None and result.error != 'DeadlineExceeded':
+            cache.put(result)
+    return results
+
+# Every distinct server/domain URL bookmarked by any user
+def bookmarked_urls():
+    server_urls = db.session.query(Bookmark.server_url).filter(Bookmark.server_url.isnot(None))
+    domain_urls = db.session.query(Bookmark.domain_url).filter(Bookmark.domain_url.isnot(None))
+    return {url for (url,) in server_urls.union(domain_urls) if url}
+
+# Stored status rows for the given URLs, keyed by URL
+def get_statuses(urls):
+    urls = {url for url in urls if url}
+    if not urls:
+        return {}
+    return {row.url: row for row in UrlStatus.query.filter(UrlStatus.url.in_(urls))}
+
+# Save probe results. Rows whose visible state (up/down, status code, error) changed get the
+# next 'url_status' version, which is what the live status streams pick up. Missed deadlines
+# are no probe at all and keep the last stored result.
+def store_results(results):
+    results = [result for result in results if result.error != 'DeadlineExceeded']
+    if not results:
+        return
+    existing = get_statuses(result.url for result in results)
+    changed = []
+    samples = []
+    for result in results:
+        row = existing.get(result.url)
+        if row is None:
+            row = UrlStatus(url=result.url)
+            db.session.add(row)
+        if row.id is None or (row.is_up, row.status_code, row.error) != (result.is_up, result.status_code, result.error):
+            changed.append(row)
+        # Cache hits repeat an earlier probe
+        if result.checked_at != row.checked_at:
+            samples.append((row, result))
+        row.is_up = result.is_up
+        row.status_code = result.status_code
+        row.latency_ms = result.latency_ms
+        row.error = result.error
+        row.checked_at = result.checked_at
+    if changed:
+        version = bump_counter('url_status')
+        for row in changed:
+            row.version = version
+    if samples:
+        db.session.flush()
+        record_samples([(row.id, result) for row, result in samples])
+    db.session.commit()
+    if changed:
+        status_feed.wake()
+
+class HealthChecker:
+    # Probes every bookmarked URL on a schedule so page views only read stored results
+
+    def __init__(self, app=None):
+        self.app = None
+        self.cache = None
+        self._thread = None
+        self._last_prune = float('-inf')
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('STATUS_CHECK_ENABLED', True)
+        app.config.setdefault('STATUS_CHECK_INTERVAL', 60)
+        app.config.setdefault('STATUS_CHECK_TIMEOUT', 5)
+        app.config.setdefault('STATUS_CHECK_DEADLINE', None)
+        app.config.setdefault('STATUS_CHECK_WORKERS', 16)
+        app.config.setdefault('STATUS_CHECK_PER_HOST', 2)
+        app.config.setdefault('STATUS_CHECK_ON_DEMAND', False)
+        app.config.setdefault('STATUS_CACHE_UP_TTL', 60)
+        app.config.setdefault('STATUS_CACHE_DOWN_TTL', 30)
+        app.config.setdefault('STATUS_CACHE_MAX_BACKOFF', 900)
+        app.config.setdefault('STATUS_CACHE_SIZE', 10000)
+        app.config.setdefault('STATUS_CACHE_PATH', None)
+        app.config.setdefault('STATUS_POOL_HOSTS', 100)
+        app.config.setdefault('STATUS_HISTORY_HOURS', 24)
+        configure_session(pool_hosts=app.config['STATUS_POOL_HOSTS'], per_host=app.config['STATUS_CHECK_PER_HOST'])
+        self.cache = StatusCache(
+            up_ttl=app.config['STATUS_CACHE_UP_TTL'],
+            down_ttl=app.config['STATUS_CACHE_DOWN_TTL'],
+            max_backoff=app.config['STATUS_CACHE_MAX_BACKOFF'],
+            max_size=app.config['STATUS_CACHE_SIZE'],
+            path=app.config['STATUS_CACHE_PATH'],
+        )
+        app.extensions['status_checker'] = self
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='status-checker', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    # Ask the checker to run a cycle now, e.g. after a bookmark was added or edited
+    def wake(self):
+        if self._thread is not None:
+            self._wake.set()
+        elif self.app.config['STATUS_CHECK_ENABLED']:
+            signal_wake('wake_status_check')
+
+    # Batch probe using the configured limits
+    def check(self, urls, deadline=None, refresh=False):
+        config = self.app.config
+        return check_urls(
+            urls,
+            timeout=config['STATUS_CHECK_TIMEOUT'],
+            deadline=deadline or config['STATUS_CHECK_DEADLINE'],
+            max_workers=config['STATUS_CHECK_WORKERS'],
+            per_host=config['STATUS_CHECK_PER_HOST'],
+            cache=self.cache,
+            refresh=refresh,
+        )
+
+    def run_once(self):
+        with self.app.app_context():
+            urls = bookmarked_urls()
+            # A scheduled cycle may use the whole interval, not just one page's deadline. It probes
+            # every URL, so each one gets a history sample, and refreshes the cache for page views.
+            results = self.check(urls, deadline=self.app.config['STATUS_CHECK_INTERVAL'], refresh=True)
+            store_results(results.values())
+            # Forget URLs that are no longer bookmarked by anyone, with their history
+            stale = UrlStatus.query.filter(UrlStatus.url.notin_(urls)) if urls else UrlStatus.query
+            forget_history([url_id for (url_id,) in stale.with_entities(UrlStatus.id)])
+            stale.delete(synchronize_session=False)
+            db.session.commit()
+            if time.monotonic() - self._last_prune > 3600:
+                prune_history()
+                self._last_prune = time.monotonic()
+            return len(urls)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Status check cycle failed")
+            self._wake.wait(self.app.config['STATUS_CHECK_INTERVAL'])
+
+status_checker = HealthChecker()
@@ -0,0 +1,169 @@
+from collections import OrderedDict
+from datetime import datetime
+import os
+import sqlite3
+import threading
+import time
+
+# TTL cache in front of the URL prober. Up and down results expire separately, and hosts that
+# keep failing are retried with exponential backoff instead of costing a full timeout each time.
+# Entries are kept in memory by default; give a path to share them between gunicorn workers
+# through a small SQLite file.
+
+class _MemoryStore:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def put(self, url, entry):
+        with self._lock:
+            self._entries[url] = entry
+            self._entries.move_to_end(url)
+            # Drop the least recently used entries once over the bound
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class _SQLiteStore:
+    # Reads refresh an entry's last_used at most this often, so lookups are not all writes
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._local = threading.local()
+        self._writes = 0
+        conn = sqlite3.connect(self.path, timeout=5)
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS status_cache (
+                    url TEXT PRIMARY KEY,
+                    is_up INTEGER NOT NULL,
+                    status_code INTEGER,
+                    latency_ms REAL,
+                    error TEXT,
+                    checked_at TEXT,
+                    expires_at REAL NOT NULL,
+                    failures INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_status_cache_last_used ON status_cache (last_used)')
+        conn.close()
+
+    def _connect(self):
+        # One connection per thread, and never reuse one inherited across a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, url):
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT is_up, status_code, latency_ms, error, checked_at, expires_at, failures, last_used FROM status_cache WHERE url = ?',
+            (url,),
+        ).fetchone()
+        if row is None:
+            return None
+        is_up, status_code, latency_ms, error, checked_at, expires_at, failures, last_used = row
+        now = time.time()
+        if now - last_used > self.TOUCH_INTERVAL:
+            with conn:
+                conn.execute('UPDATE status_cache SET last_used = ? WHERE url = ?', (now, url))
+        checked_at = datetime.fromisoformat(checked_at) if checked_at else None
+        return (url, bool(is_up), status_code, latency_ms, error, checked_at), expires_at, failures
+
+    def put(self, url, entry):
+        (url, is_up, status_code, latency_ms, error, checked_at), expires_at, failures = entry
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO status_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (url, int(is_up), status_code, latency_ms, error,
+                 checked_at.isoformat() if checked_at else None, expires_at, failures, time.time()),
+            )
+            self._writes += 1
+            # Trimming needs a scan, so only do it every so often
+            if self._writes % 100 == 0:
+                conn.execute(
+                    'DELETE FROM status_cache WHERE url IN '
+                    '(SELECT url FROM status_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                    (self.max_size,),
+                )
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM status_cache').fetchone()[0]
+
+    def clear(self):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM status_cache')
+
+
+class StatusCache:
+    def __init__(self, up_ttl=60, down_ttl=30, max_backoff=900, max_size=10000, path=None):
+        self.up_ttl = up_ttl
+        self.down_ttl = down_ttl
+        self.max_backoff = max_backoff
+        self._store = _SQLiteStore(path, max_size) if path else _MemoryStore(max_size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Fields of a fresh cached probe result for url, or None when it has to be probed again
+    def get(self, url):
+        entry = self._store.get(url)
+        fresh = entry is not None and entry[1] > time.time()
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry[0] if fresh else None
+
+    def put(self, result):
+        if result.is_up:
+            failures = 0
+            ttl = self.up_ttl
+        else:
+            previous = self._store.get(result.url)
+            failures = (previous[2] if previous else 0) + 1
+            ttl = min(self.down_ttl * 2 ** (failures - 1), self.max_backoff)
+        self._store.put(result.url, (tuple(result), time.time() + ttl, failures))
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'size': len(self._store),
+        }
+
+    def clear(self):
+        self._store.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
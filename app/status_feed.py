@@ -0,0 +1,113 @@
+import logging
+import os
+import threading
+from .models import UrlStatus
+from .database import counter_value
+
+logger = logging.getLogger(__name__)
+
+# Fans status changes out to the live status streams (Server-Sent Events) of this process.
+# store_results() gives every visible change the next 'url_status' counter value; one poller
+# thread per process watches that counter and loads the changed rows, whichever worker's checker
+# stored them, so any number of open tabs cost one small query per poll and never a probe of
+# their own. Streams then wait on a condition for changes to the URLs they show.
+#
+# Each open stream holds a request thread of its worker, so at most STATUS_STREAM_MAX run per
+# process; the rest are told to reconnect later and the remaining threads stay free for pages.
+
+def status_json(status):
+    if status is None:
+        return None
+    return {
+        'is_up': status.is_up,
+        'status_code': status.status_code,
+        'latency_ms': status.latency_ms,
+        'error': status.error,
+        'checked_at': status.checked_at.isoformat() + 'Z' if status.checked_at else None,
+    }
+
+class StatusFeed:
+    def __init__(self, app=None):
+        self.app = None
+        self.version = 0
+        self._latest = {}  # url -> (version, status json)
+        self._loaded = False
+        self._condition = threading.Condition()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._streams = 0
+        self._streams_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('STATUS_STREAM_ENABLED', True)
+        app.config.setdefault('STATUS_STREAM_POLL', 2)
+        app.config.setdefault('STATUS_STREAM_TIMEOUT', 30)
+        app.config.setdefault('STATUS_STREAM_MAX', 4)
+        app.config.setdefault('STATUS_STREAM_BUSY_RETRY', 30)
+        app.extensions['status_feed'] = self
+
+    # Start the poller on first use, once per process
+    def _ensure_started(self):
+        with self._condition:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name='status-feed', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    # Take a stream slot of this process; False when all STATUS_STREAM_MAX are in use
+    def open_stream(self):
+        with self._streams_lock:
+            if self._streams >= self.app.config['STATUS_STREAM_MAX']:
+                return False
+            self._streams += 1
+            return True
+
+    def close_stream(self):
+        with self._streams_lock:
+            self._streams -= 1
+
+    # Pick up new versions right away, e.g. after this process stored results
+    def wake(self):
+        self._wake.set()
+
+    def poll_once(self):
+        with self.app.app_context():
+            # Read the counter first: every version up to it is committed, later ones are picked up next time
+            latest = counter_value('url_status')
+            if self._loaded and latest == self.version:
+                return
+            rows = UrlStatus.query.filter(UrlStatus.version > (self.version if self._loaded else -1)).all()
+            with self._condition:
+                for row in rows:
+                    self._latest[row.url] = (row.version, status_json(row))
+                self.version = max([latest, self.version] + [row.version for row in rows])
+                self._loaded = True
+                self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                self.poll_once()
+            except Exception:
+                logger.exception("Status feed poll failed")
+            self._wake.wait(self.app.config['STATUS_STREAM_POLL'])
+
+    # Wait up to timeout for statuses of urls newer than version. Returns the feed version and
+    # the changed statuses keyed by URL (empty on timeout).
+    def wait(self, urls, version, timeout):
+        self._ensure_started()
+
+        def changes():
+            return {url: self._latest[url][1] for url in urls if url in self._latest and self._latest[url][0] > version}
+
+        with self._condition:
+            self._condition.wait_for(lambda: self._loaded and changes(), timeout)
+            return self.version, changes() if self._loaded else {}
+
+status_feed = StatusFeed()
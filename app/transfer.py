@@ -0,0 +1,242 @@
+import csv
+from html import escape
+from html.parser import HTMLParser
+import io
+import json
+import re
+from sqlalchemy import and_, insert, or_
+from .models import db, User, Bookmark
+from .images import acquire_image
+from .database import bump_bookmarks_version
+
+# Bulk import and export of bookmarks as browser bookmark HTML (the Netscape format every
+# browser imports and exports), JSON Lines or CSV. Both directions stream: exports read the
+# table in keyset batches and yield text as they go, imports parse the upload incrementally and
+# insert in batches, committing each one so a large import never holds the write lock for long.
+
+FORMATS = {
+    'html': ('text/html', 'html'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+    'csv': ('text/csv', 'csv'),
+}
+FIELDS = ('name', 'server_url', 'domain_url', 'image_url')
+
+_URL_PATTERN = re.compile(r'^https?://[^\s/$.?#].[^\s]*$')
+
+def format_for_filename(filename):
+    ext = (filename or '').rsplit('.', 1)[-1].lower()
+    return {'htm': 'html', 'ndjson': 'jsonl', 'json': 'jsonl'}.get(ext, ext if ext in FORMATS else None)
+
+# Bookmarks in id order, one short query per batch
+def _iter_bookmarks(user_id, batch_size=500):
+    last_id = 0
+    while True:
+        batch = (Bookmark.query.filter(Bookmark.user_id == user_id, Bookmark.id > last_id)
+                 .order_by(Bookmark.id).limit(batch_size).all())
+        if not batch:
+            return
+        for bookmark in batch:
+            yield bookmark
+        last_id = batch[-1].id
+        # Keep the session from accumulating every exported row
+        db.session.expunge_all()
+
+def _csv_line(values):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue()
+
+def _export_line(fmt, bookmark, username):
+    if fmt == 'html':
+        # Browsers open HREF; the extra attributes carry both addresses and the icon
+        href = bookmark.domain_url or bookmark.server_url or ''
+        attributes = ''.join(f' {field.upper()}="{escape(getattr(bookmark, field))}"'
+                             for field in ('server_url', 'domain_url', 'image_url') if getattr(bookmark, field))
+        indent = '        ' if username else '    '
+        return f'{indent}<DT><A HREF="{escape(href)}"{attributes}>{escape(bookmark.name)}</A>\n'
+    if fmt == 'jsonl':
+        record = {field: getattr(bookmark, field) for field in FIELDS}
+        return json.dumps({'user': username, **record} if username else record) + '\n'
+    return _csv_line(((username,) if username else ()) + tuple(getattr(bookmark, field) or '' for field in FIELDS))
+
+# Export as chunks of text. users is a list of (id, username); with with_user the username is
+# written out too (as folders in HTML), so an export of all accounts can be imported back.
+def export_bookmarks(fmt, users, with_user=False):
+    if fmt == 'html':
+        yield ('<!DOCTYPE NETSCAPE-Bookmark-file-1>\n'
+               '<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">\n'
+               '<TITLE>Bookmarks</TITLE>\n<H1>Bookmarks</H1>\n<DL><p>\n')
+    elif fmt == 'csv':
+        yield _csv_line((('user',) if with_user else ()) + FIELDS)
+
+    for user_id, username in users:
+        if fmt == 'html' and with_user:
+            yield f'    <DT><H3>{escape(username)}</H3>\n    <DL><p>\n'
+        lines = []
+        for bookmark in _iter_bookmarks(user_id):
+            lines.append(_export_line(fmt, bookmark, username if with_user else None))
+            if len(lines) >= 200:
+                yield ''.join(lines)
+                lines = []
+        yield ''.join(lines)
+        if fmt == 'html' and with_user:
+            yield '    </DL><p>\n'
+    if fmt == 'html':
+        yield '</DL><p>\n'
+
+class _BookmarkFileParser(HTMLParser):
+    # Collects <A> entries from a Netscape bookmark file; folder <H3> names become the user
+    # for admin imports of several accounts
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self._current = None
+        self._folder = None
+        self._in_folder_name = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name.lower(): value for name, value in attrs}
+        if tag == 'a':
+            href = attrs.get('href') or ''
+            server_url = attrs.get('server_url')
+            domain_url = attrs.get('domain_url')
+            if not server_url and not domain_url:
+                domain_url = href
+            self._current = {'user': self._folder, 'name': '', 'server_url': server_url,
+                             'domain_url': domain_url, 'image_url': attrs.get('image_url') or attrs.get('icon_uri')}
+        elif tag == 'h3':
+            self._in_folder_name = True
+            self._folder = ''
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self._current is not None:
+            self.records.append(self._current)
+            self._current = None
+        elif tag == 'h3':
+            self._in_folder_name = False
+
+    def handle_data(self, data):
+        if self._current is not None:
+            self._current['name'] += data
+        elif self._in_folder_name:
+            self._folder += data
+
+# Records from a text stream, parsed incrementally. Entries that cannot be parsed come out as
+# None, which import_bookmarks() counts as invalid, so a bad line never aborts the import.
+def read_records(stream, fmt):
+    if fmt == 'jsonl':
+        for line in stream:
+            line = line.strip()
+            if line:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                yield record if isinstance(record, dict) else None
+    elif fmt == 'csv':
+        reader = csv.DictReader(stream)
+        while True:
+            try:
+                record = next(reader)
+            except StopIteration:
+                break
+            except csv.Error:
+                record = None  # e.g. a field over csv.field_size_limit(); the reader resumes on the next line
+            yield record
+    else:
+        parser = _BookmarkFileParser()
+        while True:
+            chunk = stream.read(64 * 1024)
+            if not chunk:
+                break
+            parser.feed(chunk)
+            yield from parser.records
+            parser.records = []
+        parser.close()
+        yield from parser.records
+
+# Normalised field values of a record, or None when it cannot be imported
+def _clean(record):
+    if not record:
+        return None
+    values = {}
+    for field in FIELDS:
+        value = record.get(field)
+        values[field] = value.strip() if isinstance(value, str) and value.strip() else None
+    for field in ('server_url', 'domain_url'):
+        if values[field] and (len(values[field]) > 200 or not _URL_PATTERN.match(values[field])):
+            return None  # e.g. javascript: or place: entries in a browser export
+    image_url = values['image_url']
+    if image_url and (len(image_url) > 200 or not (_URL_PATTERN.match(image_url) or image_url.startswith('/static/images/'))):
+        values['image_url'] = None  # Data URIs and the like; the bookmark is still imported
+    values['name'] = values['name'] or values['domain_url'] or values['server_url']
+    if not values['name']:
+        return None
+    values['name'] = values['name'][:120]
+    return values
+
+# Insert records in batches of batch_size, one transaction each. A record is skipped as a
+# duplicate when one of its URLs already belongs to a bookmark of the same user. A record without
+# URLs is skipped when the user already has a URL-less bookmark of that name. When user_id is
+# None, every record must name its user by username, as in an export of all accounts.
+def import_bookmarks(records, user_id=None, batch_size=500):
+    stats = {'imported': 0, 'duplicates': 0, 'invalid': 0}
+    user_ids = {}
+    batch = []
+
+    def resolve(record):
+        if user_id is not None:
+            return user_id
+        username = record.get('user') if record else None
+        if username not in user_ids:
+            user = User.query.filter_by(username=username).first() if username else None
+            user_ids[username] = user.id if user else None
+        return user_ids[username]
+
+    for record in records:
+        owner = resolve(record)
+        values = _clean(record)
+        if values is None or owner is None:
+            stats['invalid'] += 1
+            continue
+        batch.append(dict(values, user_id=owner))
+        if len(batch) >= batch_size:
+            _insert_batch(batch, stats)
+            batch = []
+    if batch:
+        _insert_batch(batch, stats)
+    return stats
+
+# Keys a bookmark is deduplicated on: its URLs, or its name when it has none
+def _dedupe_keys(user_id, name, server_url, domain_url):
+    if server_url or domain_url:
+        return {(user_id, url) for url in (server_url, domain_url) if url}
+    return {(user_id, None, name)}
+
+def _insert_batch(batch, stats):
+    urls = {url for row in batch for url in (row['server_url'], row['domain_url']) if url}
+    names = {row['name'] for row in batch if not row['server_url'] and not row['domain_url']}
+    owners = {row['user_id'] for row in batch}
+    existing = (db.session.query(Bookmark.user_id, Bookmark.name, Bookmark.server_url, Bookmark.domain_url)
+                .filter(Bookmark.user_id.in_(owners),
+                        or_(Bookmark.server_url.in_(urls), Bookmark.domain_url.in_(urls),
+                            and_(Bookmark.name.in_(names), Bookmark.server_url.is_(None), Bookmark.domain_url.is_(None)))))
+    seen = set()
+    for row in existing:
+        seen |= _dedupe_keys(*row)
+    rows = []
+    for row in batch:
+        keys = _dedupe_keys(row['user_id'], row['name'], row['server_url'], row['domain_url'])
+        if keys & seen:
+            stats['duplicates'] += 1
+            continue
+        seen |= keys
+        rows.append(row)
+    if rows:
+        db.session.execute(insert(Bookmark), rows)
+        for row in rows:
+            acquire_image(row['image_url'])
+        bump_bookmarks_version(*{row['user_id'] for row in rows})
+    db.session.commit()
+    stats['imported'] += len(rows)
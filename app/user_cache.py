@@ -0,0 +1,78 @@
+from collections import OrderedDict
+import threading
+import time
+from flask_login import UserMixin
+from .models import db, User
+
+# Cache for the user fields that the layout and routes read on every request, so Flask-Login's
+# user loader does not query the database for each page view. Routes that change one of these
+# fields call invalidate() after committing. Entries also expire after USER_CACHE_TTL seconds,
+# which limits how long another gunicorn worker can keep a stale copy (e.g. after a role change).
+# Setting USER_CACHE_TTL to 0 turns the cache off.
+
+SESSION_FIELDS = ('id', 'username', 'role', 'status', 'theme', 'real_name')
+
+class SessionUser(UserMixin):
+    # Read-only stand-in for User as current_user. Routes that change the account (or need the
+    # email or password hash) load the User row themselves.
+
+    def __init__(self, fields):
+        for name in SESSION_FIELDS:
+            setattr(self, name, fields[name])
+
+class UserCache:
+    def __init__(self, app=None):
+        self.app = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('USER_CACHE_TTL', 60)
+        app.config.setdefault('USER_CACHE_SIZE', 10000)
+        app.extensions['user_cache'] = self
+
+    # Session fields of a user as a SessionUser, or None when the account no longer exists
+    def get(self, user_id):
+        config = self.app.config
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return SessionUser(entry[0])
+            self.misses += 1
+            generation = self._generation
+
+        columns = [getattr(User, name) for name in SESSION_FIELDS]
+        row = db.session.query(*columns).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        fields = row._asdict()
+        if config['USER_CACHE_TTL'] > 0:
+            with self._lock:
+                # Skip the store if an invalidation happened while we were reading the row
+                if generation == self._generation:
+                    self._entries[user_id] = (fields, time.monotonic() + config['USER_CACHE_TTL'])
+                    self._entries.move_to_end(user_id)
+                    while len(self._entries) > config['USER_CACHE_SIZE']:
+                        self._entries.popitem(last=False)
+        return SessionUser(fields)
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+user_cache = UserCache()
@@ -0,0 +1,124 @@
+# Micro-benchmark: the old f-string email builders versus the compiled Jinja templates in
+# app/emails.py, one message at a time and through the bulk render_emails() API.
+#
+#   python -m benchmarks.bench_email_render --messages 2000
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.emails import approval_email, render_emails
+
+
+# The builders as they were before the move to templates (without escaping), kept for comparison
+def legacy_generate_email_html(subject, body_content):
+    return f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <title>{subject}</title>
+    </head>
+    <body style="font-family: Arial, sans-serif; background-color: #f4f4f4; margin: 0; padding: 0;">
+        <table width="100%" cellpadding="0" cellspacing="0" style="background-color: #f4f4f4; padding: 20px;">
+            <tr>
+                <td align="center">
+                    <table width="600px" cellpadding="0" cellspacing="0" style="background-color: #ffffff; border-radius: 8px; box-shadow: 0 2px 4px rgba(0,0,0,0.1);">
+                        <tr>
+                            <td style="background-color: #1b263b; color: #00ffff; text-align: center; padding: 20px; border-top-left-radius: 8px; border-top-right-radius: 8px;">
+                                <h1 style="margin: 0; font-size: 24px; text-shadow: 0 0 5px rgba(0, 255, 255, 0.5);">{subject}</h1>
+                            </td>
+                        </tr>
+                        <tr>
+                            <td style="padding: 20px; color: #333333; line-height: 1.6;">
+                                <div style="background-color: #f9f9f9; border: 1px solid #00ffff; border-radius: 5px; padding: 15px; box-shadow: 0 0 10px rgba(0, 255, 255, 0.1);">
+                                    {body_content}
+                                </div>
+                            </td>
+                        </tr>
+                        <tr>
+                            <td style="text-align: center; padding: 10px; color: #777777; font-size: 12px; border-bottom-left-radius: 8px; border-bottom-right-radius: 8px;">
+                                <p style="margin: 0;">© 2025 Bookmarks. All rights reserved. 
+                                <!-- Optional: Add Privacy Policy link if your email client supports it -->
+                                <!-- <a href="https://yourdomain.com/privacy-policy" style="color: #00ffff; text-decoration: none;">Privacy Policy</a> -->
+                                </p>
+                            </td>
+                        </tr>
+                    </table>
+                </td>
+            </tr>
+        </table>
+    </body>
+    </html>
+    """
+
+
+def legacy_registration_email(name):
+    body = f"""
+    <p>Hello {name},</p>
+    <p>Thank you for registering! Your account is pending approval.</p>
+    <p>Thank you,<br>Management</p>
+    """
+    return legacy_generate_email_html("Registration Confirmation", body)
+
+
+def legacy_approval_email(name, username):
+    body = f"""
+    <p>Hello {name},</p>
+    <p>Thank you for registering! Your account has been approved! You may login now.</p>
+    <p><strong>Username:</strong> {username}</p>
+    <p>Thank you,<br>Management</p>
+    """
+    return legacy_generate_email_html("Account Approved", body)
+
+
+def legacy_password_reset_email(name, username, temp_password="ChangeMe123@"):
+    body = f"""
+    <p>Hello {name},</p>
+    <p>Your password has been reset. Below is your new information, please update your password in your profile section within 24 hours!</p>
+    <p><strong>Username:</strong> {username}</p>
+    <p><strong>Password:</strong> {temp_password}</p>
+    <p>Thank you,<br>Management</p>
+    """
+    return legacy_generate_email_html("Password Reset", body)
+
+
+def legacy_account_info_change_email(name, changes):
+    body_lines = [f"<p>Hello {name},</p>", "<p>Your account information has been updated.</p>"]
+    if "name" in changes:
+        body_lines.append(f"<p><strong>Name:</strong> {changes['name']}</p>")
+    if "email" in changes:
+        body_lines.append(f"<p><strong>Email:</strong> {changes['email']}</p>")
+    if "username" in changes:
+        body_lines.append(f"<p><strong>Username:</strong> {changes['username']}</p>")
+    if "password" in changes:
+        body_lines.append(f"<p><strong>Password:</strong> changed</p>")
+    body_lines.append("<p>Thank you,<br>Management</p>")
+    body = "".join(body_lines)
+    return legacy_generate_email_html("Account Information Updated", body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark email rendering')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    users = [(f'User {i}', f'user{i}') for i in range(args.messages)]
+    contexts = [{'name': name, 'username': username} for name, username in users]
+
+    cases = [
+        ('f-string approval_email', lambda: [legacy_approval_email(name, username) for name, username in users]),
+        ('jinja approval_email', lambda: [approval_email(name, username) for name, username in users]),
+        ('jinja render_emails (bulk)', lambda: render_emails('approval.html', 'Account Approved', contexts)),
+    ]
+    print(f'{args.messages} messages, best of {args.repeat}')
+    for label, case in cases:
+        best = min(timeit.repeat(case, number=1, repeat=args.repeat))
+        print(f'{label:28} {best * 1000:8.1f} ms  {best / args.messages * 1e6:6.1f} us/message')
+
+
+if __name__ == '__main__':
+    main()
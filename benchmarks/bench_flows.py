@@ -0,0 +1,359 @@
+# Load test of the main user flows: login, the bookmark listing and its JSON pages, search,
+# add (with an image upload), edit and delete, plus an admin approving pending accounts. The
+# database is seeded with --users accounts of --bookmarks bookmarks each, whose URLs point at
+# local stub hosts (fast, slow, failing, hanging and refusing), and mail goes to a local SMTP
+# stub, so nothing leaves the machine. Reports p50/p95/p99 latency per flow and throughput.
+#
+#   python -m benchmarks.bench_flows --users 50 --bookmarks 200 --concurrency 8
+#   python -m benchmarks.bench_flows --gunicorn 4 --threads 8 --json after.json --compare before.json
+import argparse
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stub_server import StubHTTPServer, BlackholeServer, refused_url
+from benchmarks.stub_smtp import StubSMTPServer
+
+PASSWORD = 'benchmark-password'
+
+# Response status each flow must return to count as a success
+EXPECTED = {
+    'login': 302,
+    'list': 200,
+    'api_page': 200,
+    'add': 302,
+    'search': 200,
+    'edit': 302,
+    'delete': 302,
+    'admin_panel': 200,
+    'approve': 200,
+}
+
+
+class InProcessClient:
+    # Drives the app through Flask's test client, without a network hop
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None, upload=None):
+        if upload:
+            field, filename, content = upload
+            data = dict(data, **{field: (io.BytesIO(content), filename)})
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.get_data()
+
+
+class HttpClient:
+    # Drives a running server over HTTP, one keep-alive session per virtual user
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def request(self, method, path, data=None, upload=None):
+        files = {upload[0]: (upload[1], upload[2], 'image/png')} if upload else None
+        response = self.session.request(method, self.base_url + path, data=data, files=files, allow_redirects=False)
+        return response.status_code, response.content
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def call(self, client, flow, method, path, data=None, upload=None, record=True):
+        started = time.perf_counter()
+        try:
+            status, body = client.request(method, path, data, upload)
+        except requests.RequestException:
+            status, body = None, b''
+        elapsed = time.perf_counter() - started
+        if record:
+            with self.lock:
+                self.latencies.setdefault(flow, []).append(elapsed)
+                if status != EXPECTED[flow]:
+                    self.errors[flow] = self.errors.get(flow, 0) + 1
+        return status, body
+
+
+def tile_png():
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new('RGB', (256, 256), (0, 200, 255)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def bench_env(workdir, stub, blackhole, refused, smtp):
+    return {
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'SECRET_KEY': 'benchmark',  # Shared by all gunicorn workers, so sessions work whichever one answers
+        'MAIL_SERVER': '127.0.0.1',
+        'MAIL_PORT': str(smtp.port),
+        'MAIL_USERNAME': 'bench@example.com',
+        'MAIL_QUEUE_INTERVAL': '5',
+        'STATUS_CHECK_INTERVAL': '10',
+        'STATUS_CHECK_TIMEOUT': '1',
+        'SITE_META_TIMEOUT': '1',
+        'SITE_META_ALLOW_PRIVATE': 'true',  # The stub hosts are on loopback
+        'LOG_LEVEL': 'WARNING',
+    }
+
+
+# Uploads land in the app's real upload folder; remove the tiles made from the benchmark image
+# (only the seeded database references them)
+def remove_uploads(app):
+    from app.models import ImageBlob
+    with app.app_context():
+        for blob in ImageBlob.query:
+            tile_path = os.path.join(app.config['UPLOAD_FOLDER'], os.path.relpath(blob.url, '/static/images'))
+            base, ext = tile_path.rsplit('.', 1)
+            for path in (tile_path, f'{base}@2x.{ext}'):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def url_targets(stub, blackhole, refused):
+    return [
+        f'{stub.base_url}/fast',
+        f'{stub.base_url}/fast/nas',
+        f'{stub.base_url}/slow',
+        f'{stub.base_url}/error',
+        f'{blackhole.base_url}/',
+        f'{refused}/',
+    ]
+
+
+# Approved users (the first one an admin) with their bookmarks, and pending accounts for the
+# admin to approve. Returns (usernames of approved users, ids of pending users).
+def seed(app, users, bookmarks, pending, targets):
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+    from app.models import db, User, Bookmark
+
+    password = generate_password_hash(PASSWORD)  # Hashing once keeps seeding fast
+    with app.app_context():
+        db.session.execute(insert(User), [{
+            'username': f'bench{i}', 'password': password, 'real_name': f'Bench User {i}',
+            'email': f'bench{i}@example.com', 'role': 'admin' if i == 0 else 'user', 'status': 'approved',
+        } for i in range(users)] + [{
+            'username': f'pending{i}', 'password': password, 'email': f'pending{i}@example.com', 'status': 'pending',
+        } for i in range(pending)])
+        user_ids = dict(db.session.query(User.username, User.id))
+        rows = []
+        for i in range(users):
+            for j in range(bookmarks):
+                rows.append({
+                    'user_id': user_ids[f'bench{i}'],
+                    'name': f'Service {j:05d}',
+                    'server_url': targets[j % len(targets)],
+                    'domain_url': targets[(j * 7 + 3) % len(targets)] + f'?b={j}',
+                })
+                if len(rows) >= 5000:
+                    db.session.execute(insert(Bookmark), rows)
+                    rows = []
+        if rows:
+            db.session.execute(insert(Bookmark), rows)
+        db.session.commit()
+    return [f'bench{i}' for i in range(users)], [user_ids[f'pending{i}'] for i in range(pending)]
+
+
+def user_flow(client, recorder, username, index, iterations, warmup, png, stub_url):
+    for iteration in range(warmup + iterations):
+        record = iteration >= warmup
+
+        def call(*args, **kwargs):
+            return recorder.call(client, *args, record=record, **kwargs)
+
+        call('login', 'POST', '/login', {'username': username, 'password': PASSWORD})
+        call('list', 'GET', '/')
+        status, body = call('api_page', 'GET', '/api/bookmarks?sort=status')
+        if status == 200:
+            cursor = json.loads(body).get('next_cursor')
+            if cursor:
+                call('api_page', 'GET', f'/api/bookmarks?sort=status&cursor={cursor}')
+
+        name = f'Bench add {index}-{iteration}'
+        call('add', 'POST', '/', {
+            'add_bookmark': '1', 'name': name, 'server_url': f'{stub_url}/fast', 'domain_url': f'{stub_url}/fast/{index}',
+        }, upload=('image_upload', 'tile.png', png))
+        status, body = call('search', 'GET', f'/api/bookmarks?q={requests.utils.quote(name)}&limit=1')
+        found = json.loads(body)['bookmarks'] if status == 200 else []
+        if not found:
+            continue
+        bookmark_id = found[0]['id']
+        call('edit', 'POST', '/', {
+            'edit_bookmark': '1', 'bookmark_id': bookmark_id, 'name': name + ' (edited)', 'server_url': f'{stub_url}/slow',
+            'domain_url': '', 'image_link': '',
+        })
+        call('delete', 'GET', f'/?delete={bookmark_id}')
+
+
+def admin_flow(client, recorder, pending_ids, iterations):
+    recorder.call(client, 'login', 'POST', '/login', {'username': 'bench0', 'password': PASSWORD})
+    for i in range(iterations):
+        recorder.call(client, 'admin_panel', 'GET', '/admin_panel')
+        if i < len(pending_ids):
+            recorder.call(client, 'approve', 'POST', '/admin_panel', {'approve': str(pending_ids[i])})
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a sorted list
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+
+def summarize(recorder, elapsed):
+    summary = {}
+    for flow, values in sorted(recorder.latencies.items()):
+        values = sorted(values)
+        summary[flow] = {
+            'requests': len(values),
+            'errors': recorder.errors.get(flow, 0),
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p95_ms': percentile(values, 0.95) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000,
+            'max_ms': values[-1] * 1000,
+            'rps': len(values) / elapsed,
+        }
+    total = sum(entry['requests'] for entry in summary.values())
+    summary['total'] = {'requests': total, 'errors': sum(recorder.errors.values()), 'rps': total / elapsed, 'seconds': elapsed}
+    return summary
+
+
+def report(summary, baseline=None):
+    print(f"{'flow':12} {'requests':>8} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'req/s':>8}"
+          + ('  p95 vs baseline' if baseline else ''))
+    for flow, entry in summary.items():
+        if flow == 'total':
+            continue
+        line = (f"{flow:12} {entry['requests']:8} {entry['errors']:6} {entry['p50_ms']:8.1f} {entry['p95_ms']:8.1f} "
+                f"{entry['p99_ms']:8.1f} {entry['max_ms']:8.1f} {entry['rps']:8.1f}")
+        if baseline and flow in baseline:
+            line += f"  {entry['p95_ms'] / baseline[flow]['p95_ms']:6.2f}x"
+        print(line)
+    total = summary['total']
+    print(f"total: {total['requests']} requests, {total['errors']} errors in {total['seconds']:.1f}s, {total['rps']:.1f} req/s")
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_gunicorn(env, workers, threads):
+    port = free_port()
+    process = subprocess.Popen(
+        ['gunicorn', '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--worker-class', 'gthread',
+         '--threads', str(threads), 'run:app'],
+        cwd=ROOT, env=env)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f'gunicorn exited with status {process.returncode}')
+        try:
+            if requests.get(base_url + '/login', timeout=1).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit('gunicorn did not start within 60s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the main user flows')
+    parser.add_argument('--users', type=int, default=20, help='Approved accounts to seed')
+    parser.add_argument('--bookmarks', type=int, default=200, help='Bookmarks per seeded account')
+    parser.add_argument('--pending', type=int, default=50, help='Pending accounts for the admin to approve')
+    parser.add_argument('--concurrency', type=int, default=8, help='Virtual users running the flows at once')
+    parser.add_argument('--iterations', type=int, default=5, help='Flow iterations per virtual user')
+    parser.add_argument('--warmup', type=int, default=1, help='Iterations per virtual user left out of the results')
+    parser.add_argument('--gunicorn', type=int, metavar='WORKERS', help='Serve with this many gunicorn workers instead of in-process')
+    parser.add_argument('--threads', type=int, default=8, help='Threads per gunicorn worker')
+    parser.add_argument('--slow-delay', type=float, default=0.5)
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--compare', help='Results file of an earlier run to compare p95 latencies with')
+    parser.add_argument('--keep', action='store_true', help='Keep the seeded database')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bookmarks-bench-')
+    with StubHTTPServer(slow_delay=args.slow_delay) as stub, BlackholeServer() as blackhole, StubSMTPServer() as smtp:
+        refused = refused_url()
+        env = bench_env(workdir, stub, blackhole, refused, smtp)
+        process = None
+        app = None
+        try:
+            if args.gunicorn:
+                # Seed from this process with the background jobs off; the workers run them
+                os.environ.update(env, STATUS_CHECK_ENABLED='false', MAIL_QUEUE_ENABLED='false', SITE_META_ENABLED='false')
+            else:
+                os.environ.update(env)
+            from app import create_app
+            app = create_app()
+            started = time.perf_counter()
+            usernames, pending_ids = seed(app, args.users, args.bookmarks, args.pending, url_targets(stub, blackhole, refused))
+            print(f'seeded {len(usernames)} users x {args.bookmarks} bookmarks and {len(pending_ids)} pending '
+                  f'accounts in {time.perf_counter() - started:.1f}s')
+
+            if args.gunicorn:
+                process, base_url = start_gunicorn(dict(os.environ, **env, STATUS_CHECK_ENABLED='true', MAIL_QUEUE_ENABLED='true', SITE_META_ENABLED='true'),
+                                                   args.gunicorn, args.threads)
+                make_client = lambda: HttpClient(base_url)
+                print(f'gunicorn: {args.gunicorn} workers x {args.threads} threads at {base_url}')
+            else:
+                make_client = lambda: InProcessClient(app)
+                print('in-process (Flask test client)')
+
+            recorder = Recorder()
+            png = tile_png()
+            accounts = usernames[1:] or usernames  # Virtual users log in as the regular accounts in turn
+            threads = [threading.Thread(target=user_flow, args=(
+                make_client(), recorder, accounts[i % len(accounts)], i, args.iterations, args.warmup, png, stub.base_url))
+                for i in range(args.concurrency)]
+            threads.append(threading.Thread(target=admin_flow, args=(
+                make_client(), recorder, pending_ids, args.iterations * 2)))
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+
+            summary = summarize(recorder, elapsed)
+            baseline = None
+            if args.compare:
+                with open(args.compare) as f:
+                    baseline = json.load(f)['results']
+            report(summary, baseline)
+            print(f'{len(smtp.messages)} emails reached the SMTP stub')
+            if args.json:
+                with open(args.json, 'w') as f:
+                    json.dump({'args': vars(args), 'results': summary}, f, indent=2)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait(timeout=30)
+            if app is not None:
+                remove_uploads(app)
+            if args.keep:
+                print(f'database kept in {workdir}')
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# Serial check_url_status (two probes per bookmark, as the bookmarks view used to do)
+# versus one deduplicated, concurrent check_urls batch.
+#
+#   python -m benchmarks.bench_status --bookmarks 40 --timeout 1
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.status import check_url_status, check_urls
+from benchmarks.stub_server import StubHTTPServer, BlackholeServer, refused_url
+
+
+def build_bookmarks(count, stub, blackhole, refused):
+    # Many users bookmark the same few hosts, so URLs repeat a lot
+    targets = [
+        f'{stub.base_url}/fast',
+        f'{stub.base_url}/fast/nas',
+        f'{stub.base_url}/slow',
+        f'{stub.base_url}/error',
+        f'{blackhole.base_url}/',
+        f'{refused}/',
+    ]
+    bookmarks = []
+    for i in range(count):
+        server_url = targets[i % len(targets)]
+        domain_url = targets[(i * 7 + 3) % len(targets)]
+        bookmarks.append((server_url, domain_url))
+    return bookmarks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark serial vs batched URL status checks')
+    parser.add_argument('--bookmarks', type=int, default=40)
+    parser.add_argument('--timeout', type=float, default=1.0)
+    parser.add_argument('--slow-delay', type=float, default=0.5)
+    parser.add_argument('--skip-serial', action='store_true', help='Only run the batch prober')
+    args = parser.parse_args()
+
+    with StubHTTPServer(slow_delay=args.slow_delay) as stub, BlackholeServer() as blackhole:
+        bookmarks = build_bookmarks(args.bookmarks, stub, blackhole, refused_url())
+        urls = [url for pair in bookmarks for url in pair]
+        print(f'{len(bookmarks)} bookmarks, {len(urls)} URLs, {len(set(urls))} distinct, timeout {args.timeout}s')
+
+        if not args.skip_serial:
+            started = time.perf_counter()
+            serial_up = sum(check_url_status(url, timeout=args.timeout) for url in urls)
+            serial = time.perf_counter() - started
+            print(f'serial check_url_status: {serial:8.2f}s  ({serial_up} up)')
+
+        started = time.perf_counter()
+        results = check_urls(urls, timeout=args.timeout, deadline=args.timeout * 2)
+        batch = time.perf_counter() - started
+        batch_up = sum(results[url].is_up for url in urls)
+        print(f'batch check_urls:        {batch:8.2f}s  ({batch_up} up)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# Local stand-ins for the hosts users bookmark, so benchmarks never touch the network
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import socket
+import struct
+import threading
+import time
+import zlib
+
+
+def png_icon(size=32, rgb=(40, 120, 200)):
+    # A solid square PNG, built without an imaging library
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    rows = b''.join(b'\x00' + bytes(rgb) * size for _ in range(size))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # /fast answers immediately, /slow waits slow_delay seconds, /error always returns 500.
+    # Pages link /icon.png as their favicon; hits counts the requests per path.
+    slow_delay = 0.5
+    hits = Counter()
+    icon = png_icon()
+
+    def _respond(self, with_body):
+        self.hits[self.path] += 1
+        if self.path.startswith('/slow'):
+            time.sleep(self.slow_delay)
+        status = 500 if self.path.startswith('/error') else 200
+        content_type = 'text/html'
+        body = b'<html><head><title>Stub</title><link rel="icon" href="/icon.png"></head><body>ok</body></html>'
+        if self.path in ('/icon.png', '/favicon.ico'):
+            content_type, body = 'image/png', self.icon
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubHTTPServer:
+    def __init__(self, slow_delay=0.5):
+        handler = type('Handler', (StubHandler,), {'slow_delay': slow_delay, 'hits': Counter()})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    @property
+    def hits(self):
+        return self.server.RequestHandlerClass.hits
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class BlackholeServer:
+    # Accepts TCP connections but never answers, like a host that hangs until the client times out
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1024)
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.sock.getsockname()[1]}'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.sock.close()
+
+
+def refused_url():
+    # A port nobody listens on, so connections are refused immediately
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return f'http://127.0.0.1:{port}'
@@ -0,0 +1,83 @@
+# Minimal local SMTP server standing in for the real mail relay. It accepts every message and
+# keeps them in memory; delay makes each command slow, like a distant or overloaded relay, and
+# addresses in reject are refused at RCPT like unknown mailboxes.
+import socketserver
+import threading
+import time
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 stub ESMTP')
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO'):
+                self.reply('250 stub')
+            elif verb == 'MAIL':
+                sender, recipients = command[10:], []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipient = command[8:].strip('<>')
+                if recipient in self.server.reject:
+                    self.reply('550 No such user here')
+                    continue
+                recipients.append(recipient)
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(line)
+                with self.server.lock:
+                    self.server.messages.append((sender, recipients, b''.join(data)))
+                self.reply('250 OK queued')
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, delay=0.0, reject=()):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.delay = delay
+        self.reject = set(reject)
+        self.messages = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,47 @@
+# Gunicorn settings for production. Gunicorn reads this file from the working directory, so
+# `gunicorn run:app` is enough; every setting can be overridden from the environment.
+import multiprocessing
+import os
+import secrets
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Requests spend most of their time waiting on the database, outbound probes and SMTP, so each
+# worker serves many at once from a thread pool. Workers are sized from the CPU count; the sync
+# worker (GUNICORN_WORKER_CLASS=sync) needs the classic 2 x CPUs + 1 since it handles one request
+# at a time. Greenlet workers (gevent, eventlet) are not supported.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * (2 if worker_class == 'sync' else 1) + 1))
+# Live status streams hold a thread each for up to STATUS_STREAM_TIMEOUT seconds; a worker keeps
+# at most STATUS_STREAM_MAX of them open (half its threads unless set) and turns the rest away.
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+accesslog = os.getenv('GUNICORN_ACCESS_LOG')  # '-' for stdout
+
+# Build the app once in the master and fork it, so workers start instantly and share its memory
+preload_app = os.getenv('GUNICORN_PRELOAD', 'True').lower() == 'true'
+
+# Sessions and signed image URLs must verify in every worker, so without SECRET_KEY the master
+# makes one for all of them, preloaded or not. It changes on restart and logs everyone out: set
+# SECRET_KEY in production.
+if not os.getenv('SECRET_KEY'):
+    os.environ['SECRET_KEY'] = secrets.token_hex(32)
+
+# Health checks, the mail queue and site metadata are started after forking, in a single worker (see background.py)
+os.environ.setdefault('BACKGROUND_JOBS_AT_STARTUP', 'false')
+
+def post_fork(server, worker):
+    if not server.cfg.preload_app:
+        return
+    from app.models import db
+    flask_app = worker.app.wsgi()
+    with flask_app.app_context():
+        # Pooled connections opened in the master (e.g. by migrations) must not be used by two
+        # processes; drop them without closing the master's sockets
+        db.engine.dispose(close=False)
+
+def post_worker_init(worker):
+    from app.background import start_background_jobs
+    start_background_jobs(worker.wsgi)
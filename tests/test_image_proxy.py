@@ -0,0 +1,113 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+import threading
+import pytest
+from flask import Flask
+from PIL import Image
+from app import image_proxy
+from app.image_proxy import fetch_image, load_token
+
+# The image proxy against a local stub HTTP server. Loopback is a private address, so tests that
+# fetch allow private hosts; the SSRF tests turn that off again.
+
+def _jpeg(size=(64, 64)):
+    buffer = BytesIO()
+    Image.effect_noise(size, 60).convert('RGB').save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.hits.append(self.path)
+        if self.path == '/hop':
+            self.send_response(302)
+            self.send_header('Location', f'http://localhost:{self.server.server_port}/logo.jpg')
+            self.end_headers()
+            return
+        body = self.server.bodies.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    server.hits = []
+    server.bodies = {'/logo.jpg': _jpeg(), '/big.jpg': _jpeg((800, 800)), '/truncated.jpg': _jpeg((800, 800))[:3000]}
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.config.update(
+        SECRET_KEY='test',
+        IMAGE_PROXY_ENABLED=True,
+        IMAGE_PROXY_CACHE_DIR=str(tmp_path),
+        IMAGE_PROXY_MAX_BYTES=10 * 1024 * 1024,
+        IMAGE_PROXY_TTL=3600,
+        IMAGE_PROXY_TIMEOUT=5,
+        IMAGE_PROXY_ALLOW_PRIVATE=True,
+        MAX_IMAGE_UPLOAD_BYTES=100 * 1024,
+        IMAGE_TILE_SIZE=64,
+    )
+    with app.app_context():
+        yield app
+
+def test_token_signature_is_checked(app):
+    token = image_proxy._serializer().dumps('http://example.com/logo.png')
+    assert load_token(token) == 'http://example.com/logo.png'
+    assert load_token(token[:-2] + ('AA' if not token.endswith('AA') else 'BB')) is None
+    app.config['SECRET_KEY'] = 'other'
+    assert load_token(token) is None
+
+def test_second_request_is_served_from_cache(app, stub):
+    first = fetch_image(f'{stub.url}/logo.jpg')
+    second = fetch_image(f'{stub.url}/logo.jpg')
+    assert not first.redirect and first.mimetype.startswith('image/')
+    assert second == first
+    assert stub.hits == ['/logo.jpg']
+
+def test_private_hosts_are_not_fetched(app, stub):
+    app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = False
+    assert fetch_image(f'{stub.url}/logo.jpg').redirect
+    assert stub.hits == []
+
+# DNS answering with a public address but the connection landing on a private one (rebinding)
+def test_connection_to_private_address_is_refused(app, stub, monkeypatch):
+    app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = False
+    monkeypatch.setattr(image_proxy, 'is_private_host', lambda url: False)
+    assert fetch_image(f'{stub.url}/logo.jpg') is None
+    assert stub.hits == []
+
+# A public URL redirecting into the private network: every hop is checked, not just the first
+def test_redirect_to_private_host_is_not_followed(app, stub, monkeypatch):
+    app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = False
+    monkeypatch.setattr(image_proxy, 'is_private_host', lambda url: url.startswith('http://localhost'))
+    monkeypatch.setattr(image_proxy, '_get_public_session', image_proxy.get_session)
+    assert fetch_image(f'{stub.url}/hop').redirect
+    assert stub.hits == ['/hop']
+
+def test_oversized_image_is_passed_through(app, stub):
+    assert len(stub.bodies['/big.jpg']) > app.config['MAX_IMAGE_UPLOAD_BYTES']
+    assert fetch_image(f'{stub.url}/big.jpg').redirect
+    assert fetch_image(f'{stub.url}/big.jpg').redirect
+    assert stub.hits == ['/big.jpg']
+
+# The header parses but the pixel data is cut short; the failure is cached like any passthrough
+def test_truncated_image_is_passed_through(app, stub):
+    assert fetch_image(f'{stub.url}/truncated.jpg').redirect
+    assert fetch_image(f'{stub.url}/truncated.jpg').redirect
+    assert stub.hits == ['/truncated.jpg']
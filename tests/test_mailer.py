@@ -0,0 +1,74 @@
+from datetime import datetime, timezone
+import pytest
+from benchmarks.stub_smtp import StubSMTPServer
+from benchmarks.stub_server import refused_url
+from app.mailer import mail, mail_queue, queue_email, claim_messages, deliver
+from app.migrations import upgrade
+from app.models import db, MailMessage
+
+# Delivery against a local stand-in SMTP server that refuses one mailbox
+
+BOUNCE = 'bounce@example.com'
+
+@pytest.fixture
+def smtp():
+    with StubSMTPServer(reject={BOUNCE}) as server:
+        yield server
+
+def _use_server(app, port):
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_DEFAULT_SENDER='noreply@example.com')
+    mail.init_app(app)
+
+@pytest.fixture
+def app(database, smtp):
+    database.config['MAIL_TIMEOUT'] = 5
+    _use_server(database, smtp.port)
+    mail_queue.init_app(database)
+    upgrade()
+    return database
+
+def _queue(*recipients):
+    messages = [queue_email(f'Hello {recipient}', [recipient], '<p>Hi</p>', commit=False) for recipient in recipients]
+    claim_messages(messages)
+    db.session.commit()
+    return messages
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def test_batch_goes_out_over_one_connection(app, smtp):
+    messages = _queue('a@example.com', 'b@example.com', 'c@example.com')
+    report = deliver(messages)
+    db.session.commit()
+    assert smtp.connections == 1
+    assert [recipients for _, recipients, _ in smtp.messages] == [['a@example.com'], ['b@example.com'], ['c@example.com']]
+    assert [entry['status'] for entry in report] == ['sent'] * 3
+    assert {(m.status, m.attempts) for m in MailMessage.query} == {('sent', 1)}
+
+def test_rejected_recipient_is_recorded_per_message(app, smtp):
+    messages = _queue('a@example.com', BOUNCE, 'c@example.com')
+    report = deliver(messages)
+    db.session.commit()
+    assert smtp.connections == 1
+    assert [recipients for _, recipients, _ in smtp.messages] == [['a@example.com'], ['c@example.com']]
+    assert [(entry['status'], entry['error'] is None) for entry in report] == [('sent', True), ('queued', False), ('sent', True)]
+    bounced = MailMessage.query.filter_by(recipients=BOUNCE).one()
+    assert bounced.status == 'queued' and bounced.attempts == 1
+    assert '550' in bounced.last_error
+    assert bounced.next_attempt_at > _utcnow()
+
+def test_unreachable_server_requeues_everything(app, smtp):
+    _use_server(app, int(refused_url().rsplit(':', 1)[1]))
+    report = deliver(_queue('a@example.com', 'b@example.com'))
+    db.session.commit()
+    assert smtp.messages == []
+    assert [entry['status'] for entry in report] == ['queued', 'queued']
+    assert all(m.last_error and m.attempts == 1 for m in MailMessage.query)
+
+# Messages a request claimed are left to it until the claim lapses
+def test_queue_skips_claimed_messages(app, smtp):
+    claimed = _queue('a@example.com')[0]
+    queue_email('Later', ['b@example.com'], '<p>Hi</p>')
+    report = mail_queue.process_once()
+    assert [entry['recipients'] for entry in report] == [['b@example.com']]
+    assert db.session.get(MailMessage, claimed.id).status == 'sending'
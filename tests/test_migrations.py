@@ -0,0 +1,99 @@
+import threading
+import pytest
+from sqlalchemy import event, inspect, text, String
+from app.models import db
+from app.migrations import MIGRATIONS, BASELINE_TABLES, upgrade, current_version, _baseline_tables
+
+LATEST = MIGRATIONS[-1][0]
+
+# SQLite reflection skips the expression index on bookmark names, with a warning
+pytestmark = pytest.mark.filterwarnings('ignore:Skipped unsupported reflection of expression-based index')
+
+def _columns(table):
+    return {c['name']: c for c in inspect(db.engine).get_columns(table)}
+
+def test_fresh_database_reaches_latest_version(database):
+    assert upgrade() == [version for version, _, _ in MIGRATIONS]
+    assert current_version() == LATEST
+
+def test_upgrade_is_idempotent(database):
+    upgrade()
+    assert upgrade() == []
+    assert current_version() == LATEST
+
+# A fresh database must end up with every table, column and index the current models declare
+def test_migrated_schema_matches_models(database):
+    upgrade()
+    inspector = inspect(db.engine)
+    postgres = db.engine.dialect.name == 'postgresql'
+    for table in db.metadata.sorted_tables:
+        columns = _columns(table.name)
+        assert set(columns) == {c.name for c in table.columns}, table.name
+        for column in table.columns:
+            if postgres and isinstance(column.type, String) and column.type.length:
+                assert columns[column.name]['type'].length == column.type.length, f"{table.name}.{column.name}"
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        assert {index.name for index in table.indexes} <= indexes, table.name
+
+# Databases created by create_all() before versioning start at version 0 with the baseline tables
+# and rows already there; migration 1 must leave them alone and the rest must apply on top
+def test_upgrade_from_unversioned_baseline(database):
+    with db.engine.begin() as connection:
+        _baseline_tables(connection)
+        connection.execute(text(
+            "INSERT INTO \"user\" (id, username, password, role, status) VALUES (1, 'admin', 'hash', 'admin', 'active')"
+        ))
+        connection.execute(text("INSERT INTO bookmark (id, user_id, name, server_url) VALUES (1, 1, 'Wiki', 'http://wiki')"))
+    assert current_version() == 0
+    assert upgrade() == [version for version, _, _ in MIGRATIONS]
+    with db.engine.connect() as connection:
+        assert connection.execute(text('SELECT username, bookmarks_version FROM "user"')).one() == ('admin', 0)
+        assert connection.execute(text('SELECT name, title, icon_url FROM bookmark')).one() == ('Wiki', None, None)
+    assert set(BASELINE_TABLES) <= set(inspect(db.engine).get_table_names())
+
+# Migration 8 widens the column on PostgreSQL; SQLite keeps VARCHAR(120) but does not enforce it
+def test_password_holds_scrypt_hashes(database):
+    upgrade()
+    if db.engine.dialect.name == 'postgresql':
+        assert _columns('user')['password']['type'].length == 255
+    password = 'scrypt:32768:8:1$' + 'x' * 200
+    with db.engine.begin() as connection:
+        connection.execute(text("INSERT INTO \"user\" (username, password) VALUES ('admin', :password)"), {'password': password})
+    with db.engine.connect() as connection:
+        assert connection.execute(text('SELECT password FROM "user"')).scalar() == password
+
+def _postgres_only(database):
+    if db.engine.dialect.name != 'postgresql':
+        pytest.skip('PostgreSQL only')
+
+def test_every_migration_takes_the_advisory_lock(database):
+    _postgres_only(database)
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        upgrade()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    assert sum('pg_advisory_xact_lock' in statement for statement in statements) == len(MIGRATIONS)
+
+# Several containers starting at once: each migration is applied exactly once
+def test_concurrent_upgrades(database):
+    _postgres_only(database)
+    results, errors = [], []
+    def run():
+        with database.app_context():
+            try:
+                results.append(upgrade())
+            except Exception as e:
+                errors.append(e)
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    applied = [version for result in results for version in result]
+    assert sorted(applied) == [version for version, _, _ in MIGRATIONS]
+    assert current_version() == LATEST
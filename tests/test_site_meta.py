@@ -0,0 +1,113 @@
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import pytest
+from benchmarks.stub_server import png_icon
+from app import image_proxy
+from app.migrations import upgrade
+from app.models import db, User, Bookmark, SiteMeta, ImageBlob
+from app.site_meta import site_meta, fetch_site, HostRateLimit
+
+# Title and favicon enrichment against a local stub HTTP server. The stub answers on both
+# 127.0.0.1 and localhost; tests that need a private host treat localhost as the private one.
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.hits[self.path] += 1
+        if self.path == '/' and self.server.root_redirect:
+            self._redirect(self.server.root_redirect)
+        elif self.path.startswith('/loop/'):
+            self._redirect(f"/loop/{int(self.path.rsplit('/', 1)[1]) + 1}")
+        elif self.path == '/icon.png':
+            self._send('image/png', self.server.icon)
+        else:
+            page = f'<html><head><title>Stub site</title><link rel="icon" href="{self.server.icon_href}"></head></html>'
+            self._send('text/html', page.encode())
+
+    def _redirect(self, location):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.end_headers()
+
+    def _send(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    server.hits = Counter()
+    server.icon = png_icon()
+    server.icon_href = '/icon.png'
+    server.root_redirect = None
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    server.private_url = f'http://localhost:{server.server_port}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def app(database, tmp_path):
+    database.config.update(UPLOAD_FOLDER=str(tmp_path), MAX_IMAGE_UPLOAD_BYTES=1024 * 1024, IMAGE_TILE_SIZE=64)
+    site_meta.init_app(database)
+    database.config.update(SITE_META_HOST_INTERVAL=0, SITE_META_ALLOW_PRIVATE=True)
+    upgrade()
+    return database
+
+# Loopback stands in for the public internet and localhost for the internal network
+@pytest.fixture
+def localhost_is_private(app, monkeypatch):
+    app.config['SITE_META_ALLOW_PRIVATE'] = False
+    monkeypatch.setattr(image_proxy, 'is_private_host', lambda url: url.startswith('http://localhost'))
+    monkeypatch.setattr(image_proxy, '_get_public_session', image_proxy.get_session)
+
+def _fetch(origin):
+    return fetch_site(origin, HostRateLimit(0))
+
+def test_bookmarks_of_one_origin_share_one_fetch(app, stub):
+    user = User(username='admin', password='x')
+    db.session.add(user)
+    db.session.flush()
+    for url in (stub.url + '/', stub.url + '/docs', stub.url + '/blog?page=2', stub.private_url + '/'):
+        db.session.add(Bookmark(user_id=user.id, name=url, server_url=url))
+    db.session.commit()
+
+    assert site_meta.run_once() == (4, 2)
+    assert stub.hits['/'] == 2  # Once per origin
+    assert SiteMeta.query.count() == 2
+    bookmarks = Bookmark.query.all()
+    assert {bookmark.title for bookmark in bookmarks} == {'Stub site'}
+    assert len({bookmark.icon_url for bookmark in bookmarks}) == 1
+    assert ImageBlob.query.one().refcount == 4
+    # Known origins are not fetched again
+    assert site_meta.run_once() == (0, 0)
+    assert stub.hits['/'] == 2
+
+def test_redirect_hops_are_limited(app, stub):
+    stub.root_redirect = '/loop/1'
+    fetched = _fetch(stub.url)
+    assert fetched.error == 'TooManyRedirects'
+    assert fetched.title is None
+    assert sum(count for path, count in stub.hits.items() if path.startswith('/loop/')) == 5
+
+def test_redirect_to_private_host_is_refused(app, stub, localhost_is_private):
+    stub.root_redirect = stub.private_url + '/'
+    fetched = _fetch(stub.url)
+    assert fetched.error == 'PrivateHost'
+    assert fetched.title is None
+    assert stub.hits == Counter({'/': 1})  # The redirect itself, never the private page
+
+def test_private_icon_is_not_fetched(app, stub, localhost_is_private):
+    stub.icon_href = stub.private_url + '/icon.png'
+    fetched = _fetch(stub.url)
+    assert fetched.error is None and fetched.title == 'Stub site'
+    assert fetched.icon is None
+    assert stub.hits['/icon.png'] == 0